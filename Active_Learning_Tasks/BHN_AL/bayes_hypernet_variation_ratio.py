@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from BHNs import HyperCNN
 from ops import load_mnist
+from encoding import onehot
 from utils import log_normal, log_laplace
 import numpy as np
 import random
@@ -10,15 +11,7 @@ from scipy.stats import mode
 
 
 def to_categorical(y):
-    num_classes=10
-    y = np.array(y, dtype='int').ravel()
-    if not num_classes:
-        num_classes = np.max(y) + 1
-    n = y.shape[0]
-    categorical = np.zeros((n, num_classes))
-    categorical[np.arange(n), y] = 1
-
-    return categorical
+    return onehot(y, 10, dtype='float64')
 
 
 def split_train_pool_data(X_train, y_train):
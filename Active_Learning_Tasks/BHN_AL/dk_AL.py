@@ -2,6 +2,7 @@
 from BHNs import HyperCNN
 from ops import load_mnist
 from utils import log_normal, log_laplace
+from prefetch import iterate_minibatches
 import numpy
 np = numpy
 import random
@@ -43,7 +44,7 @@ def train_epoch(train_func,predict_func,X,Y,Xt,Yt,
 
 
 def train_model(train_func,predict_func,X,Y,Xt,Yt,
-                lr0=0.1,lrdecay=1,bs=20,epochs=50):
+                lr0=0.1,lrdecay=1,bs=20,epochs=50,prefetch=0):
 
     N = X.shape[0]    
     records=list()
@@ -57,9 +58,7 @@ def train_model(train_func,predict_func,X,Y,Xt,Yt,
             lr = lr0         
             
         #for i in range(N/bs):
-        for i in range( N/bs + int(N%bs > 0) ):
-            x = X[i*bs:(i+1)*bs]
-            y = Y[i*bs:(i+1)*bs]
+        for x, y in iterate_minibatches(X,Y,bs,prefetch,drop_last=False):
             
             loss = train_func(x,y,N,lr)
             
@@ -76,14 +75,14 @@ def train_model(train_func,predict_func,X,Y,Xt,Yt,
     return records
 
 
-def test_model(predict_proba, X_test, y_test):
+def test_model(predict_proba, X_test, y_test, dtype=np.float64):
     mc_samples = 100
-    y_pred_all = np.zeros((mc_samples, X_test.shape[0], 10))
+    y_pred_all = np.zeros((mc_samples, X_test.shape[0], 10), dtype=dtype)
 
     for m in range(mc_samples):
         y_pred_all[m] = predict_proba(X_test)
 
-    y_pred = y_pred_all.mean(0).argmax(-1)
+    y_pred = y_pred_all.mean(0, dtype=np.promote_types(dtype, np.float32)).argmax(-1)
     y_test = y_test.argmax(-1)
 
     test_accuracy = np.equal(y_pred, y_test).mean()
@@ -179,11 +178,11 @@ def active_learning(acquisition_iterations):
 
 
    
-    valid_accuracy = test_model(model.predict_proba, valid_x, valid_y)
+    valid_accuracy = test_model(model.predict_proba, valid_x, valid_y, mc_dtype)
     print "                                                          valid Accuracy", valid_accuracy
     all_valid_accuracy = valid_accuracy
 
-    test_accuracy = test_model(model.predict_proba, test_x, test_y)
+    test_accuracy = test_model(model.predict_proba, test_x, test_y, mc_dtype)
     print "                                                          Test Accuracy", test_accuracy
     all_accuracy = test_accuracy
 
@@ -205,7 +204,7 @@ def active_learning(acquisition_iterations):
         if acq == 'bald':
     	    score_All = np.zeros(shape=(X_pool_Dropout.shape[0], nb_classes))
             All_Entropy_BH = np.zeros(shape=X_pool_Dropout.shape[0])
-            all_bh_classes = np.zeros(shape=(X_pool_Dropout.shape[0], bh_iterations))
+            all_bh_classes = np.zeros(shape=(X_pool_Dropout.shape[0], bh_iterations), dtype=mc_dtype)
 
 
             for d in range(bh_iterations):
@@ -364,12 +363,12 @@ def active_learning(acquisition_iterations):
 	                       lr0,lrdecay,bs,epochs)
    
 
-        valid_accuracy = test_model(model.predict_proba, valid_x, valid_y)   
+        valid_accuracy = test_model(model.predict_proba, valid_x, valid_y, mc_dtype)   
         print "                                                          Valid Accuracy", valid_accuracy
         all_valid_accuracy = np.append(all_valid_accuracy, valid_accuracy)
 
         if test_eval:
-            test_accuracy = test_model(model.predict_proba, test_x, test_y)   
+            test_accuracy = test_model(model.predict_proba, test_x, test_y, mc_dtype)   
             print "                                                          Test Accuracy", test_accuracy
             all_accuracy = np.append(all_accuracy, test_accuracy)
 
@@ -439,6 +438,7 @@ if __name__ == '__main__':
     parser.add_argument('--save_dir', type=str, default="./")
     parser.add_argument('--seed', type=int, default=1337)
     parser.add_argument('--verbose', type=int, default=1)
+    parser.add_argument('--mc_dtype', type=str, default='float64', choices=['float64', 'float32', 'float16'])
 
 
     # --------------------------------------------
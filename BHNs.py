@@ -14,7 +14,7 @@ from modules import CoupledDenseLayer, ConvexBiasLayer, CoupledWNDenseLayer, \
                     stochastic_weight_norm
 from modules import MNFLayer
 from modules import *
-from utils import log_normal
+from utils import log_normal, log_mean_exp
 import theano
 import theano.tensor as T
 from theano.tensor.shared_randomstreams import RandomStreams
@@ -31,11 +31,11 @@ from lasagne.objectives import squared_error as se
 import numpy as np
 
 from helpers import flatten_list
-from helpers import SaveLoadMIXIN
+from helpers import SaveLoadMIXIN, CheckpointMIXIN
 
 
 lrdefault = 1e-3
-class Base_BHN(object):
+class Base_BHN(CheckpointMIXIN):
     """
     def _get_theano_variables(self):
     def _get_hyper_net(self):
@@ -49,6 +49,12 @@ class Base_BHN(object):
     
     max_norm = 10
     clip_grad = 5
+    # conditioner of the conv coupling layers (flow='ConvNVP')
+    conv_units = 16
+    conv_filter_size = 5
+    # checked when loading a checkpoint
+    signature_attrs = ['flow', 'coupling', 'conditioner', 'num_params',
+                       'weight_shapes', 'output_type']
     
     def __init__(self,
                 flow='RealNVP',
@@ -60,22 +66,50 @@ class Base_BHN(object):
                  prior = log_normal,
                  output_type = 'categorical',
                  test_values=None,
-                 init_batch = None):
+                 init_batch = None,
+                 conditioner='dense',
+                 conditioner_rank=16,
+                 n_groups=None,
+                 n_elbo_samples=1,
+                 elbo_estimator='mean',
+                 int_targets=False):
         
+        # int_targets: the targets are int labels (an ivector) instead of 
+        # one-hot rows, for output_type='categorical'
         self.__dict__.update(locals())
+        if not hasattr(self,'block_sizes'):
+            self.block_sizes = [self.num_params,]
         
         self._get_theano_variables()
         
+        assert elbo_estimator in ['mean','iwae']
+        if int_targets:
+            assert output_type == 'categorical'
+        if n_elbo_samples > 1:
+            assert not perdatapoint, 'n_elbo_samples > 1 needs wd1 = 1'
+        
         if perdatapoint:
-            self.wd1 = self.input_var.shape[0]
+            if n_groups is None:
+                self.wd1 = self.input_var.shape[0]
+            else:
+                # one sample per group of examples
+                self.wd1 = T.minimum(n_groups,self.input_var.shape[0])
         else:
-            self.wd1 = 1
+            self.wd1 = n_elbo_samples
     
         
         print('\tbuilding hyper net')
         self._get_hyper_net()
+        if perdatapoint and n_groups is not None:
+            self._group_samples()
+        self.p_input = self.input_var
+        self.p_weights = self.weights
+        if n_elbo_samples > 1:
+            self._tile_samples()
         print('\tbuilding primary net')
         self._get_primary_net()
+        if n_elbo_samples > 1:
+            self._average_samples()
         print('\tgetting params')
         self._get_params()
         print('\tgetting elbo')
@@ -102,7 +136,10 @@ class Base_BHN(object):
     
     def _get_theano_variables(self):
         self.input_var = T.matrix('input_var')
-        self.target_var = T.matrix('target_var')
+        if self.int_targets:
+            self.target_var = T.ivector('target_var')
+        else:
+            self.target_var = T.matrix('target_var')
         self.dataset_size = T.scalar('dataset_size')
         self.learning_rate = T.scalar('learning_rate')
         # TODO: fix name
@@ -127,9 +164,83 @@ class Base_BHN(object):
                                   "the _get_hyper_net() method")
 
     
+    def _get_coupling_layer(self, incoming, num_units,
+                            dense_layer=CoupledDenseLayer):
+        """
+        coupling layer of the RealNVP hypernet; the conditioner is chosen
+        by self.conditioner:
+            dense           dense_layer
+            lowrank         matrices factored with rank conditioner_rank
+            block           one conditioner per block of self.block_sizes 
+                            (one block per primary net layer)
+            block_lowrank   both
+        """
+        if self.conditioner == 'dense':
+            return dense_layer(incoming,num_units)
+        elif self.conditioner == 'lowrank':
+            return CoupledLowRankDenseLayer(incoming,num_units,
+                                            self.conditioner_rank)
+        elif self.conditioner == 'block':
+            return CoupledBlockDenseLayer(incoming,num_units,
+                                          self.block_sizes)
+        elif self.conditioner == 'block_lowrank':
+            return CoupledBlockDenseLayer(incoming,num_units,
+                                          self.block_sizes,
+                                          self.conditioner_rank)
+        else:
+            raise Exception('conditioner {} not ' \
+                            'supported.'.format(self.conditioner))
+    
+    def _get_permute_layer(self, incoming):
+        # block conditioners need the blocks to stay in place
+        if self.conditioner in ['block', 'block_lowrank']:
+            return BlockPermuteLayer(incoming,self.block_sizes)
+        else:
+            return PermuteLayer(incoming,self.num_params)
+    
+    def _group_samples(self):
+        """
+        perdatapoint with n_groups: the hypernet only ran on wd1 <= n_groups
+        noise vectors; example i of the minibatch gets the sample i % wd1.
+        
+        REDEFINE weights, logdets (one row per example), wd1
+        """
+        self.group_index = T.arange(self.input_var.shape[0]) % self.wd1
+        self.weights = self.weights[self.group_index]
+        self.logdets = self.logdets[self.group_index]
+        self.wd1 = self.input_var.shape[0]
+    
+    def _tile_samples(self):
+        """
+        n_elbo_samples=K: the flow ran once on K noise vectors; the primary
+        net runs once on the minibatch tiled K times (sample-major), the
+        k-th copy using the k-th sample.
+        
+        REDEFINE p_input, p_weights (one row per example), wd1
+        """
+        K = self.n_elbo_samples
+        N = self.input_var.shape[0]
+        reps = (K,) + (1,)*(self.input_var.ndim-1)
+        self.p_input = T.tile(self.input_var,reps)
+        self.p_weights = T.repeat(self.weights,N,axis=0)
+        self.wd1 = K*N
+    
+    def _average_samples(self):
+        """
+        keep the K*N outputs for the elbo; predictions average the K samples
+        
+        DEFINE y_samples; REDEFINE y, y_unclipped
+        """
+        K = self.n_elbo_samples
+        N = self.input_var.shape[0]
+        self.y_samples = self.y
+        self.y = self.y.reshape((K,N,-1)).mean(0)
+        self.y_unclipped = self.y_unclipped.reshape((K,N,-1)).mean(0)
+    
     def _get_primary_net(self):
         """
-        main structure of the predictive network (to be specified).
+        main structure of the predictive network (to be specified),
+        reading p_input and p_weights.
         
         DEFINE p_net, y
         """
@@ -162,14 +273,30 @@ class Base_BHN(object):
         of the variance
         """
         self.kl = (self.logqw - self.logpw).mean()
+        
+        K = self.n_elbo_samples
+        if K > 1:
+            y = self.y_samples
+            target_var = T.tile(self.target_var,
+                                (K,) + (1,)*(self.target_var.ndim-1))
+        else:
+            y = self.y
+            target_var = self.target_var
         if self.output_type == 'categorical':
-            self.logpyx = - cc(self.y,self.target_var).mean()
+            logpyx = - cc(y,target_var)
         elif self.output_type == 'real':
-            self.logpyx = - se(self.y,self.target_var).mean()
+            logpyx = - se(y,target_var)
         else:
             assert False
-        self.loss = - (self.logpyx - \
-                       self.weight * self.kl/T.cast(self.dataset_size,floatX))
+        # one estimate per sample of q(w)
+        logpyx = logpyx.reshape((K,-1)).mean(1)
+        self.logpyx = logpyx.mean()
+        ds = T.cast(self.dataset_size,floatX)
+        elbo = logpyx - self.weight * (self.logqw - self.logpw)/ds
+        if self.elbo_estimator == 'iwae':
+            self.loss = - log_mean_exp(ds * elbo)/ds
+        else:
+            self.loss = - elbo.mean()
 
         # DK - extra monitoring
         params = self.params
@@ -218,28 +345,10 @@ class Base_BHN(object):
     def _get_useful_funcs(self):
         pass
     
+    def _param_groups(self):
+        return [('hnet', lasagne.layers.get_all_params(self.h_net)),
+                ('pnet', lasagne.layers.get_all_params(self.p_net))]
     
-    def save(self,save_path,notes=[]):
-        np.save(save_path, [p.get_value() for p in self.params]+notes)
-
-    def load(self,save_path):
-        values = np.load(save_path)
-        notes = values[-1]
-        values = values[:-1]
-
-        if len(self.params) != len(values):
-            raise ValueError("mismatch: got %d values to set %d parameters" %
-                             (len(values), len(self.params)))
-
-        for p, v in zip(self.params, values):
-            if p.get_value().shape != v.shape:
-                raise ValueError("mismatch: parameter has shape %r but value to "
-                                 "set has shape %r" %
-                                 (p.get_value().shape, v.shape))
-            else:
-                p.set_value(v)
-
-        return notes
 
     # TODO: make sure init of subclass doesn't undo this!?
     def _init_pnet(self,init_batch):
@@ -313,6 +422,7 @@ class MLPWeightNorm_BHN(Base_BHN):
             self.weight_shapes.append((n_units,n_units))
         self.weight_shapes.append((n_units,n_classes))
         self.num_params = sum(ws[1] for ws in self.weight_shapes)
+        self.block_sizes = [ws[1] for ws in self.weight_shapes]
         
         super(MLPWeightNorm_BHN, self).__init__(lbda=lbda,
                                                 perdatapoint=perdatapoint,
@@ -341,14 +451,20 @@ class MLPWeightNorm_BHN(Base_BHN):
         
         if self.flow == 'RealNVP':
             if self.coupling:
-                layer_temp = CoupledDenseLayer(h_net,200)
+                layer_temp = self._get_coupling_layer(h_net,200)
                 h_net = IndexLayer(layer_temp,0)
                 logdets_layers.append(IndexLayer(layer_temp,1))
                 for c in range(self.coupling-1):
-                    h_net = PermuteLayer(h_net,self.num_params)
-                    layer_temp = CoupledDenseLayer(h_net,200)
+                    h_net = self._get_permute_layer(h_net)
+                    layer_temp = self._get_coupling_layer(h_net,200)
                     h_net = IndexLayer(layer_temp,0)
                     logdets_layers.append(IndexLayer(layer_temp,1))
+        elif self.flow == 'ConvNVP':
+            if self.coupling:
+                h_net, ld_layers = NVP_conv_layer(h_net,self.conv_units,
+                                                  self.coupling,
+                                                  self.conv_filter_size)
+                logdets_layers += ld_layers
         elif self.flow == 'IAF':
             layer_temp = IAFDenseLayer(h_net,200,1,L=self.coupling,cond_bias=False)
             h_net = IndexLayer(layer_temp,0)
@@ -364,12 +480,12 @@ class MLPWeightNorm_BHN(Base_BHN):
         # TODO: figure out why I can't run at school anymore (DK)  >:( 
         t = 0#np.cast['int32'](0) # TODO: what's wrong with np.cast
         p_net = lasagne.layers.InputLayer([None,self.n_inputs])
-        inputs = {p_net:self.input_var}
+        inputs = {p_net:self.p_input}
         for ws in self.weight_shapes:
             # using weightnorm reparameterization
             # only need ws[1] parameters (for rescaling of the weight matrix)
             num_param = ws[1]
-            weight = self.weights[:,t:t+num_param].reshape((self.wd1,ws[1]))
+            weight = self.p_weights[:,t:t+num_param].reshape((self.wd1,ws[1]))
             p_net = lasagne.layers.DenseLayer(p_net,ws[1])
             p_net = stochastic_weight_norm(p_net,weight)
             print p_net.output_shape
@@ -441,6 +557,10 @@ class MNF_MLP_BHN(Base_BHN):
 
         assert perdatapoint
         assert lbda == 1
+        # _get_elbo below is single-sample (its z_T_fs and z_T_bs would not 
+        # line up with K samples)
+        assert kargs.get('n_elbo_samples', 1) == 1, \
+            'MNF_MLP_BHN only supports n_elbo_samples = 1'
         
         self.__dict__.update(locals())
 
@@ -450,6 +570,7 @@ class MNF_MLP_BHN(Base_BHN):
             self.weight_shapes.append((n_units,n_units))
         self.weight_shapes.append((n_units,n_classes))
         self.num_params = sum(ws[0] for ws in self.weight_shapes)
+        self.block_sizes = [ws[0] for ws in self.weight_shapes]
         
         super(MNF_MLP_BHN, self).__init__(lbda=lbda,
                                                 perdatapoint=perdatapoint,
@@ -474,14 +595,20 @@ class MNF_MLP_BHN(Base_BHN):
         
         if self.flow == 'RealNVP':
             if self.coupling:
-                layer_temp = CoupledDenseLayer(h_net,200)
+                layer_temp = self._get_coupling_layer(h_net,200)
                 h_net = IndexLayer(layer_temp,0)
                 logdets_layers.append(IndexLayer(layer_temp,1))
                 for c in range(self.coupling-1):
-                    h_net = PermuteLayer(h_net,self.num_params)
-                    layer_temp = CoupledDenseLayer(h_net,200)
+                    h_net = self._get_permute_layer(h_net)
+                    layer_temp = self._get_coupling_layer(h_net,200)
                     h_net = IndexLayer(layer_temp,0)
                     logdets_layers.append(IndexLayer(layer_temp,1))
+        elif self.flow == 'ConvNVP':
+            if self.coupling:
+                h_net, ld_layers = NVP_conv_layer(h_net,self.conv_units,
+                                                  self.coupling,
+                                                  self.conv_filter_size)
+                logdets_layers += ld_layers
         elif self.flow == 'IAF':
             layer_temp = IAFDenseLayer(h_net,200,1,L=self.coupling,cond_bias=False)
             h_net = IndexLayer(layer_temp,0)
@@ -525,6 +652,11 @@ class MNF_MLP_BHN(Base_BHN):
         # TODO
         self.logdets_z_T_b = sum([get_output(ld,self.ep) for ld in logdets_layers])
     
+    def _group_samples(self):
+        super(MNF_MLP_BHN, self)._group_samples()
+        self.z_T_bs = [z_T_b[self.group_index] for z_T_b in self.z_T_bs]
+        self.logdets_z_T_b = self.logdets_z_T_b[self.group_index]
+
     # FIXME: use z*mu...
     def _get_primary_net(self):
         self.mus = []
@@ -535,14 +667,14 @@ class MNF_MLP_BHN(Base_BHN):
         self.b_logsigs = []
         t = 0
         p_net = lasagne.layers.InputLayer([None,self.n_inputs])
-        inputs = {p_net:self.input_var}
+        inputs = {p_net:self.p_input}
         for ws in self.weight_shapes:
             # using weightnorm reparameterization
             # only need ws[1] parameters (for rescaling of the weight matrix)
             num_param = ws[0]
             print num_param
             w_layer = lasagne.layers.InputLayer((None,num_param))
-            weight = self.weights[:,t:t+num_param].reshape((self.wd1, num_param)) # bs, n_inp
+            weight = self.p_weights[:,t:t+num_param].reshape((self.wd1, num_param)) # bs, n_inp
             self.z_T_fs.append(weight)
             inputs[w_layer] = weight
             p_net = MNFLayer([p_net,w_layer], ws[1], ws[0])
@@ -673,8 +805,15 @@ class HyperWN_CNN(Base_BHN):
                  nonl=rectify,
                  pool_per=1,
                  n_units_h=200,
+                 input_dtype=floatX,
+                 input_scale=1.,
+                 input_mean=None,
                  **kargs):
-        
+        """
+        input_dtype, input_scale, input_mean: the input_var can be e.g. 
+        uint8 images, cast, scaled and centered inside the graph 
+        (InputNormLayer) so that the minibatches stay uint8 on the host
+        """
         
         weight_shapes = list()
         args = list()
@@ -707,6 +846,9 @@ class HyperWN_CNN(Base_BHN):
         self.num_mlp_layers = n_mlplayers
         self.num_hids = n_units
         self.num_hids_h = n_units_h
+        self.input_dtype = input_dtype
+        self.input_scale = input_scale
+        self.input_mean = input_mean
 
         self.n_kernels = np.array(self.weight_shapes)[:,1].sum()
         self.kernel_shape = self.weight_shapes[0][:1]+self.weight_shapes[0][2:]
@@ -718,6 +860,9 @@ class HyperWN_CNN(Base_BHN):
                               self.num_hids * self.num_mlp_layers
         self.num_cnn_params = np.sum(np.array(self.weight_shapes)[:,0])
         self.num_params = self.num_mlp_params + self.num_cnn_params
+        self.block_sizes = [ws[0] for ws in self.weight_shapes] + \
+                           [self.num_hids,] * self.num_mlp_layers + \
+                           [self.num_classes,]
         
         self.coupling = coupling
         super(HyperWN_CNN, self).__init__(lbda=lbda,
@@ -729,7 +874,7 @@ class HyperWN_CNN(Base_BHN):
     def _get_theano_variables(self):
         # redefine a 4-d tensor for convnet
         super(HyperWN_CNN, self)._get_theano_variables()
-        self.input_var = T.tensor4('input_var')
+        self.input_var = T.tensor4('input_var',dtype=self.input_dtype)
      
     
     def _get_hyper_net(self):
@@ -747,16 +892,24 @@ class HyperWN_CNN(Base_BHN):
         
         if self.flow == 'RealNVP':
             if self.coupling:
-                layer_temp = CoupledWNDenseLayer(h_net,self.num_hids_h)
+                layer_temp = self._get_coupling_layer(
+                    h_net,self.num_hids_h,CoupledWNDenseLayer)
                 h_net = IndexLayer(layer_temp,0)
                 logdets_layers.append(IndexLayer(layer_temp,1))
                  
                 for c in range(self.coupling-1):
-                    h_net = PermuteLayer(h_net,self.num_params)
+                    h_net = self._get_permute_layer(h_net)
                     
-                    layer_temp = CoupledWNDenseLayer(h_net,self.num_hids_h)
+                    layer_temp = self._get_coupling_layer(
+                        h_net,self.num_hids_h,CoupledWNDenseLayer)
                     h_net = IndexLayer(layer_temp,0)
                     logdets_layers.append(IndexLayer(layer_temp,1))
+        elif self.flow == 'ConvNVP':
+            if self.coupling:
+                h_net, ld_layers = NVP_conv_layer(h_net,self.conv_units,
+                                                  self.coupling,
+                                                  self.conv_filter_size)
+                logdets_layers += ld_layers
         elif self.flow == 'IAF':
             layer_temp = IAFDenseLayer(h_net,self.num_hids_h,1,
                                        L=self.coupling,cond_bias=False)
@@ -776,13 +929,20 @@ class HyperWN_CNN(Base_BHN):
         t = 0 #np.cast['int32'](0)
         p_net = lasagne.layers.InputLayer((None,)+self.input_shape)
         print p_net.output_shape
-        inputs = {p_net:self.input_var}
+        inputs = {p_net:self.p_input}
+        if self.input_dtype != floatX or self.input_scale != 1 or \
+           self.input_mean is not None:
+            p_net = InputNormLayer(p_net,self.input_scale,self.input_mean)
         for ws, args in zip(self.weight_shapes,self.args):
 
             num_filters = ws[0]
             
-            # TO-DO: generalize to have multiple samples?
-            weight = self.weights[0,t:t+num_filters].dimshuffle(0,'x','x','x')
+            if self.wd1 == 1:
+                # one sample: rescale the filters
+                weight = self.p_weights[0,t:t+num_filters].dimshuffle(0,'x','x','x')
+            else:
+                # one sample per example: rescale the feature maps
+                weight = self.p_weights[:,t:t+num_filters]
 
             num_filters = args[0]
             filter_size = args[1]
@@ -801,7 +961,7 @@ class HyperWN_CNN(Base_BHN):
 
             
         for layer in range(self.num_mlp_layers):
-            weight = self.weights[:,t:t+self.num_hids].reshape((self.wd1,
+            weight = self.p_weights[:,t:t+self.num_hids].reshape((self.wd1,
                                                                 self.num_hids))
             p_net = lasagne.layers.DenseLayer(p_net,self.num_hids,
                                               nonlinearity=rectify)
@@ -809,7 +969,7 @@ class HyperWN_CNN(Base_BHN):
             t += self.num_hids
 
 
-        weight = self.weights[:,t:t+self.num_classes].reshape((self.wd1,self.num_classes))
+        weight = self.p_weights[:,t:t+self.num_classes].reshape((self.wd1,self.num_classes))
 
         p_net = lasagne.layers.DenseLayer(p_net,self.num_classes,
                                           nonlinearity=nonlinearities.softmax)
@@ -824,6 +984,12 @@ class HyperWN_CNN(Base_BHN):
     def _get_useful_funcs(self):
         self.predict_proba = theano.function([self.input_var],self.y)
         self.predict = theano.function([self.input_var],self.y.argmax(1))       
+        if self.n_elbo_samples > 1:
+            # (n_elbo_samples, batch_size, num_classes) in one pass
+            K = self.n_elbo_samples
+            N = self.input_var.shape[0]
+            self.predict_proba_samples = theano.function(
+                [self.input_var],self.y_samples.reshape((K,N,-1)))
         
 
 
@@ -30,11 +30,11 @@ from lasagne.objectives import squared_error as se
 import numpy as np
 
 from helpers import flatten_list
-from helpers import SaveLoadMIXIN
+from helpers import SaveLoadMIXIN, CheckpointMIXIN
 
 
 lrdefault = 1e-3
-class Base_BHN(object):
+class Base_BHN(CheckpointMIXIN):
     """
     def _get_theano_variables(self):
     def _get_hyper_net(self):
@@ -48,6 +48,12 @@ class Base_BHN(object):
     
     max_norm = 10
     clip_grad = 5
+    # conditioner of the conv coupling layers (flow='ConvNVP')
+    conv_units = 16
+    conv_filter_size = 5
+    # checked when loading a checkpoint
+    signature_attrs = ['flow', 'coupling', 'conditioner', 'num_params',
+                       'weight_shapes', 'input_dim']
     
     def __init__(self,
                 flow='RealNVP',
@@ -173,8 +179,7 @@ class Base_BHN(object):
         
     def _get_grads(self):
         grads = T.grad(self.loss, self.params)
-        mgrads = lasagne.updates.total_norm_constraint(grads,
-                                                       max_norm=self.max_norm)
+        mgrads = self._constrain_grads(grads)
         cgrads = [T.clip(g, -self.clip_grad, self.clip_grad) for g in mgrads]
         if self.opt == 'adam':
             self.updates = lasagne.updates.adam(cgrads, self.params, 
@@ -186,6 +191,10 @@ class Base_BHN(object):
             self.updates = lasagne.updates.sgd(cgrads, self.params, 
                                                 learning_rate=self.learning_rate)
                                     
+    def _constrain_grads(self, grads):
+        return lasagne.updates.total_norm_constraint(grads,
+                                                     max_norm=self.max_norm)
+                                    
     def _get_train_func(self):
         inputs = [self.input_var,
                   self.target_var,
@@ -209,31 +218,10 @@ class Base_BHN(object):
     def _get_useful_funcs(self):
         pass
     
+    def _param_groups(self):
+        return [('hnet', lasagne.layers.get_all_params(self.h_net)),
+                ('pnet', lasagne.layers.get_all_params(self.p_net))]
     
-    def save(self,save_path,notes=[None]):
-        np.save(save_path, [p.get_value() for p in self.params]+notes)
-
-    def load(self,save_path):
-        values = np.load(save_path)
-        # TODO: serious hacking here!
-        if len(self.params) == len(values) - 1:
-            notes = values[-1]
-            values = values[:-1]
-        elif len(self.params) == len(values):
-            notes = None
-        else:
-            raise ValueError("mismatch: got %d values to set %d parameters" %
-                             (len(values), len(self.params)))
-
-        for p, v in zip(self.params, values):
-            if p.get_value().shape != v.shape:
-                raise ValueError("mismatch: parameter has shape %r but value to "
-                                 "set has shape %r" %
-                                 (p.get_value().shape, v.shape))
-            else:
-                p.set_value(v)
-
-        return notes
 
     def _init_pnet(self,init_batch):
         init_output = init_batch.copy()
@@ -335,9 +323,15 @@ class MLPWeightNorm_BHN(Base_BHN):
                     layer_temp = CoupledDenseLayer(h_net,200)
                     h_net = IndexLayer(layer_temp,0)
                     logdets_layers.append(IndexLayer(layer_temp,1))
+        elif self.flow == 'ConvNVP':
+            if self.coupling:
+                h_net, ld_layers = NVP_conv_layer(h_net,self.conv_units,
+                                                  self.coupling,
+                                                  self.conv_filter_size)
+                logdets_layers += ld_layers
         elif self.flow == 'IAF':
             layer_temp = IAFDenseLayer(h_net,200,1,L=self.coupling,cond_bias=False)
-            layer = IndexLayer(layer_temp,0)
+            h_net = IndexLayer(layer_temp,0)
             logdets_layers.append(IndexLayer(layer_temp,1))
         else:
             assert False
@@ -383,7 +377,168 @@ class MLPWeightNorm_BHN(Base_BHN):
 
 
 
-class MCdropout_MLP(object):
+class StackedMLPWeightNorm_BHN(Base_BHN):
+    """
+    n_models independent MLPWeightNorm_BHNs (e.g. one per split of a UCI 
+    dataset) in one graph: every param has a leading model axis, the dots 
+    are batched dots, and each model has its own minibatch:
+        input_var   (n_models,batch_size,input_dim)
+        target_var  (n_models,batch_size,1)
+        dataset_size  (n_models,)
+    the loss is the sum of the losses of the models, and the gradients are 
+    constrained per model, so that each model is trained as if alone.
+    """
+
+    signature_attrs = Base_BHN.signature_attrs + ['n_models']
+    
+    def __init__(self,
+                 n_models,
+                 lbda=1,
+                 srng = RandomStreams(seed=427),
+                 prior = log_normal,
+                 coupling=True,
+                 n_hiddens=1,
+                 n_units=50,
+                 input_dim=1,
+                 **kargs):
+        
+        self.__dict__.update(locals())
+
+        self.weight_shapes = list()        
+        self.weight_shapes.append((input_dim,n_units))
+        for i in range(1,n_hiddens):
+            self.weight_shapes.append((n_units,n_units))
+        self.weight_shapes.append((n_units,1))
+        self.num_params = sum(ws[1] for ws in self.weight_shapes)
+        
+        assert kargs.get('output_type','real') == 'real'
+        super(StackedMLPWeightNorm_BHN, self).__init__(lbda=lbda,
+                                                       perdatapoint=False,
+                                                       srng=srng,
+                                                       prior=prior,
+                                                       **kargs)
+    
+    def _get_theano_variables(self):
+        self.input_var = T.tensor3('input_var')
+        self.target_var = T.tensor3('target_var')
+        self.dataset_size = T.vector('dataset_size')
+        self.learning_rate = T.scalar('learning_rate')
+        self.weight = T.scalar('weight')
+    
+    def _get_hyper_net(self):
+        # one noise vector per model
+        ep = self.srng.normal(size=(self.n_models,
+                                    self.num_params),dtype=floatX)
+        logdets_layers = []
+        h_net = lasagne.layers.InputLayer([self.n_models,self.num_params])
+        
+        layer_temp = StackedLinearFlowLayer(h_net)
+        h_net = IndexLayer(layer_temp,0)
+        logdets_layers.append(IndexLayer(layer_temp,1))
+        
+        if self.flow == 'RealNVP':
+            if self.coupling:
+                layer_temp = StackedCoupledDenseLayer(h_net,200)
+                h_net = IndexLayer(layer_temp,0)
+                logdets_layers.append(IndexLayer(layer_temp,1))
+                for c in range(self.coupling-1):
+                    h_net = PermuteLayer(h_net,self.num_params)
+                    layer_temp = StackedCoupledDenseLayer(h_net,200)
+                    h_net = IndexLayer(layer_temp,0)
+                    logdets_layers.append(IndexLayer(layer_temp,1))
+        elif self.flow == 'IAF':
+            if self.coupling:
+                layer_temp = StackedIAFDenseLayer(h_net,200,1,L=self.coupling)
+                h_net = IndexLayer(layer_temp,0)
+                logdets_layers.append(IndexLayer(layer_temp,1))
+        else:
+            assert False
+        
+        self.h_net = h_net
+        self.weights = lasagne.layers.get_output(h_net,ep)
+        self.logdets = sum([get_output(ld,ep) for ld in logdets_layers])
+    
+    def _get_primary_net(self):
+        t = 0
+        p_net = lasagne.layers.InputLayer([self.n_models,None,self.input_dim])
+        inputs = {p_net:self.input_var}
+        for j,ws in enumerate(self.weight_shapes):
+            num_param = ws[1]
+            weight = self.weights[:,t:t+num_param]
+            if j == len(self.weight_shapes)-1:
+                nonlinearity = nonlinearities.linear
+            else:
+                nonlinearity = nonlinearities.rectify
+            p_net = StackedWeightNormDenseLayer(p_net,ws[1],weight,
+                                                nonlinearity=nonlinearity)
+            print p_net.output_shape
+            t += num_param
+        
+        self.p_net = p_net
+        self.y = get_output(p_net,inputs)
+    
+    def _get_elbo(self):
+        """
+        negative elbo of each model (n_models,), summed in loss
+        """
+        ds = T.cast(self.dataset_size,floatX)
+        self.logqw = - self.logdets
+        self.logpw = self.prior(self.weights,0.,-T.log(self.lbda)).sum(1)
+        self.kl = self.logqw - self.logpw
+        self.logpyx = - se(self.y,self.target_var).mean(axis=(1,2))
+        self.losses = - (self.logpyx - self.weight * self.kl/ds)
+        self.loss = self.losses.sum()
+        self.monitored = [self.logpyx, self.logpw, self.logqw]
+    
+    def _constrain_grads(self, grads):
+        # total_norm_constraint, applied to each model separately
+        norms = T.sqrt(sum([T.sqr(g).reshape((self.n_models,-1)).sum(1)
+                            for g in grads]))
+        target_norms = T.clip(norms, 0, self.max_norm)
+        multipliers = target_norms / (1e-7 + norms)
+        return [g * multipliers.dimshuffle([0]+['x']*(g.ndim-1))
+                for g in grads]
+    
+    def _get_useful_funcs(self):
+        self.predict = theano.function([self.input_var],self.y)
+    
+    def _init_pnet(self,init_batch):
+        """
+        init_batch: (n_models,n,input_dim)
+        """
+        init_output = T.as_tensor_variable(np.cast[floatX](init_batch))
+        all_layers = lasagne.layers.get_all_layers(self.p_net)
+        
+        bs = list()
+        gs = list()
+        for l in all_layers[1:]:
+            W = l.W / T.sqrt(T.sum(T.square(l.W),axis=1,keepdims=True))
+            input = T.batched_dot(init_output,W)
+            m = T.mean(input,1)
+            input -= m.dimshuffle(0,'x',1)
+            stdv = T.sqrt(T.mean(T.square(input),axis=1))
+            input /= stdv.dimshuffle(0,'x',1)
+            bs.append(-m/stdv)
+            gs.append(1./stdv)
+            init_output = l.nonlinearity(input)
+        
+        for l,b in zip(all_layers[1:],bs):
+            l.b.set_value(b.eval())
+        
+        gs_ = lasagne.layers.get_all_layers(self.h_net)[1].b
+        new_gs = np.concatenate([g.eval() for g in gs],1)
+        old_gs = gs_.get_value()
+        gs_.set_value(new_gs*old_gs)
+
+
+
+
+
+
+class MCdropout_MLP(CheckpointMIXIN):
+
+    # checked when loading a checkpoint
+    signature_attrs = ['n_hiddens', 'n_units', 'input_dim']
 
     def __init__(self,n_hiddens,n_units, input_dim=1, 
             drop_prob=.0005, prior=log_normal, lbda=1.):
@@ -459,27 +614,6 @@ class MCdropout_MLP(object):
     def train_func(self,x,y,n,lr=lrdefault,w=1.0):
         return self.train_func_(x,y,lr, n)
 
-    def save(self,save_path,notes=[]):
-        np.save(save_path, [p.get_value() for p in self.params]+notes)
-
-    def load(self,save_path):
-        values = np.load(save_path)
-        notes = values[-1]
-        values = values[:-1]
-
-        if len(self.params) != len(values):
-            raise ValueError("mismatch: got %d values to set %d parameters" %
-                             (len(values), len(self.params)))
-
-        for p, v in zip(self.params, values):
-            if p.get_value().shape != v.shape:
-                raise ValueError("mismatch: parameter has shape %r but value to "
-                                 "set has shape %r" %
-                                 (p.get_value().shape, v.shape))
-            else:
-                p.set_value(v)
-
-        return notes
 
     
 
@@ -488,7 +622,10 @@ class MCdropout_MLP(object):
 
 
 
-class Backprop_MLP(object):
+class Backprop_MLP(CheckpointMIXIN):
+
+    # checked when loading a checkpoint
+    signature_attrs = ['n_hiddens', 'n_units', 'input_dim']
 
     def __init__(self,n_hiddens,n_units, input_dim=1,
                  prior=log_normal, lbda=1.):
@@ -557,27 +694,6 @@ class Backprop_MLP(object):
     def train_func(self,x,y,n,lr=lrdefault,w=1.0):
         return self.train_func_(x,y,lr, n)
 
-    def save(self,save_path,notes=[]):
-        np.save(save_path, [p.get_value() for p in self.params]+notes)
-
-    def load(self,save_path):
-        values = np.load(save_path)
-        notes = values[-1]
-        values = values[:-1]
-
-        if len(self.params) != len(values):
-            raise ValueError("mismatch: got %d values to set %d parameters" %
-                             (len(values), len(self.params)))
-
-        for p, v in zip(self.params, values):
-            if p.get_value().shape != v.shape:
-                raise ValueError("mismatch: parameter has shape %r but value to "
-                                 "set has shape %r" %
-                                 (p.get_value().shape, v.shape))
-            else:
-                p.set_value(v)
-
-        return notes
 
 
 
@@ -7,20 +7,25 @@ Created on Mon Oct 23 20:11:43 2017
 
 
 
+import time
 import numpy as np
 #from cleverhans import attacks_th
 import theano
 import theano.tensor as T
+floatX = theano.config.floatX
 
 from sklearn.metrics import roc_auc_score
-from acquisition_functions import bald, max_ent, var_ratio, mean_std
-score_fs = [bald, max_ent, var_ratio, mean_std]
-eval_scores = lambda sps: [f(sps) for f in score_fs]
+from anomaly_detection import entropy, mc_stats
 
 import scipy
                            
 
 rank = lambda x: scipy.stats.rankdata(x) / len(x)
+
+def norm_entropy(p):
+    """ entropy of the rows renormalized to sum to 1, as scipy.stats.entropy
+    (the BHNs' predictions are clipped) """
+    return entropy(p / p.sum(-1, keepdims=True))
                            
 def fgm_grad(x, prediction, y):
     loss = T.nnet.categorical_crossentropy(prediction,y)    
@@ -56,13 +61,84 @@ def fgm_grad2(x, prediction, y, predict_proba):
     
     return grad_x
 
+
+def mc_vjp_grad(x, prediction, y, predict_proba):
+    """
+    as fgm_grad2, for predictions whose noise can't be fixed (e.g. dropout):
+    dL/d(avg prediction) from n forward passes, then one vector-Jacobian
+    product per sample instead of the rows of the Jacobian
+    """
+    v = T.matrix('v')
+    vjp = theano.function([x,v],T.grad(T.sum(prediction*v),x))
+    
+    def grad_x(x, y, n):
+        pred_avg = sum([predict_proba(x) for _ in range(n)])/float(n)
+        # d categorical_crossentropy(pred_avg,y).mean() / d pred_avg
+        g = np.cast[floatX](- y / pred_avg / len(x))
+        return sum([vjp(x,g) for _ in range(n)])/float(n)
+    
+    return grad_x
+
+
+# clipping of the predictions returned by the predict_proba of the BHNs
+proba_clip = (0.001, 0.999)
+
+
+def _bank_outputs(prediction, weights, W):
+    """ the K predictions (K x n x C) for a bank W of samples of weights """
+    def step(w):
+        w = T.patternbroadcast(w.dimshuffle('x',0),weights.broadcastable)
+        return theano.clone(prediction,replace={weights:w})
+    
+    probs, _ = theano.scan(step,sequences=W)
+    return probs
+
+
+def weight_bank_grad(x, prediction, y, weights):
+    """
+    compiled grad(x,y,W): gradient of the cross-entropy of the prediction 
+    averaged over a bank W (K x P) of samples of the hypernet output 
+    `weights` (1 x P), in one graph (a scan over the K samples)
+    """
+    W = T.matrix('weight_bank')
+    probs = _bank_outputs(prediction,weights,W)
+    loss = T.nnet.categorical_crossentropy(probs.mean(0),y)
+    return theano.function([x,y,W],T.grad(loss.mean(),x))
+
+
+def weight_bank_predict(x, prediction, weights, clip=proba_clip):
+    """
+    compiled predict(x,W): the K predictions (K x n x C) of a bank W, 
+    clipped as predict_proba
+    """
+    W = T.matrix('weight_bank')
+    probs = _bank_outputs(prediction,weights,W)
+    if clip is not None:
+        probs = T.clip(probs,clip[0],clip[1])
+    return theano.function([x,W],probs)
+
+
+def weight_bank_sampler(weights):
+    """ sample_bank(K): K samples (K x P) of the hypernet output `weights` """
+    sample = theano.function([],weights)
+    return lambda K: np.concatenate([sample() for _ in range(K)])
+
     
 def evaluate(X,Y,predict_proba,
              input_var,target_var,prediction,
              eps=[0.001,0.002,0.003,0.004,0.005,0.008,0.01,0.012,0.015,
                   0.02,0.025,0.03,0.04,0.05,0.075,0.1,0.15,0.2,0.3,0.5],
              max_n=100,n_mc=20,n_classes=10,
-             avg = 50):
+             avg = 50,
+             weights = None):
+    """
+    weights: the hypernet output the prediction is computed from (a 1 x P 
+    sample, perdatapoint=False), if any: the attack then averages over a 
+    bank of `avg` weight samples in one graph (weight_bank_grad), and the 
+    n_mc predictions are one call of weight_bank_predict; without it, 
+    over `avg` stochastic passes (mc_vjp_grad) and n_mc calls of 
+    predict_proba
+    """
     
     print 'compiling attacker ...'
     
@@ -74,11 +150,12 @@ def evaluate(X,Y,predict_proba,
     #    signed = np.sign(grads)
     #    return x + ep * signed
     
-    grad = fgm_grad2(input_var,prediction,target_var,predict_proba)
-    def att(x,y,ep):
-        grads = grad(x,y,avg)
-        signed = np.sign(grads)
-        return x + ep * signed
+    if weights is not None:
+        grad_bank = weight_bank_grad(input_var,prediction,target_var,weights)
+        sample_bank = weight_bank_sampler(weights)
+        grad = lambda x, y, n: grad_bank(x,y,sample_bank(n))
+    else:
+        grad = mc_vjp_grad(input_var,prediction,target_var,predict_proba)
     
     
     #att_ = theano.function([input_var,target_var],attack)
@@ -88,35 +165,62 @@ def evaluate(X,Y,predict_proba,
     N = X.shape[0]
     num_batches = np.ceil(N / float(max_n)).astype(int)
     
-    def per_ep(ep):
-        Xa = np.zeros(X.shape,dtype='float32')
-        for j in range(num_batches):
-            x = X[j*max_n:(j+1)*max_n]
-            y = Y[j*max_n:(j+1)*max_n]
-            xa = att(x,y,ep)
-            Xa[j*max_n:(j+1)*max_n] = xa
-        
-        MCt = np.zeros((n_mc,X.shape[0],n_classes),dtype='float32')    
-        for i in range(n_mc):
-            for j in range(num_batches):
-                x = Xa[j*max_n:(j+1)*max_n]
-                MCt[i,j*max_n:(j+1)*max_n] = predict_proba(x)
-        
-        Y_proba = MCt.mean(0)
-        
-        # generalization
-        Y_pred = Y_proba.argmax(-1)
-        Y_true = Y.argmax(-1)
-        corr = np.equal(Y_pred,Y_true)
+    # the sign of the gradient doesn't depend on ep: computed once per 
+    # batch, for all the eps
+    t0 = time.time()
+    signs = np.zeros(X.shape,dtype='float32')
+    for j in range(num_batches):
+        x = X[j*max_n:(j+1)*max_n]
+        y = Y[j*max_n:(j+1)*max_n]
+        signs[j*max_n:(j+1)*max_n] = np.sign(grad(x,y,avg))
+    print 'attack: {:.1f} examples/sec ({} samples)'.format(
+        N / (time.time() - t0), avg)
+    
+    # all the eps (and 0) of a batch are evaluated as one stacked batch,
+    # n_mc times; the MC samples are reduced on the fly to E[p], E[p^2] and
+    # E[H(p)] (anomaly_detection.mc_stats), from which the score functions 
+    # are computed
+    eps_all = np.r_[0., eps].astype('float32')
+    E = len(eps_all)
+    if weights is not None:
+        predict_bank = weight_bank_predict(input_var,prediction,weights)
+        mc_predictions = lambda x: predict_bank(x,sample_bank(n_mc))
+    else:
+        mc_predictions = None
+    
+    Y_proba = np.zeros((E,N,n_classes))
+    Y_sq = np.zeros((E,N,n_classes))
+    Y_ent = np.zeros((E,N))
+    t0 = time.time()
+    for j in range(num_batches):
+        x = X[j*max_n:(j+1)*max_n]
+        s = signs[j*max_n:(j+1)*max_n]
+        n = x.shape[0]
+        xa = x[None] + eps_all.reshape((E,)+(1,)*x.ndim) * s[None]
+        xa = np.cast['float32'](xa.reshape((E*n,)+x.shape[1:]))
+        stats = mc_stats(predict_proba,xa,n_mc,len(xa),
+                         samples_fn=mc_predictions,normalize_ent=True)
+        Y_proba[:,j*max_n:(j+1)*max_n] = stats['mean'].reshape((E,n,-1))
+        Y_sq[:,j*max_n:(j+1)*max_n] = stats['sq_mean'].reshape((E,n,-1))
+        Y_ent[:,j*max_n:(j+1)*max_n] = stats['mean_ent'].reshape((E,n))
+    print 'evaluation: {:.1f} examples/sec ({} eps, {} samples)'.format(
+        N / (time.time() - t0), E, n_mc)
+    
+    # generalization
+    corrs = np.equal(Y_proba.argmax(-1),Y.argmax(-1))
+    # score functions (as in acquisition_functions)
+    Y_entropies = norm_entropy(Y_proba)
+    Y_balds = Y_entropies - Y_ent
+    Y_maxs = 1 - Y_proba.max(-1)
+    Y_mstds = np.maximum(Y_sq - Y_proba**2,0)**.5
+    Y_mstds = Y_mstds.mean(-1)
+    
+    def per_ep(e):
+        """ results of eps_all[e] """
+        corr = corrs[e]
         err = 1-corr
         acc = corr.mean()
-        
-        #score function
-        #Y_entropy = np.sum(Y_proba * np.log(Y_proba),1)
-        #Y_max = Y_proba.max(1)
-        #Y_mstd = MCt.std(0).mean(1)
-        Y_bald, Y_entropy, Y_max, Y_mstd = eval_scores(MCt)
-        return acc, Y_bald, Y_entropy, Y_max, Y_mstd, err
+        return acc, Y_balds[e], Y_entropies[e], Y_maxs[e], Y_mstds[e], err
     
     accs = list()
     ood_blds = list()
@@ -132,7 +236,7 @@ def evaluate(X,Y,predict_proba,
     maxs = list()
     stds = list()
     
-    acc0, Y_bald0, Y_entropy0, Y_max0, Y_mstd0, err0 = per_ep(0.0)
+    acc0, Y_bald0, Y_entropy0, Y_max0, Y_mstd0, err0 = per_ep(0)
     accs.append(acc0)
     blds.append(Y_bald0.mean())
     ents.append(Y_entropy0.mean())
@@ -144,8 +248,8 @@ def evaluate(X,Y,predict_proba,
     erd_maxs.append(roc_auc_score(err0,rank(Y_max0)))
     erd_stds.append(roc_auc_score(err0,rank(Y_mstd0)))
     
-    for ep in eps:
-        acc, Y_bald, Y_entropy, Y_max, Y_mstd, err = per_ep(ep)
+    for e, ep in enumerate(eps):
+        acc, Y_bald, Y_entropy, Y_max, Y_mstd, err = per_ep(e+1)
         accs.append(acc.mean())
         blds.append(Y_bald.mean())
         ents.append(Y_entropy.mean())
@@ -190,9 +294,88 @@ def evaluate(X,Y,predict_proba,
            ood_blds, ood_ents, ood_maxs, ood_stds, \
            erd_blds, erd_ents, erd_maxs, erd_stds
 
+
+def pgd_attack(grad, X, Y, ep, n_steps=10, step_size=None, 
+               random_start=True, clip=None, max_n=100, rng=np.random):
+    """
+    PGD (BIM without random_start) in the l_inf ball of radius ep:
+        x <- proj(x + step_size * sign(grad(x,y)))
+    grad(x,y): gradient of the loss to increase, e.g. over a fixed bank of 
+    weight samples (see evaluate_pgd); step_size defaults to 2.5*ep/n_steps
+    clip: (min, max) of the inputs, if any
+    """
+    if step_size is None:
+        step_size = 2.5 * ep / n_steps
+    N = X.shape[0]
+    Xa = np.zeros(X.shape,dtype='float32')
+    for j in range(0,N,max_n):
+        x0 = X[j:j+max_n]
+        y = Y[j:j+max_n]
+        x = x0
+        if random_start:
+            x = x + rng.uniform(-ep,ep,x0.shape)
+        for t in range(n_steps):
+            x = x + step_size * np.sign(grad(np.cast['float32'](x),y))
+            x = np.clip(x,x0-ep,x0+ep)
+            if clip is not None:
+                x = np.clip(x,clip[0],clip[1])
+        Xa[j:j+max_n] = x
+    return Xa
+
+
+def evaluate_pgd(X,Y,predict_proba,
+                 input_var,target_var,prediction,
+                 eps=[0.01,0.02,0.05,0.1,0.2,0.3],
+                 n_steps=10,step_size=None,n_samples=10,fixed_bank=True,
+                 random_start=True,clip=None,
+                 max_n=100,n_mc=20,n_classes=10,
+                 weights=None):
+    """
+    accuracy (and mean predictive entropy) under PGD attacks of the 
+    MC-averaged predictive, for each ep.
     
+    weights: as in evaluate; the gradient of each step is then one call of 
+    weight_bank_grad with a bank of n_samples weight samples, drawn once 
+    per batch and ep if fixed_bank (a deterministic attack), else at each 
+    step. Without it, n_samples stochastic passes (mc_vjp_grad).
+    """
+    
+    print 'compiling attacker ...'
+    if weights is not None:
+        grad_bank = weight_bank_grad(input_var,prediction,target_var,weights)
+        sample_bank = weight_bank_sampler(weights)
+        predict_bank = weight_bank_predict(input_var,prediction,weights)
+        mc_predictions = lambda x: predict_bank(x,sample_bank(n_mc))
+    else:
+        grad_mc = mc_vjp_grad(input_var,prediction,target_var,predict_proba)
+        mc_predictions = None
+    
+    accs = list()
+    ents = list()
+    for ep in eps:
+        t0 = time.time()
+        if weights is not None and fixed_bank:
+            Xa = np.zeros(X.shape,dtype='float32')
+            for j in range(0,X.shape[0],max_n):
+                W = sample_bank(n_samples)
+                Xa[j:j+max_n] = pgd_attack(
+                    lambda x, y: grad_bank(x,y,W),
+                    X[j:j+max_n],Y[j:j+max_n],ep,n_steps,step_size,
+                    random_start,clip,max_n)
+        elif weights is not None:
+            Xa = pgd_attack(lambda x, y: grad_bank(x,y,sample_bank(n_samples)),
+                            X,Y,ep,n_steps,step_size,random_start,clip,max_n)
+        else:
+            Xa = pgd_attack(lambda x, y: grad_mc(x,y,n_samples),
+                            X,Y,ep,n_steps,step_size,random_start,clip,max_n)
+        t_attack = time.time() - t0
         
-        
-        
-        
-        
+        Y_proba = mc_stats(predict_proba,Xa,n_mc,max_n,
+                           samples_fn=mc_predictions)['mean']
+        accs.append(np.equal(Y_proba.argmax(-1),Y.argmax(-1)).mean())
+        ents.append(norm_entropy(Y_proba).mean())
+        print ep, accs[-1], ents[-1], \
+              '({:.2f} ms/example)'.format(1000 * t_attack / X.shape[0])
+    
+    return accs, ents
+
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Error and out-of-distribution detection from MC predictions, streamed:
+each dataset is read in chunks, and for each chunk the num_samples
+predictive distributions are reduced on the fly to per-example sufficient
+statistics
+    mean        E[p]            (n, C)
+    sq_mean     E[p^2]          (n, C)
+    mean_ent    E[H(p)]         (n,)
+    first       p of one sample (n, C)
+from which every score function is computed, so the (num_samples, n, C)
+tensor of samples is never materialized and each dataset is sampled once.
+
+Scores are larger for examples that look in-distribution (they are the
+negatives of the acquisition functions they are named for, except max_ent,
+kept as in dk_anomaly_detection.py).
+"""
+
+import time
+from collections import OrderedDict
+import numpy as np
+floatX = 'float32'
+
+from encoding import to_labels
+
+
+def entropy(p, axis=-1):
+    """ entropy (nats) of distributions p, with 0 log 0 = 0 """
+    return - (p * np.log(np.maximum(p, np.finfo(p.dtype).tiny))).sum(axis)
+
+
+def mc_stats(probs_fn, X, num_samples=100, chunk_size=1000, dtype=np.float64,
+             samples_fn=None, normalize_ent=False):
+    """
+    sufficient statistics of num_samples MC predictions probs_fn(x) of X,
+    computed chunk_size examples at a time
+    samples_fn: samples_fn(x) gives the num_samples predictions of x at once
+    (e.g. a K x n x C array), instead of num_samples calls of probs_fn
+    normalize_ent: mean_ent is of the rows renormalized to sum to 1 (as 
+    scipy.stats.entropy), e.g. for clipped predictions
+    """
+    if samples_fn is None:
+        samples_fn = lambda x: (probs_fn(x) for _ in range(num_samples))
+    N = len(X)
+    stats = None
+    for s in range(0, N, chunk_size):
+        x = np.asarray(X[s:s+chunk_size], dtype=floatX)
+        for k, p in enumerate(samples_fn(x)):
+            p = np.asarray(p, dtype=dtype)
+            if stats is None:
+                C = p.shape[1]
+                stats = dict(mean=np.zeros((N, C), dtype),
+                             sq_mean=np.zeros((N, C), dtype),
+                             mean_ent=np.zeros(N, dtype),
+                             first=np.zeros((N, C), dtype))
+            if k == 0:
+                stats['first'][s:s+chunk_size] = p
+            stats['mean'][s:s+chunk_size] += p
+            stats['sq_mean'][s:s+chunk_size] += p**2
+            if normalize_ent:
+                p = p / p.sum(-1, keepdims=True)
+            stats['mean_ent'][s:s+chunk_size] += entropy(p)
+    for key in ['mean', 'sq_mean', 'mean_ent']:
+        stats[key] /= num_samples
+    return stats
+
+
+def bald(stats):
+    return - (entropy(stats['mean']) - stats['mean_ent'])
+
+def max_ent(stats):
+    return entropy(stats['mean'])
+
+def mean_std(stats):
+    stds = np.maximum(stats['sq_mean'] - stats['mean']**2, 0)**.5
+    return - stds.mean(-1)
+
+def var_ratio(stats):
+    return stats['mean'].max(-1)
+
+def baseline(stats):
+    """ max softmax probability of a single sample """
+    return stats['first'].max(-1)
+
+# in the order of the rows of the results
+score_fns = OrderedDict([('bald', bald),
+                         ('max_ent', max_ent),
+                         ('mean_std', mean_std),
+                         ('var_ratio', var_ratio),
+                         ('baseline', baseline)])
+
+
+def get_scores(stats, names=None):
+    if names is None:
+        names = score_fns.keys()
+    return OrderedDict((name, score_fns[name](stats)) for name in names)
+
+
+def _cumulative_counts(y_true, y_score):
+    """
+    true and false positives at each distinct threshold, from the highest
+    score down (one sort, ties grouped)
+    """
+    order = np.argsort(-y_score, kind='mergesort')
+    y_true, y_score = y_true[order], y_score[order]
+    last = np.r_[np.where(np.diff(y_score))[0], len(y_score) - 1]
+    tps = np.cumsum(y_true)[last]
+    fps = last + 1 - tps
+    return tps.astype(np.float64), fps.astype(np.float64)
+
+
+def auroc(y_true, y_score):
+    tps, fps = _cumulative_counts(y_true, y_score)
+    tpr = np.r_[0, tps] / tps[-1]
+    fpr = np.r_[0, fps] / fps[-1]
+    return np.trapz(tpr, fpr)
+
+
+def aupr(y_true, y_score):
+    """ average precision, sum_n (R_n - R_{n-1}) P_n """
+    tps, fps = _cumulative_counts(y_true, y_score)
+    precision = tps / (tps + fps)
+    recall = tps / tps[-1]
+    return np.sum(np.diff(np.r_[0, recall]) * precision)
+
+
+def get_results(ins, oos):
+    """
+    AUROC, AUPR (in-distribution positive), AUPR (out-of-distribution
+    positive), in %
+    """
+    y_true = np.r_[np.ones(len(ins)), np.zeros(len(oos))]
+    y_score = np.r_[ins, oos]
+    return [round(auroc(y_true, y_score)*100, 2),
+            round(aupr(y_true, y_score)*100, 2),
+            round(aupr(1 - y_true, -y_score)*100, 2)]
+
+
+def timed_stats(probs_fn, X, name='', verbose=True, **kargs):
+    """ mc_stats, reporting the throughput """
+    t0 = time.time()
+    stats = mc_stats(probs_fn, X, **kargs)
+    dt = time.time() - t0
+    if verbose:
+        print '{}: {} examples in {:.1f}s ({:.1f} examples/sec)'.format(
+            name, len(X), dt, len(X) / dt)
+    return stats
+
+
+def evaluate(probs_fn, X, Y, oods, names=None, verbose=True, **kargs):
+    """
+    error detection (correct vs. misclassified examples of X, with one-hot
+    or int labels Y) and detection of each out-of-distribution set of oods
+    against X, for every score function.
+
+    returns err_results (n_scores, 3), ood_results (n_scores, len(oods), 3)
+    kargs: num_samples, chunk_size, dtype of mc_stats
+    """
+    if names is None:
+        names = score_fns.keys()
+    stats = timed_stats(probs_fn, X, 'in-distribution', verbose, **kargs)
+    scores = get_scores(stats, names)
+
+    is_correct = np.equal(stats['mean'].argmax(-1), to_labels(Y))
+    err_results = np.empty((len(names), 3))
+    for nscore, name in enumerate(names):
+        err_results[nscore] = get_results(scores[name][is_correct],
+                                          scores[name][~is_correct])
+
+    ood_results = np.empty((len(names), len(oods), 3))
+    for nood, ood in enumerate(oods):
+        ood_stats = timed_stats(probs_fn, ood, 'ood {}'.format(nood),
+                                verbose, **kargs)
+        ood_scores = get_scores(ood_stats, names)
+        for nscore, name in enumerate(names):
+            ood_results[nscore, nood] = get_results(scores[name],
+                                                    ood_scores[name])
+    return err_results, ood_results
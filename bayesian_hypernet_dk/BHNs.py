@@ -1098,6 +1098,7 @@ class HyperCNN(Base_BHN):
         coupling layers for WN params
         default to 4 coupling layers
         provide shape to h_net2
+        n_mc samples of the hypernet per call, folded into the batch axis
 
     """
 
@@ -1122,7 +1123,9 @@ class HyperCNN(Base_BHN):
                  init_noise_level=-7,
                  init_scale_h=.0001, # TODO
                  init_scale_p=.01,
-                 init_batch = None):
+                 init_batch = None,
+                 n_mc=1):
+        assert not (perdatapoint and n_mc > 1)
         self.__dict__.update(locals())
         
         self.dataset = dataset
@@ -1210,7 +1213,7 @@ class HyperCNN(Base_BHN):
     def _get_hyper_net(self):
         # inition random noise
         print self.num_params
-        ep = self.srng.normal(size=(self.wd1,
+        ep = self.srng.normal(size=(self.wd1*self.n_mc,
                                     self.num_params),dtype=floatX)
         logdets_layers = []
         h_net = lasagne.layers.InputLayer([None,self.num_params])
@@ -1276,7 +1279,18 @@ class HyperCNN(Base_BHN):
         elif self.dataset == 'cifar10':
             p_net = lasagne.layers.InputLayer([None,3,32,32])
         print p_net.output_shape
-        inputs = {p_net:self.input_var}
+        
+        wd1 = self.wd1
+        weights = self.weights
+        input_var = self.input_var
+        if self.n_mc > 1:
+            # tile the minibatch n_mc times (sample-major), 
+            # the k-th copy using the k-th sample
+            N = self.input_var.shape[0]
+            wd1 = self.n_mc * N
+            weights = T.repeat(self.weights,N,axis=0)
+            input_var = T.tile(self.input_var,(self.n_mc,1,1,1))
+        inputs = {p_net:input_var}
 
         #logpw = np.float32(0.)
         
@@ -1284,8 +1298,12 @@ class HyperCNN(Base_BHN):
 
             num_filters = ws[0]
             
-            # TO-DO: generalize to have multiple samples?
-            weight = self.weights[0,t:t+num_filters].dimshuffle(0,'x','x','x')
+            if wd1 == 1:
+                # one sample: rescale the filters
+                weight = weights[0,t:t+num_filters].dimshuffle(0,'x','x','x')
+            else:
+                # one sample per example: rescale the feature maps
+                weight = weights[:,t:t+num_filters]
 
             num_filters = args[0]
             filter_size = args[1]
@@ -1304,8 +1322,8 @@ class HyperCNN(Base_BHN):
 
             
         for layer in range(self.num_mlp_layers):
-            weight = self.weights[:,t:t+self.num_hids].reshape((self.wd1,
-                                                                self.num_hids))
+            weight = weights[:,t:t+self.num_hids].reshape((wd1,
+                                                           self.num_hids))
             p_net = lasagne.layers.DenseLayer(p_net,self.num_hids,
                                               nonlinearity=rectify)
             p_net = stochastic_weight_norm(p_net,weight)
@@ -1315,7 +1333,7 @@ class HyperCNN(Base_BHN):
             t += self.num_hids
 
 
-        weight = self.weights[:,t:t+self.num_classes].reshape((self.wd1,self.num_classes))
+        weight = weights[:,t:t+self.num_classes].reshape((wd1,self.num_classes))
 
         p_net = lasagne.layers.DenseLayer(p_net,self.num_classes,
                                           nonlinearity=nonlinearities.softmax)
@@ -1324,11 +1342,19 @@ class HyperCNN(Base_BHN):
         y = T.clip(get_output(p_net,inputs), 0.001, 0.999) # stability
         
         self.p_net = p_net
+        self.y_samples = y
+        if self.n_mc > 1:
+            # predictions average the n_mc samples
+            y = y.reshape((self.n_mc,self.input_var.shape[0],-1)).mean(0)
         self.y = y
         
     def _get_useful_funcs(self):
         self.predict_proba = theano.function([self.input_var],self.y)
         self.predict = theano.function([self.input_var],self.y.argmax(1))       
+        # (n_mc, batch_size, num_classes) in one pass
+        self.predict_proba_samples = theano.function(
+            [self.input_var],
+            self.y_samples.reshape((self.n_mc,self.input_var.shape[0],-1)))
     
     # DK - adding this so I can add the hacky l2 penalty that Riashat used
     def _get_elbo(self):
@@ -1349,7 +1375,8 @@ class HyperCNN(Base_BHN):
         of the variance
         """
         self.kl = (self.logqw - self.logpw).mean()
-        self.logpyx = - cc(self.y,self.target_var).mean()
+        target_var = T.tile(self.target_var,(self.n_mc,1))
+        self.logpyx = - cc(self.y_samples,target_var).mean()
         self.loss = - (self.logpyx - self.kl/T.cast(self.dataset_size,floatX))
         if self.extra_l2:
             self.loss += self.l2_penalty
@@ -535,6 +535,10 @@ class WeightNormLayer(lasagne.layers.Layer):
             self.g = g
         elif g is not None:
             self.g = self.add_param(g, (k,), name="g")
+        # a (batch_size, k) g holds one scale per example (e.g. one weight 
+        # sample per example): rescale the outputs instead of the weights
+        self.per_example = type(g) == tv and g.ndim == 2 and \
+                           not g.broadcastable[0]
         if len(self.input_shape)==4:
             self.axes_to_sum = (0,2,3)
             self.dimshuffle_args = ['x',0,'x','x']
@@ -551,12 +555,17 @@ class WeightNormLayer(lasagne.layers.Layer):
         else:
             W_axes_to_sum = 0
             W_dimshuffle_args = ['x',0]
-        if g is not None:
+        if g is not None and not self.per_example:
             incoming.W = self.g * incoming.W_param / T.sqrt(T.sum(T.square(incoming.W_param),axis=W_axes_to_sum)).dimshuffle(*W_dimshuffle_args)
         else:
             incoming.W = incoming.W_param / T.sqrt(T.sum(T.square(incoming.W_param),axis=W_axes_to_sum,keepdims=True))        
 
     def get_output_for(self, input, init=False, **kwargs):
+        if self.per_example:
+            if input.ndim == 4:
+                input = input * self.g.dimshuffle(0,1,'x','x')
+            else:
+                input = input * self.g
         if init:
             m = T.mean(input, self.axes_to_sum)
             input -= m.dimshuffle(*self.dimshuffle_args)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ELBO vs wall-clock time of MLPWeightNorm_BHN trained on MNIST with
+n_elbo_samples=K: each step runs the flow once on K noise vectors and the
+primary net once on the minibatch tiled K times.
+
+Every `eval_every` seconds of training we record the negative ELBO on the
+validation set (averaged over `n_eval` draws); the curves are saved as
+    {save_dir}/elbo_samples_K{K}{estimator}.npy    -- rows of (time, -elbo)
+
+    python benchmark_elbo_samples.py --K 1 2 4 8 --budget 300
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+
+import theano
+from theano.tensor.shared_randomstreams import RandomStreams
+floatX = theano.config.floatX
+
+from BHNs import MLPWeightNorm_BHN
+from ops import load_mnist
+
+
+def valid_elbo(loss_func, X, Y, bs=1000, n_eval=5):
+    N = X.shape[0]
+    losses = []
+    for i in range(n_eval):
+        for j in range(0,N,bs):
+            n = X[j:j+bs].shape[0]
+            losses.append(n * loss_func(X[j:j+bs],Y[j:j+bs],N,1.))
+    return np.sum(losses) / float(N*n_eval)
+
+
+def benchmark(K, train_x, train_y, valid_x, valid_y, budget=300,
+              eval_every=10, bs=100, lr=0.001, n_eval=5, **kargs):
+    model = MLPWeightNorm_BHN(srng=RandomStreams(seed=427),
+                              n_elbo_samples=K,
+                              **kargs)
+    loss_func = theano.function([model.input_var,
+                                 model.target_var,
+                                 model.dataset_size,
+                                 model.weight],
+                                model.loss,
+                                allow_input_downcast=True)
+
+    N = train_x.shape[0]
+    curve = [(0., valid_elbo(loss_func,valid_x,valid_y,n_eval=n_eval))]
+    train_time = 0.
+    next_eval = eval_every
+    while train_time < budget:
+        perm = np.random.permutation(N)
+        for j in range(0,N,bs):
+            inds = perm[j:j+bs]
+            t0 = time.time()
+            model.train_func(train_x[inds],train_y[inds],N,lr)
+            train_time += time.time() - t0
+            if train_time >= next_eval:
+                curve.append((train_time,
+                              valid_elbo(loss_func,valid_x,valid_y,
+                                         n_eval=n_eval)))
+                print('K={} {:.1f}s -elbo {:.4f}'.format(K,*curve[-1]))
+                next_eval += eval_every
+            if train_time >= budget:
+                break
+
+    return np.array(curve)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K',default=[1,2,4,8],type=int,nargs='+')
+    parser.add_argument('--elbo_estimator',default='mean',type=str,
+                        choices=['mean','iwae'])
+    parser.add_argument('--budget',default=300.,type=float)
+    parser.add_argument('--eval_every',default=10.,type=float)
+    parser.add_argument('--n_eval',default=5,type=int)
+    parser.add_argument('--bs',default=100,type=int)
+    parser.add_argument('--lr',default=0.001,type=float)
+    parser.add_argument('--coupling',default=4,type=int)
+    parser.add_argument('--n_hiddens',default=1,type=int)
+    parser.add_argument('--n_units',default=200,type=int)
+    parser.add_argument('--mnist',default='./data/mnist.pkl.gz',type=str)
+    parser.add_argument('--save_dir',default='./results',type=str)
+    args = parser.parse_args()
+    print(args)
+
+    if not os.path.exists(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    train_x, train_y, valid_x, valid_y, test_x, test_y = \
+        load_mnist(args.mnist)
+
+    for K in args.K:
+        np.random.seed(427)
+        curve = benchmark(K, train_x, train_y, valid_x, valid_y,
+                          budget=args.budget,
+                          eval_every=args.eval_every,
+                          bs=args.bs,
+                          lr=args.lr,
+                          n_eval=args.n_eval,
+                          coupling=args.coupling,
+                          n_hiddens=args.n_hiddens,
+                          n_units=args.n_units,
+                          elbo_estimator=args.elbo_estimator)
+        np.save('{}/elbo_samples_K{}{}'.format(args.save_dir,K,
+                                               args.elbo_estimator),curve)
+        print('K={} final -elbo {:.4f} after {} evals'.format(
+            K,curve[-1,1],len(curve)-1))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the hypernet flows for a growing number of primary net params:
+    RealNVP  - CoupledDenseLayer
+    IAF      - IAFDenseLayer
+    ConvNVP  - CoupledConv1DLayer
+
+For each (flow, num_params) we report the number of hypernet parameters,
+the memory taken by the parameters and the adam moment estimates, the
+compilation time and the time of one training step of q(w) towards the
+N(0,1/lbda) prior.
+
+    python benchmark_flows.py --num_params 1000 10000 100000
+"""
+
+import time
+import argparse
+import numpy as np
+
+import theano
+import theano.tensor as T
+import lasagne
+from lasagne.layers import get_output
+from theano.tensor.shared_randomstreams import RandomStreams
+floatX = theano.config.floatX
+
+from modules import LinearFlowLayer, IndexLayer, PermuteLayer, \
+                    CoupledDenseLayer, IAFDenseLayer, NVP_conv_layer
+from utils import log_normal
+
+
+def build_flow(flow, num_params, coupling=4, n_units_h=200,
+               conv_units=16, conv_filter_size=5):
+    """ same hypernet as in BHNs.MLPWeightNorm_BHN._get_hyper_net """
+    logdets_layers = []
+    h_net = lasagne.layers.InputLayer([None,num_params])
+
+    layer_temp = LinearFlowLayer(h_net)
+    h_net = IndexLayer(layer_temp,0)
+    logdets_layers.append(IndexLayer(layer_temp,1))
+
+    if flow == 'RealNVP':
+        layer_temp = CoupledDenseLayer(h_net,n_units_h)
+        h_net = IndexLayer(layer_temp,0)
+        logdets_layers.append(IndexLayer(layer_temp,1))
+        for c in range(coupling-1):
+            h_net = PermuteLayer(h_net,num_params)
+            layer_temp = CoupledDenseLayer(h_net,n_units_h)
+            h_net = IndexLayer(layer_temp,0)
+            logdets_layers.append(IndexLayer(layer_temp,1))
+    elif flow == 'ConvNVP':
+        h_net, ld_layers = NVP_conv_layer(h_net,conv_units,coupling,
+                                          conv_filter_size)
+        logdets_layers += ld_layers
+    elif flow == 'IAF':
+        layer_temp = IAFDenseLayer(h_net,n_units_h,1,L=coupling,
+                                   cond_bias=False)
+        h_net = IndexLayer(layer_temp,0)
+        logdets_layers.append(IndexLayer(layer_temp,1))
+    else:
+        raise Exception('no flow named `{}`'.format(flow))
+
+    return h_net, logdets_layers
+
+
+def benchmark(flow, num_params, n_samples=1, n_steps=20, lbda=1.,
+              srng=RandomStreams(seed=427), **kargs):
+    t0 = time.time()
+    h_net, logdets_layers = build_flow(flow, num_params, **kargs)
+
+    ep = srng.normal(size=(n_samples,num_params),dtype=floatX)
+    weights = get_output(h_net,ep)
+    logdets = sum([get_output(ld,ep) for ld in logdets_layers])
+    logpw = log_normal(weights,0.,-T.log(lbda)).sum(1)
+    loss = (- logdets - logpw).mean()
+
+    params = lasagne.layers.get_all_params(h_net,trainable=True)
+    updates = lasagne.updates.adam(loss,params,0.001)
+    step = theano.function([],loss,updates=updates)
+    compile_time = time.time() - t0
+
+    step() # warm up
+    t0 = time.time()
+    for i in range(n_steps):
+        step()
+    step_time = (time.time() - t0) / n_steps
+
+    values = [p.get_value() for p in params]
+    num_hparams = sum([v.size for v in values])
+    # params + adam's first and second moment estimates
+    memory = 3 * sum([v.nbytes for v in values]) / 2.**20
+
+    return num_hparams, memory, compile_time, step_time
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_params',default=[1000,10000,100000],
+                        type=int,nargs='+')
+    parser.add_argument('--flows',default=['RealNVP','IAF','ConvNVP'],
+                        type=str,nargs='+')
+    parser.add_argument('--coupling',default=4,type=int)
+    parser.add_argument('--n_units_h',default=200,type=int)
+    parser.add_argument('--conv_units',default=16,type=int)
+    parser.add_argument('--conv_filter_size',default=5,type=int)
+    parser.add_argument('--n_samples',default=1,type=int)
+    parser.add_argument('--n_steps',default=20,type=int)
+    args = parser.parse_args()
+    print(args)
+
+    row = '{:>8} {:>10} {:>12} {:>12} {:>12} {:>12}'
+    print(row.format('flow','num_params','hnet params','memory (MB)',
+                     'compile (s)','step (ms)'))
+    for num_params in args.num_params:
+        for flow in args.flows:
+            result = benchmark(flow, num_params,
+                               n_samples=args.n_samples,
+                               n_steps=args.n_steps,
+                               coupling=args.coupling,
+                               n_units_h=args.n_units_h,
+                               conv_units=args.conv_units,
+                               conv_filter_size=args.conv_filter_size)
+            num_hparams, memory, compile_time, step_time = result
+            print(row.format(flow, num_params, num_hparams,
+                             np.round(memory,2), np.round(compile_time,2),
+                             np.round(1000*step_time,2)))
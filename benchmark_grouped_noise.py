@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the grouped perdatapoint mode (n_groups=G): the hypernet draws
+G weight samples per minibatch and example i uses sample i % G.
+    G = 1           - one sample shared by the minibatch
+    G = batch_size  - one sample per example (perdatapoint=True)
+
+For each (model, G) we report the time of one training step and, on a fixed
+minibatch, the std of the loss and the mean per-coordinate variance of its
+gradient across draws of the noise.
+
+    python benchmark_grouped_noise.py --groups 1 4 16 64 128
+"""
+
+import time
+import argparse
+import numpy as np
+
+import theano
+import theano.tensor as T
+floatX = theano.config.floatX
+
+from BHNs import MLPWeightNorm_BHN, MNF_MLP_BHN
+from helpers import flatten_list
+
+
+def benchmark(model_type, n_groups, X, Y, n_steps=20, n_draws=50, **kargs):
+    if model_type == 'BHN_MLPWN':
+        model = MLPWeightNorm_BHN(perdatapoint=True,
+                                  n_groups=n_groups,
+                                  **kargs)
+    elif model_type == 'BHN_MNF':
+        model = MNF_MLP_BHN(perdatapoint=True,
+                            n_groups=n_groups,
+                            **kargs)
+    else:
+        raise Exception('no model named `{}`'.format(model_type))
+
+    grads = flatten_list(T.grad(model.loss,model.params))
+    loss_grads = theano.function([model.input_var,
+                                  model.target_var,
+                                  model.dataset_size,
+                                  model.weight],
+                                 [model.loss,grads],
+                                 allow_input_downcast=True)
+
+    N = X.shape[0]
+    losses, gs = [], []
+    for i in range(n_draws):
+        l, g = loss_grads(X,Y,N,1.)
+        losses.append(l)
+        gs.append(g)
+    loss_std = np.std(losses)
+    grad_var = np.var(np.asarray(gs),0).mean()
+
+    model.train_func(X,Y,N,0.) # warm up
+    t0 = time.time()
+    for i in range(n_steps):
+        model.train_func(X,Y,N,0.)
+    step_time = (time.time() - t0) / n_steps
+
+    return step_time, loss_std, grad_var
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models',default=['BHN_MLPWN','BHN_MNF'],
+                        type=str,nargs='+')
+    parser.add_argument('--groups',default=[1,4,16,64,128],
+                        type=int,nargs='+')
+    parser.add_argument('--batch_size',default=128,type=int)
+    parser.add_argument('--coupling',default=4,type=int)
+    parser.add_argument('--n_hiddens',default=1,type=int)
+    parser.add_argument('--n_units',default=200,type=int)
+    parser.add_argument('--n_steps',default=20,type=int)
+    parser.add_argument('--n_draws',default=50,type=int)
+    args = parser.parse_args()
+    print(args)
+
+    # fixed random MNIST-shaped minibatch
+    rng = np.random.RandomState(427)
+    X = rng.rand(args.batch_size,784).astype(floatX)
+    Y = np.eye(10)[rng.randint(0,10,args.batch_size)].astype(floatX)
+
+    row = '{:>10} {:>6} {:>12} {:>12} {:>12}'
+    print(row.format('model','G','step (ms)','loss std','grad var'))
+    for model_type in args.models:
+        for n_groups in args.groups:
+            result = benchmark(model_type, n_groups, X, Y,
+                               n_steps=args.n_steps,
+                               n_draws=args.n_draws,
+                               coupling=args.coupling,
+                               n_hiddens=args.n_hiddens,
+                               n_units=args.n_units)
+            step_time, loss_std, grad_var = result
+            print(row.format(model_type, n_groups,
+                             np.round(1000*step_time,2),
+                             '{:.4g}'.format(loss_std),
+                             '{:.4g}'.format(grad_var)))
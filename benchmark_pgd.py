@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cost of the PGD attack of FGS_eval.evaluate_pgd per example and per step,
+against the number of hypernet samples averaged at each step, for
+MLPWeightNorm_BHN on random MNIST-shaped data:
+    bank  - one call of weight_bank_grad on a fixed bank of K weight samples
+    mc    - K stochastic passes of mc_vjp_grad (one forward and one
+            vector-Jacobian product per sample)
+
+    python benchmark_pgd.py --K 1 5 10 20 50 --n_steps 10
+"""
+
+import time
+import argparse
+import numpy as np
+
+import theano
+from theano.tensor.shared_randomstreams import RandomStreams
+floatX = theano.config.floatX
+
+from BHNs import MLPWeightNorm_BHN
+from FGS_eval import pgd_attack, weight_bank_grad, weight_bank_sampler, \
+                     mc_vjp_grad
+
+
+def attack_time(grad, X, Y, n_steps, ep=0.1):
+    """ seconds per example and per step """
+    t0 = time.time()
+    pgd_attack(grad, X, Y, ep, n_steps=n_steps, clip=(0.,1.))
+    return (time.time() - t0) / (X.shape[0] * n_steps)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K',default=[1,5,10,20,50],type=int,nargs='+')
+    parser.add_argument('--n',default=500,type=int)
+    parser.add_argument('--n_steps',default=10,type=int)
+    parser.add_argument('--n_hiddens',default=2,type=int)
+    parser.add_argument('--n_units',default=800,type=int)
+    parser.add_argument('--coupling',default=4,type=int)
+    args = parser.parse_args()
+    print(args)
+
+    rng = np.random.RandomState(427)
+    X = rng.rand(args.n, 784).astype(floatX)
+    Y = np.eye(10, dtype=floatX)[rng.randint(0, 10, args.n)]
+
+    model = MLPWeightNorm_BHN(srng=RandomStreams(seed=427),
+                              coupling=args.coupling,
+                              n_hiddens=args.n_hiddens,
+                              n_units=args.n_units)
+    grad_bank = weight_bank_grad(model.input_var, model.y_unclipped,
+                                 model.target_var, model.weights)
+    sample_bank = weight_bank_sampler(model.weights)
+    grad_mc = mc_vjp_grad(model.input_var, model.y_unclipped,
+                          model.target_var, model.predict_proba)
+
+    row = '{:>4} {:>16} {:>16} {:>8}'
+    print(row.format('K', 'bank (ms/ex)', 'mc (ms/ex)', 'speedup'))
+    for K in args.K:
+        W = sample_bank(K)
+        grad_bank(X[:10], Y[:10], W) # warm up
+        bank = attack_time(lambda x, y: grad_bank(x, y, W), X, Y,
+                           args.n_steps)
+        mc = attack_time(lambda x, y: grad_mc(x, y, K), X, Y, args.n_steps)
+        print(row.format(K, np.round(1000*bank,4), np.round(1000*mc,4),
+                         np.round(mc/bank,2)))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+How much of the minibatch preparation (shuffled gather, augmentation, float32
+cast) is hidden by prefetch.Prefetcher, for HyperWN_CNN on MNIST and on
+CIFAR-5 (the configurations of experiment_lenet5_cifar5.py), on random data
+of the right shapes. For each we report the time per step of
+    prep        - preparing the minibatches alone
+    sync        - preparing then training, in turn
+    prefetched  - training with the minibatches prepared by the worker thread
+and the fraction of prep hidden: (sync - prefetched) / prep.
+
+    python benchmark_prefetch.py --datasets mnist cifar5 --n_steps 200
+"""
+
+import time
+import argparse
+import numpy as np
+
+import theano
+floatX = theano.config.floatX
+
+from BHNs import HyperWN_CNN
+from prefetch import minibatches, Prefetcher
+
+
+configs = dict(
+    mnist=dict(input_channels=1, input_shape=(1,28,28), n_classes=10,
+               n_convlayers=2, n_channels=[20,50], kernel_size=5,
+               n_mlplayers=1, n_units=500, pool_per=1),
+    cifar5=dict(input_channels=3, input_shape=(3,32,32), n_classes=5,
+                n_convlayers=2, n_channels=192, kernel_size=5,
+                n_mlplayers=1, n_units=1000, pool_per=1))
+
+
+def flip_crop(pad=4, rng=np.random):
+    """ random horizontal flips and translations (zero padded) """
+    def augment(x, y):
+        n, c, h, w = x.shape
+        flips = rng.rand(n) < .5
+        x = np.where(flips[:,None,None,None], x[:,:,:,::-1], x)
+        padded = np.zeros((n, c, h+2*pad, w+2*pad), dtype=x.dtype)
+        padded[:,:,pad:pad+h,pad:pad+w] = x
+        dh, dw = rng.randint(0, 2*pad+1, 2)
+        return padded[:,:,dh:dh+h,dw:dw+w], y
+    return augment
+
+
+def run(model, batches, n_steps, train=True):
+    t0 = time.time()
+    for i, (x, y) in enumerate(batches):
+        if i == n_steps:
+            break
+        if train:
+            model.train_func(x, y, n_steps, 0.)
+    return (time.time() - t0) / n_steps
+
+
+def benchmark(dataset, X, Y, bs=100, n_steps=200, max_queue=8, augment=True):
+    model = HyperWN_CNN(**configs[dataset])
+    augment = flip_crop() if augment else None
+    def get_batches():
+        # as many epochs as needed
+        while True:
+            for batch in minibatches(X, Y, bs, shuffle=True, dtype=floatX,
+                                     augment=augment):
+                yield batch
+    run(model, get_batches(), 10) # warm up
+    prep = run(model, get_batches(), n_steps, train=False)
+    sync = run(model, get_batches(), n_steps)
+    batches = Prefetcher(get_batches(), max_queue=max_queue)
+    prefetched = run(model, batches, n_steps)
+    batches.close()
+    return prep, sync, prefetched
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets',default=['mnist','cifar5'],
+                        type=str,nargs='+',choices=['mnist','cifar5'])
+    parser.add_argument('--bs',default=100,type=int)
+    parser.add_argument('--n_steps',default=200,type=int)
+    parser.add_argument('--max_queue',default=8,type=int)
+    parser.add_argument('--augment',default=1,type=int)
+    args = parser.parse_args()
+    print(args)
+
+    rng = np.random.RandomState(427)
+    row = '{:>8} {:>10} {:>10} {:>16} {:>8}'
+    print(row.format('dataset','prep (ms)','sync (ms)','prefetched (ms)','hidden'))
+    for dataset in args.datasets:
+        shape = configs[dataset]['input_shape']
+        n_classes = configs[dataset]['n_classes']
+        # float64 data, so that the cast to floatX is part of the prep
+        N = 20 * args.bs
+        X = rng.rand(N, *shape)
+        Y = np.eye(n_classes)[rng.randint(0, n_classes, N)]
+        prep, sync, prefetched = benchmark(dataset, X, Y, bs=args.bs,
+                                           n_steps=args.n_steps,
+                                           max_queue=args.max_queue,
+                                           augment=args.augment)
+        hidden = np.clip((sync - prefetched) / prep, 0., 1.)
+        print(row.format(dataset, np.round(1000*prep,2), np.round(1000*sync,2),
+                         np.round(1000*prefetched,2), np.round(hidden,2)))
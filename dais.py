@@ -30,6 +30,7 @@ from lasagne.layers import get_output
 from BHNs import MLPWeightNorm_BHN
 from ops import load_mnist
 from utils import log_normal, log_laplace, log_sum_exp
+from prefetch import iterate_minibatches
 import numpy as np
 
 import theano
@@ -205,7 +206,7 @@ class MLPWeightNorm_BHN_dais(MLPWeightNorm_BHN):
 
 def train_model(train_func,predict_func,X,Y,Xt,Yt,
                 lr0=0.1,lrdecay=1,bs=20,epochs=50,anneal=0,name='0',
-                e0=0,rec=0):
+                e0=0,rec=0,prefetch=0):
     
     print 'trainset X.shape:{}, Y.shape:{}'.format(X.shape,Y.shape)
     N = X.shape[0]    
@@ -229,9 +230,7 @@ def train_model(train_func,predict_func,X,Y,Xt,Yt,
         else:
             w = 1.0         
             
-        for i in range(N/bs):
-            x = X[i*bs:(i+1)*bs]
-            y = Y[i*bs:(i+1)*bs]
+        for x, y in iterate_minibatches(X,Y,bs,prefetch):
             
             loss = train_func(x,y,N,lr,w)
             
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache of the image datasets: each source (mnist.pkl.gz, the cifar10
+pickle, the cifar-10-batches-py directory) is converted once into
+    {cache_dir}/{name}/{split}_x.npy    uint8 images (the original dtype if
+                                        the pixels are not k/scale)
+    {cache_dir}/{name}/{split}_y.npy    int32 labels
+    {cache_dir}/{name}/meta.json        scale of the pixels
+which are then memory-mapped. The loaders of ops.py and helpers.py use the
+cache when they are given a cache_dir, or when $DATA_CACHE is set, so every
+script gets it without changes.
+
+ImageView and OneHotView give the float32 images and one-hot labels of
+the cached arrays lazily, minibatch per minibatch.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+floatX = 'float32'
+
+from encoding import onehot
+
+
+def get_cache_dir(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get('DATA_CACHE')
+    return cache_dir
+
+
+def to_uint8(x):
+    """
+    (u, scale) with u uint8 and x == u.astype(x.dtype) / scale exactly,
+    or (x, None) if there is no such scale
+    """
+    x = np.asarray(x)
+    for scale in [1., 255., 256.]:
+        q = np.rint(x * scale)
+        if q.min() < 0 or q.max() > 255:
+            continue
+        u = q.astype('uint8')
+        if np.array_equal(decode(u, scale, x.dtype), x):
+            return u, scale
+    return x, None
+
+
+def decode(u, scale, dtype=floatX):
+    x = np.asarray(u, dtype=dtype)
+    if scale is not None and scale != 1:
+        x /= np.cast[dtype](scale)
+    return x
+
+
+def save_cache(name, splits, cache_dir):
+    """
+    splits: {split: (x, labels)}; written to a temporary directory of this
+    process first, so that an interrupted conversion leaves no partial cache
+    and concurrent jobs building the same cache do not clash (the first
+    rename wins, the others discard their copy)
+    """
+    path = os.path.join(cache_dir, name)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    tmp_path = tempfile.mkdtemp(prefix=name + '.', suffix='.tmp',
+                                dir=cache_dir)
+    try:
+        # mkdtemp is private to the user
+        os.chmod(tmp_path, 0o755)
+        meta = dict(scales={}, dtypes={})
+        for split, (x, y) in splits.items():
+            u, scale = to_uint8(x)
+            np.save(os.path.join(tmp_path, split + '_x.npy'), u)
+            np.save(os.path.join(tmp_path, split + '_y.npy'),
+                    np.asarray(y).reshape(-1).astype('int32'))
+            meta['scales'][split] = scale
+            meta['dtypes'][split] = str(np.asarray(x).dtype)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another job finished the same cache first
+            if not os.path.isfile(os.path.join(path, 'meta.json')):
+                raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+
+
+def load_cache(name, cache_dir, mmap_mode='r'):
+    """ {split: (ImageView, labels)}, memory-mapped """
+    path = os.path.join(cache_dir, name)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    splits = dict()
+    for split, scale in meta['scales'].items():
+        x = np.load(os.path.join(path, split + '_x.npy'), mmap_mode=mmap_mode)
+        y = np.load(os.path.join(path, split + '_y.npy'), mmap_mode=mmap_mode)
+        # decoded to the original dtype, or to floatX for integer images
+        dtype = meta['dtypes'][split]
+        if not np.issubdtype(np.dtype(dtype), np.floating):
+            dtype = floatX
+        splits[split] = (ImageView(x, scale, dtype), y)
+    return splits
+
+
+def cached(name, build, cache_dir):
+    """ load_cache(name), after converting build() on first use """
+    if not os.path.isfile(os.path.join(cache_dir, name, 'meta.json')):
+        print 'caching {} in {}'.format(name, cache_dir)
+        save_cache(name, build(), cache_dir)
+    return load_cache(name, cache_dir)
+
+
+def as_uint8(x):
+    """
+    (u, scale): uint8 images u with x == u / scale, from an ImageView of 
+    the cache or from an array of float images
+    """
+    if isinstance(x, ImageView):
+        u, scale = np.asarray(x.data).reshape(x.shape), x.scale
+    else:
+        u, scale = to_uint8(x)
+    if u.dtype != np.uint8:
+        raise ValueError('the images are not k/scale for a scale in '
+                         '[1, 255, 256]')
+    return u, (1. if scale is None else scale)
+
+
+class ImageView(object):
+    """
+    decoded (float) view of an array of uint8 images, e.g. memory-mapped:
+    only the items indexed are read and decoded.
+        view[i*bs:(i+1)*bs]  ->  float array of the minibatch
+        view.data            ->  the raw array
+    """
+
+    def __init__(self, data, scale=None, dtype=floatX, item_shape=None):
+        self.data = data
+        self.scale = scale
+        self.dtype = dtype
+        if item_shape is None:
+            item_shape = data.shape[1:]
+        self.item_shape = tuple(item_shape)
+
+    @property
+    def shape(self):
+        return (len(self.data),) + self.item_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        x = decode(self.data[idx], self.scale, self.dtype)
+        if isinstance(idx, (int, np.integer)):
+            return x.reshape(self.item_shape)
+        return x.reshape((-1,) + self.item_shape)
+
+    def reshape(self, *shape):
+        """ reshapes the items (the first axis is kept) """
+        if len(shape) == 1 and isinstance(shape[0], tuple):
+            shape = shape[0]
+        assert shape[0] in [-1, len(self)]
+        return ImageView(self.data, self.scale, self.dtype, shape[1:])
+
+    def take(self, inds):
+        """ view of the items inds (read into memory, still undecoded) """
+        return ImageView(self.data[inds], self.scale, self.dtype,
+                         self.item_shape)
+
+
+class OneHotView(object):
+    """
+    one-hot view of an array of int labels, built per minibatch
+    """
+
+    def __init__(self, labels, n_classes, dtype=floatX):
+        self.labels = labels
+        self.n_classes = n_classes
+        self.dtype = dtype
+
+    @property
+    def shape(self):
+        return (len(self.labels), self.n_classes)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        y = onehot(self.labels[idx], self.n_classes, self.dtype)
+        if isinstance(idx, (int, np.integer)):
+            return y[0]
+        return y
+
+    def argmax(self, axis):
+        assert axis in [1, -1]
+        return np.asarray(self.labels)
+
+    def take(self, inds):
+        return OneHotView(self.labels[inds], self.n_classes, self.dtype)
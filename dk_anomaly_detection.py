@@ -79,6 +79,10 @@ if 1:#def main():
 
     parser.add_argument('--ooc', type=int, default=1)
     parser.add_argument('--exclude', type=int, default=3)
+    parser.add_argument('--ad_num_samples', type=int, default=100,
+                        help="MC samples for the anomaly detection scores")
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help="examples sampled at a time (anomaly detection)")
 
 
 
@@ -378,53 +382,10 @@ if anomaly:
     ##################################################
     # from https://github.com/hendrycks/error-detection/blob/master/Vision/MNIST_Abnormality_Module.ipynb
     print "load notMNIST, CIFAR-10, and Omniglot"
-    try:
-        if ooc:
-            pass
-        else:
-            notmnist_dataset = np.load('./data/not_mnist.npy')
-            cifar_batch = np.load('./data/CIFAR10-bw.npy')
-            omni_images = np.load('./data/omniglot.npy')
-            print "loaded saved npy files"
-    except:
-        import pickle
-        pickle_file = './data/notMNIST.pickle'
-        with open(pickle_file, 'rb') as f:
-            #save = pickle.load(f, encoding='latin1')
-            save = pickle.load(f)
-            notmnist_dataset = save['test_dataset'].reshape((-1, 28 * 28))
-            del save
-
-        np.save('./data/not_mnist.npy', notmnist_dataset)
-
-        from helpers import load_data10
-        _, _, X_test, _ = load_data10()
-        import tensorflow as tf
-        try:
-            sess = tf.Session()
-            with sess.as_default():
-                cifar_batch = sess.run(tf.image.resize_images(tf.image.rgb_to_grayscale(X_test), (28, 28))).reshape((-1, 784))
-        except:
-            pass
-
-        np.save('./data/CIFAR10-bw.npy', cifar_batch)
-
-        import scipy.io as sio
-        import scipy.misc as scimisc
-        # other alphabets have characters which overlap
-        safe_list = [0,2,5,6,8,12,13,14,15,16,17,18,19,21,26]
-        m = sio.loadmat("./data/data_background.mat")
-
-        squished_set = []
-        for safe_number in safe_list:
-            for alphabet in m['images'][safe_number]:
-                for letters in alphabet:
-                    for letter in letters:
-                        for example in letter:
-                            squished_set.append(scimisc.imresize(1 - example[0], (28,28)).reshape(1, 28*28))
-
-        omni_images = np.concatenate(squished_set, axis=0)
-        np.save('./data/omniglot.npy', omni_images)
+    if not ooc:
+        # converted on first use, see prepare_ood_data.py
+        from prepare_ood_data import load_ood_data
+        notmnist_dataset, cifar_batch, omni_images = load_ood_data('./data')
 
     print "done loading notMNIST, CIFAR-10, and Omniglot"
     ################################################################
@@ -438,61 +399,8 @@ if anomaly:
     # TODO: get_results CONFIDENCE
 
     #####################
-    from sklearn.metrics import roc_auc_score as roc
-    from sklearn.metrics import average_precision_score as pr
-    def get_results(ins, oos): #in/out of sample
-        """
-        returns AOROC, AOPR (success), AOPR (failure) 
-        """
-        rval = []
-        y_true = np.hstack((np.ones(len(ins)), np.zeros(len(oos))))
-        y_score = np.hstack((ins, oos))
-        rval += [round(roc(y_true, y_score)*100, 2),
-                round(pr(y_true, y_score)*100, 2)]
-        y_true = np.hstack((np.zeros(len(ins)), np.ones(len(oos))))
-        y_score = -y_score
-        rval += [#round(roc(y_true, y_score)*100, 2),
-                round(pr(y_true, y_score)*100, 2)]
-        return rval
-
-
-    #######################
-    # IDEAS FOR y_score:
-    """
-    baseline
-    entropy of estimated Dirichlet?
-    avg entropy of predictive distribution
-    avg entropy of predictions (along each axis)
-    entropy of flattened array
-    standard deviation (something something...)
-    """
-
-    score_fns = []
-
-    # These score functions are NEGATIVEs of the acquisition functions they are named for
-    # SAMPLES: nsamples, nexamples, nclasses
-    # returns scores: nexamples
-    # they are listed in alphabetic order
-    import scipy.stats
-    def bald(samples):
-        return - (scipy.stats.entropy(samples.mean(0).T) - scipy.stats.entropy(samples.transpose(2,0,1)).mean(0))
-    score_fns.append(bald)
-    def max_ent(samples):
-        return scipy.stats.entropy(samples.mean(0).T)
-    score_fns.append(max_ent)
-    if 0: 
-        def min_margin(samples): # TODO
-            return scipy.stats.entropy(samples.mean(0).T)
-        score_fns.append(min_margin)
-    def mean_std(samples):
-        stds = np.maximum(((samples**2).mean(0) - samples.mean(0)**2),0)**.5
-        return - stds.mean(-1)
-    score_fns.append(mean_std)
-    def var_ratio(samples):
-        return samples.mean(0).max(-1)
-    score_fns.append(var_ratio)
-
-
+    # score functions, AUROC/AUPR: see anomaly_detection.py
+    import anomaly_detection
 
 
     #######################
@@ -502,14 +410,6 @@ if anomaly:
     probs = theano.function([input_var],y)
 
 
-    #######################
-    # predictions on clean data
-
-    from utils import MCpred
-    clean_samples = MCpred(X=Xt, predict_probs_fn=probs, num_samples=100, returns='samples',num_classes=classes)
-    clean_probs = clean_samples.mean(0)
-    clean_preds = clean_probs.argmax(-1)
-
     oods = []
     oods.append( noised(Xt, noise_level, 'uniform'))
     oods.append( noised(Xt, noise_level) )
@@ -521,22 +421,12 @@ if anomaly:
         oods.append( notmnist_dataset )
 
     # RESULTS ARE IN THE SAME ORDER AS IN THE TABLES IN DAN's paper
+    # (rows: anomaly_detection.score_fns; baseline is the last one)
 
-    ##########################
-    # error-detection
-    print "\n Error detection"
-    err_results= np.empty((len(score_fns), 3))
-    for nscore, score_fn in enumerate(score_fns):
-        print "Error detection", nscore
-        gtruth = np.argmax(Yt, axis=-1)
-        is_correct = np.equal(clean_preds, gtruth)
-        correct = clean_samples[:, is_correct]
-        incorrect = clean_samples[:, np.logical_not(is_correct)]
-        clean_scores = score_fn(correct)
-        # check that all score functions return a score for each example (i.e. have the right shape)
-        assert len(clean_scores) == correct.shape[1]
-        err_scores = score_fn(incorrect)
-        err_results[nscore][:3] = get_results(clean_scores, err_scores)
+    # each dataset is sampled once, chunk per chunk
+    print "\n Error detection and OOD detection"
+    err_results, ood_results = anomaly_detection.evaluate(
+        probs, Xt, Yt, oods, num_samples=ad_num_samples, chunk_size=chunk_size)
     if save:
         if test_eval:
             np.save(save_path + '_test_err_results.npy', err_results)
@@ -546,17 +436,6 @@ if anomaly:
     # print results
     print err_results
 
-    ##########################
-    # OOD-detection
-    print "\nOOD detection"
-    ood_results= np.empty((len(score_fns), len(oods), 3))
-    for nscore, score_fn in enumerate(score_fns):
-        for nood, ood in enumerate(oods):
-            print "OOD detection", nscore, nood
-            clean_scores = score_fn(clean_samples)
-            ood_samples = MCpred(X=ood, predict_probs_fn=probs, num_samples=100, returns='samples',num_classes=classes)
-            ood_scores = score_fn(ood_samples)
-            ood_results[nscore][nood] = get_results(clean_scores, ood_scores)
     if save:
         if test_eval:
             np.save(save_path + '_test_ood_results.npy', ood_results)
@@ -7,10 +7,20 @@ np = numpy
 np.random.seed(1) # TODO
 import os
 import random
+import shutil
 
 
 
-def get_regression_dataset(dataset, split_count, data_path='./', valid_set=True, normalize=True):#$HOME/BayesianHypernetCW/'):
+def get_regression_dataset(dataset, split_count, data_path='./', valid_set=True, normalize=True, store_path=None):#$HOME/BayesianHypernetCW/'):
+    """
+    store_path: if given, the data is read (memory-mapped) from the binary
+    store built by build_regression_store, which is built on first use
+    """
+    if store_path is not None:
+        if not os.path.isfile(os.path.join(store_path, dataset, 'index_train.npy')):
+            build_regression_store(dataset, data_path, store_path)
+        return load_regression_store(dataset, split_count, store_path, valid_set, normalize)
+
     # load data
     data = np.loadtxt(data_path + 'get_proper_regression_data/' + dataset + '/data/data.txt').astype('float32')
     index_features = np.loadtxt(data_path + 'get_proper_regression_data/' + dataset + '/data/index_features.txt')
@@ -25,29 +35,12 @@ def get_regression_dataset(dataset, split_count, data_path='./', valid_set=True,
     input_dim = train_x.shape[1]
 
     if valid_set:
-        ind = int(.8 * len(train_x))
-        valid_x = train_x[ind:]
-        valid_y = train_y[ind:]
-        train_x = train_x[:ind]
-        train_y = train_y[:ind]
+        train_x, train_y, valid_x, valid_y = split_valid(train_x, train_y)
 
         if normalize:
-            x_mean = train_x.mean(axis=0)
-            x_std = train_x.std(axis=0)
-            y_mean = train_y.mean()
-            y_std = train_y.std()
-
-            x_std[ x_std == 0 ] = 1 # avoid divide by 0!
-
-            train_x = (train_x - x_mean) / x_std
-            valid_x = (valid_x - x_mean) / x_std
-            test_x = (test_x - x_mean) / x_std
-
-            train_y = (train_y - y_mean) / y_std
-
-            # TODO: these must be "unnormalized" by the model
-            #valid_y = (valid_y - y_mean) / y_std
-            #test_y = (test_y - y_mean) / y_std
+            x_mean, x_std, y_mean, y_std = get_stats(train_x, train_y)
+            train_x, train_y, valid_x, test_x = normalize_dataset(
+                train_x, train_y, valid_x, test_x, x_mean, x_std, y_mean, y_std)
         else:
             y_mean = None
             y_std = None
@@ -65,3 +58,130 @@ def get_dataset(X, y, i, index_train, index_test):
     y_test = y[ index_test.astype(int) ]
 
     return X_train, y_train, X_test, y_test
+
+
+def split_valid(train_x, train_y):
+    ind = int(.8 * len(train_x))
+    return train_x[:ind], train_y[:ind], train_x[ind:], train_y[ind:]
+
+
+def get_stats(train_x, train_y):
+    x_mean = train_x.mean(axis=0)
+    x_std = train_x.std(axis=0)
+    y_mean = train_y.mean()
+    y_std = train_y.std()
+
+    x_std[ x_std == 0 ] = 1 # avoid divide by 0!
+    return x_mean, x_std, y_mean, y_std
+
+
+def normalize_dataset(train_x, train_y, valid_x, test_x, x_mean, x_std, y_mean, y_std):
+    train_x = (train_x - x_mean) / x_std
+    valid_x = (valid_x - x_mean) / x_std
+    test_x = (test_x - x_mean) / x_std
+
+    train_y = (train_y - y_mean) / y_std
+
+    # TODO: these must be "unnormalized" by the model
+    #valid_y = (valid_y - y_mean) / y_std
+    #test_y = (test_y - y_mean) / y_std
+    return train_x, train_y, valid_x, test_x
+
+
+# binary store:
+#   {store_path}/{dataset}/X.npy, y.npy                 float32 features/targets
+#   {store_path}/{dataset}/index_train.npy, index_test.npy   (n_splits, n) int32
+#   {store_path}/{dataset}/x_mean.npy, x_std.npy, y_mean.npy, y_std.npy
+#       normalization stats of the training part (without the valid set)
+#       of each split
+# written to a temporary directory renamed into place (as 
+# dataset_cache.save_cache), so concurrent jobs never read a partial store
+
+def build_regression_store(dataset, data_path='./', store_path='./regression_store'):
+    """ one-time conversion of get_proper_regression_data/{dataset} """
+    src = os.path.join(data_path, 'get_proper_regression_data', dataset, 'data')
+    n_splits = int(np.loadtxt(os.path.join(src, 'n_splits.txt')))
+    data = np.loadtxt(os.path.join(src, 'data.txt')).astype('float32')
+    index_features = np.loadtxt(os.path.join(src, 'index_features.txt')).astype(int)
+    index_target = np.loadtxt(os.path.join(src, 'index_target.txt')).astype(int)
+    X = data[:, index_features.reshape(-1)]
+    y = data[:, index_target.reshape(-1)].reshape((-1,1))
+
+    index_train = np.asarray([np.loadtxt(os.path.join(src, 'index_train_{}.txt'.format(i)))
+                              for i in range(n_splits)]).astype('int32')
+    index_test = np.asarray([np.loadtxt(os.path.join(src, 'index_test_{}.txt'.format(i)))
+                             for i in range(n_splits)]).astype('int32')
+    # ragged splits would give object arrays
+    assert index_train.ndim == 2 and index_test.ndim == 2
+
+    stats = [get_stats(*split_valid(X[inds], y[inds])[:2]) for inds in index_train]
+    x_mean, x_std, y_mean, y_std = [np.asarray(s) for s in zip(*stats)]
+
+    dst = os.path.join(store_path, dataset)
+    # one temporary directory per process: several jobs may build at once
+    tmp = '{}.tmp.{}'.format(dst, os.getpid())
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name, arr in [('X', X), ('y', y), ('index_test', index_test),
+                      ('x_mean', x_mean), ('x_std', x_std),
+                      ('y_mean', y_mean), ('y_std', y_std),
+                      ('index_train', index_train)]:
+        np.save(os.path.join(tmp, name + '.npy'), arr)
+    try:
+        os.rename(tmp, dst)
+    except OSError:
+        # another job got there first
+        shutil.rmtree(tmp)
+        if not os.path.isfile(os.path.join(dst, 'index_train.npy')):
+            raise
+        return
+    print 'stored {} ({} splits) in {}'.format(dataset, n_splits, dst)
+
+
+def load_regression_store(dataset, split_count, store_path='./regression_store', valid_set=True, normalize=True):
+    """ same outputs as get_regression_dataset """
+    src = os.path.join(store_path, dataset)
+    load = lambda name, mmap_mode='r': np.load(os.path.join(src, name + '.npy'), mmap_mode=mmap_mode)
+    X, y = load('X'), load('y')
+    split_count = int(split_count)
+    index_train = load('index_train')[split_count]
+    index_test = load('index_test')[split_count]
+
+    train_x, train_y, test_x , test_y = get_dataset(X, y, split_count, index_train, index_test)
+    input_dim = train_x.shape[1]
+
+    if valid_set:
+        train_x, train_y, valid_x, valid_y = split_valid(train_x, train_y)
+
+        if normalize:
+            x_mean, x_std = load('x_mean')[split_count], load('x_std')[split_count]
+            y_mean, y_std = load('y_mean', None)[split_count], load('y_std', None)[split_count]
+            train_x, train_y, valid_x, test_x = normalize_dataset(
+                train_x, train_y, valid_x, test_x, x_mean, x_std, y_mean, y_std)
+        else:
+            y_mean = None
+            y_std = None
+
+        return input_dim, train_x, train_y, valid_x, valid_y, test_x, test_y, y_mean, y_std
+    else:
+        return input_dim, train_x, train_y, test_x, test_y
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets',default=['airfoil', 'parkinsons', 'boston', 'concrete', 'energy', 'kin8nm', 'naval', 'power', 'protein', 'wine', 'yacht', 'year'], type=str, nargs='+')
+    parser.add_argument('--data_path',default=None, type=str)
+    parser.add_argument('--store_path',default='./regression_store', type=str)
+    args = parser.parse_args()
+    print args
+
+    data_path = args.data_path
+    if data_path is None:
+        data_path = os.path.join(os.environ['HOME'], 'BayesianHypernetCW/')
+
+    for dataset in args.datasets:
+        build_regression_store(dataset, data_path, args.store_path)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Label encodings shared by the loaders and the training scripts.
+
+Models built with int_targets=True (see BHNs.Base_BHN) train on the int
+labels directly, so the one-hot float matrices are only needed by the
+models and scripts that still take one-hot targets.
+"""
+
+import numpy as np
+floatX = 'float32'
+
+
+def onehot(labels, n_classes=None, dtype=floatX):
+    """
+    (n, n_classes) one-hot rows of the int labels (any shape, e.g. (n,1));
+    n_classes defaults to max(labels)+1
+    """
+    labels = np.asarray(labels, dtype='int64').reshape(-1)
+    if n_classes is None:
+        n_classes = labels.max() + 1
+    Y = np.zeros((len(labels), n_classes), dtype=dtype)
+    Y[np.arange(len(labels)), labels] = 1
+    return Y
+
+
+def to_labels(Y, dtype='int32'):
+    """
+    int labels of one-hot (or probability) rows, of a OneHotView, or of
+    labels already (returned flattened)
+    """
+    if hasattr(Y, 'labels'):
+        Y = Y.labels
+    Y = np.asarray(Y)
+    if Y.ndim == 2 and Y.shape[1] > 1:
+        Y = Y.argmax(1)
+    return Y.reshape(-1).astype(dtype)
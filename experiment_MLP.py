@@ -9,6 +9,7 @@ Created on Sun May 14 19:49:51 2017
 #from concrete_dropout import MLPConcreteDropout_BHN
 from ops import load_mnist
 from utils import train_model, evaluate_model
+from helpers import checkpoint_exists
 import numpy as np
 
 import lasagne
@@ -254,7 +255,7 @@ if __name__ == '__main__':
     va_rec_name = name+'_recs'
     tr_rec_name = name+'_recs_train' # TODO (we're already saving the valid_recs!)
     save_path = name + '.params.npy'
-    if os.path.isfile(save_path) and not args.override:
+    if checkpoint_exists(save_path) and not args.override:
         print 'load best model'
         e0 = model.load(save_path)
         va_recs = open(va_rec_name,'r').read().split('\n')[:e0]
@@ -10,6 +10,7 @@ from BHNs import MLPWeightNorm_BHN
 from concrete_dropout import MLPConcreteDropout_BHN
 from ops import load_mnist
 from utils import log_normal, log_laplace, train_model, evaluate_model
+from helpers import checkpoint_exists
 import numpy as np
 
 import lasagne
@@ -19,6 +20,7 @@ import os
 from lasagne.random import set_rng
 from theano.tensor.shared_randomstreams import RandomStreams
 from FGS_eval import evaluate as adv_evaluate
+from FGS_eval import evaluate_pgd
 
 
 # TODO: add all LCS
@@ -131,13 +133,16 @@ if __name__ == '__main__':
     parser.add_argument('--n_hiddens',default=1,type=int)
     parser.add_argument('--n_units',default=200,type=int)
     parser.add_argument('--totrain',default=1,type=int)
-    parser.add_argument('--adv_eval',default=1,type=int)
+    parser.add_argument('--adv_eval',default=1,type=int,
+                        help="1: FGSM, 2: PGD")
+    parser.add_argument('--pgd_steps',default=10,type=int)
+    parser.add_argument('--pgd_step_size',default=None,type=float)
     parser.add_argument('--avg',default=1,type=int)
     parser.add_argument('--seed',default=427,type=int)
     parser.add_argument('--override',default=1,type=int)
     parser.add_argument('--reinit',default=1,type=int)
     parser.add_argument('--flow',default='RealNVP',type=str, 
-                        choices=['RealNVP', 'IAF'])
+                        choices=['RealNVP', 'IAF', 'ConvNVP'])
     parser.add_argument('--noise_distribution',default='spherical_gaussian',type=str)
     # alpha > beta  ==>  we prefer units to have high dropout probability
     parser.add_argument('--alpha',default=2, type=float)
@@ -266,7 +271,7 @@ if __name__ == '__main__':
     va_rec_name = name+'_recs'
     tr_rec_name = name+'_recs_train' # TODO (we're already saving the valid_recs!)
     save_path = name + '.params.npy'
-    if os.path.isfile(save_path) and not args.override:
+    if checkpoint_exists(save_path) and not args.override:
         print 'load best model'
         e0 = model.load(save_path)
         va_recs = open(va_rec_name,'r').read().split('\n')[:e0]
@@ -309,6 +314,14 @@ if __name__ == '__main__':
         print 'test acc (best valid): {}'.format(te_acc)
 
         
+    if args.adv_eval in [1, 2]:
+        # the weight samples of the hypernet can be fixed (not the noise 
+        # of the dropout models)
+        if args.model == 'BHN_MLPWN' and not args.perdatapoint:
+            weights = model.weights
+        else:
+            weights = None
+    
     if args.adv_eval == 1:
         results = adv_evaluate(test_x,
                                test_y,
@@ -316,7 +329,22 @@ if __name__ == '__main__':
                                model.input_var,
                                model.target_var,
                                model.y_unclipped,
-                               avg=args.avg)
+                               avg=args.avg,
+                               weights=weights)
         
         np.save(name+'_adv',results)
+    elif args.adv_eval == 2:
+        results = evaluate_pgd(test_x,
+                               test_y,
+                               model.predict_proba,
+                               model.input_var,
+                               model.target_var,
+                               model.y_unclipped,
+                               n_steps=args.pgd_steps,
+                               step_size=args.pgd_step_size,
+                               n_samples=args.avg,
+                               clip=(0.,1.),
+                               weights=weights)
+        
+        np.save(name+'_pgd',results)
         
@@ -12,6 +12,7 @@ import pandas as pd
 from BHNs_MLP_Regression import MLPWeightNorm_BHN, MCdropout_MLP
 from ops import load_mnist
 from utils import log_normal, log_laplace
+from helpers import checkpoint_exists
 import numpy as np
 
 import lasagne
@@ -476,7 +477,7 @@ if __name__ == '__main__':
     va_rec_name = name+'_recs'
     tr_rec_name = name+'_recs_train' # TODO (we're already saving the valid_recs!)
     save_path = name + '.params.npy'
-    if os.path.isfile(save_path) and not args.override:
+    if checkpoint_exists(save_path) and not args.override:
         print 'load best model'
         e0 = model.load(save_path)
         va_recs = open(va_rec_name,'r').read().split('\n')[:e0]
@@ -8,6 +8,7 @@ Created on Mon Oct 23 13:45:40 2017
 
 from ops import load_mnist
 from utils import log_normal, log_laplace, train_model, evaluate_model
+from helpers import checkpoint_exists
 import numpy as np
 
 import lasagne
@@ -21,7 +22,7 @@ from lasagne.objectives import categorical_crossentropy as cc
 from lasagne.layers import get_output
 from theano.tensor.shared_randomstreams import RandomStreams
 
-from modules import hypernet, N_get_output, get_elbo
+from modules import hypernet, conditional_norm_outputs, get_elbo
 from utils import stable_grad
 
 # TODO: add all LCS
@@ -104,6 +105,7 @@ class MLP(object):
         
         self.layer = layer
         if flow is None:
+            self.p_params = lasagne.layers.get_all_params(self.layer)
             self.output_var = get_output(layer,self.input_var)
             self.output_var_det = get_output(layer,self.input_var,
                                              deterministic=True)
@@ -135,10 +137,13 @@ class MLP(object):
             ep = srng.normal(size=(1,num_params),dtype=floatX)        
             
    
-            output_var = N_get_output(layer,
-                                      self.input_var,hnet,ep,
-                                      norm_type=norm_type,
-                                      static_bias=static_bias)
+            # the primary net is left untouched; the biases of the 
+            # normalized layers are not part of p_params
+            output_var, output_var_test, p_params = \
+                conditional_norm_outputs(layer,
+                                         self.input_var,hnet,ep,
+                                         norm_type=norm_type,
+                                         static_bias=static_bias)
             weights = get_output(hnet,ep)
             logdets = get_output(ld,ep)
             
@@ -147,17 +152,13 @@ class MLP(object):
             self.hnet = hnet
             self.ep = ep
             self.output_var_ = output_var
+            self.p_params = p_params
             
             if norm_type == 'BN' and flow is not None:
                 print 'BN test time uses running avg'
-                #self.output_var = N_get_output(layer,
-                #                               self.input_var,hnet,ep,
-                #                               norm_type=norm_type,
-                #                               static_bias=static_bias,
-                #                               test_time=True)
-                self.output_var = self.output_var
+                self.output_var = output_var_test
             else:
-                self.output_var = self.output_var
+                self.output_var = output_var
             
             self.weights = weights
             self.logdets = logdets
@@ -178,7 +179,7 @@ class MLP(object):
             
         
         
-        self.params = lasagne.layers.get_all_params(self.layer) + \
+        self.params = self.p_params + \
                       lasagne.layers.get_all_params(self.hnet)
         if hasattr(self,'N_bias'):
             if self.N_bias is not None:
@@ -380,7 +381,7 @@ if __name__ == '__main__':
     va_rec_name = name+'_recs'
     tr_rec_name = name+'_recs_train' # TODO (we're already saving the valid_recs!)
     save_path = name + '.params.npy'
-    if os.path.isfile(save_path) and not args.override:
+    if checkpoint_exists(save_path) and not args.override:
         print 'load best model'
         e0 = model.load(save_path)
         va_recs = open(va_rec_name,'r').read().split('\n')[:e0]
@@ -7,7 +7,9 @@ Created on Sun May 14 19:49:51 2017
 
 
 from ops import load_mnist, load_cifar10, load_cifar5
+from dataset_cache import as_uint8
 from utils import log_normal, log_laplace, train_model, evaluate_model
+from helpers import checkpoint_exists
 import numpy as np
 
 import lasagne
@@ -156,11 +158,17 @@ if __name__ == '__main__':
     parser.add_argument('--override',default=1,type=int)
     parser.add_argument('--reinit',default=1,type=int)
     parser.add_argument('--flow',default='RealNVP',type=str, 
-                        choices=['RealNVP', 'IAF'])
+                        choices=['RealNVP', 'IAF', 'ConvNVP'])
     parser.add_argument('--n_units_h',default=200, type=int)
     parser.add_argument('--alpha',default=2, type=float)
     parser.add_argument('--beta',default=1, type=float)
     parser.add_argument('--save_dir',default='./models_CNN',type=str)
+    parser.add_argument('--uint8',default=0,type=int,
+                        help="keep the images uint8 on the host, cast and "
+                             "scaled in the graph (HyperWN_CNN only)")
+    parser.add_argument('--int_targets',default=0,type=int,
+                        help="train on int labels instead of one-hot "
+                             "targets (HyperWN_CNN only)")
     
     
     args = parser.parse_args()
@@ -236,7 +244,8 @@ if __name__ == '__main__':
         if dataset=='mnist':
             filename = '/data/lisa/data/mnist.pkl.gz'
             train_x, train_y, valid_x, valid_y, test_x, test_y = \
-                load_mnist(filename)
+                load_mnist(filename,lazy=args.uint8,
+                           one_hot=not args.int_targets)
             train_x = train_x.reshape((-1, 1, 28, 28))
             valid_x = valid_x.reshape((-1, 1, 28, 28))
             test_x = test_x.reshape((-1, 1, 28, 28))
@@ -255,7 +264,8 @@ if __name__ == '__main__':
         elif dataset=='cifar10':
             filename = 'cifar10.pkl'
             train_x, train_y, valid_x, valid_y, test_x, test_y = \
-                load_cifar10(filename,seed=args.seed)
+                load_cifar10(filename,seed=args.seed,lazy=args.uint8,
+                             one_hot=not args.int_targets)
             train_x = train_x.reshape((-1, 3, 32, 32))
             test_x = test_x.reshape((-1, 3, 32, 32))
             
@@ -274,7 +284,8 @@ if __name__ == '__main__':
         elif dataset=='cifar5':
             filename = 'cifar10.pkl'
             train_x, train_y, valid_x, valid_y, test_x, test_y = \
-                load_cifar5(filename,seed=args.seed)
+                load_cifar5(filename,seed=args.seed,lazy=args.uint8,
+                            one_hot=not args.int_targets)
             train_x = train_x.reshape((-1, 3, 32, 32))
             test_x = test_x.reshape((-1, 3, 32, 32))
             
@@ -291,6 +302,17 @@ if __name__ == '__main__':
             nonl = rectify
             pool_per = 1
             
+    input_kargs = dict()
+    if args.uint8:
+        assert args.model == 'HyperWN_CNN'
+        # lazy views of the cache (if $DATA_CACHE is set) or float arrays
+        (train_x, scale), (valid_x, _), (test_x, _) = \
+            [as_uint8(x) for x in [train_x, valid_x, test_x]]
+        input_kargs = dict(input_dtype='uint8', input_scale=1./scale)
+    if args.int_targets:
+        assert args.model == 'HyperWN_CNN'
+        input_kargs['int_targets'] = True
+    
     if args.model == 'HyperWN_CNN':
         model = HyperWN_CNN(lbda=lbda,
                             perdatapoint=perdatapoint,
@@ -309,7 +331,8 @@ if __name__ == '__main__':
                             pad=pad,
                             nonl=nonl,
                             pool_per=pool_per,
-                            n_units_h=args.n_units_h)
+                            n_units_h=args.n_units_h,
+                            **input_kargs)
     elif args.model == 'CNN':
         model = MCdropoutCNN(dataset=dataset,n_classes=n_classes)
     elif args.model == 'CNN_spatial_dropout':
@@ -324,7 +347,7 @@ if __name__ == '__main__':
 
     va_rec_name = name+'_recs'
     save_path = name + '.params.npy'
-    if os.path.isfile(save_path) and not args.override:
+    if checkpoint_exists(save_path) and not args.override:
         print 'load best model'
         e0 = model.load(save_path)
         va_recs = open(va_rec_name,'r').read().split('\n')[:e0]
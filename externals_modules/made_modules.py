@@ -144,6 +144,35 @@ class MaskGenerator(object):
 
 
 
+def get_made_masks(input_size, hidden_sizes, l=0, random_seed=1234):
+    """
+    numpy version of MaskGenerator: draws a random ordering and the 
+    connectivity of the hidden units, and returns the masks of a MADE with
+    the given hidden_sizes (same connectivity rules as MaskGenerator; no 
+    theano function is compiled).
+    
+    l : the connectivity of a hidden unit is drawn from softmax(l*m), m 
+        ranging from the min connectivity of the layer below to input_size-1
+    """
+    rng = np.random.RandomState(random_seed)
+    ordering = rng.permutation(input_size)
+    
+    layers_connectivity = [ordering + 1]
+    for layer_size in hidden_sizes:
+        start_choice = layers_connectivity[-1].min()
+        choices = np.arange(start_choice, max(start_choice+1, input_size))
+        p_vals = np.exp(l * (choices - choices.max()))
+        p_vals /= p_vals.sum()
+        layers_connectivity.append(rng.choice(choices, layer_size, p=p_vals))
+    layers_connectivity.append(ordering)
+    
+    return [(lc_in[:, None] <= lc_out[None, :]).astype(floatX) 
+            for lc_in, lc_out in zip(layers_connectivity[:-1],
+                                     layers_connectivity[1:])]
+
+
+
+
 class Layer(object):
 
     def __init__(self, layerIdx, input, n_in, n_out, 
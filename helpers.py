@@ -1,9 +1,15 @@
 #!/usr/bin/env python
     
+import os
+import re
+import json
+import shutil
 import theano.tensor as T
 import numpy
 np = numpy
 
+from dataset_cache import get_cache_dir, cached
+
 # from Hendrycks
 def gelu_fast(x):
     return 0.5 * x * (1 + T.tanh(T.sqrt(2 / np.pi) * (x + 0.044715 * T.pow(x, 3))))
@@ -53,6 +59,264 @@ class SaveLoadMIXIN(object):
         self.reset_dict[name]()
          
   
+######################
+def _jsonable(obj):
+    """ json.dumps default for numpy scalars/arrays (and anything else) """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+def checkpoint_path(save_path):
+    """
+    where the checkpoint saved at save_path is: the directory save_path, 
+    or save_path without '.npy' (np.save used to append it, and scripts 
+    still pass that name), or else their '.old' copy, left by a save 
+    interrupted between its two renames. Defaults to save_path (an old 
+    single-file checkpoint).
+    """
+    paths = [save_path]
+    if save_path.endswith('.npy'):
+        paths.append(save_path[:-len('.npy')])
+    for path in paths + [path + '.old' for path in paths]:
+        if os.path.isdir(path):
+            return path
+    return save_path
+
+
+def checkpoint_exists(save_path):
+    return os.path.exists(checkpoint_path(save_path))
+
+
+class CheckpointMIXIN(object):
+    """
+    save/load self.params (and the optimizer state, i.e. the shared 
+    variables updated in self.updates that are not params) as a directory:
+        manifest.json  -- names, shapes and dtypes of the arrays, 
+                          architecture signature, notes
+        <name>.npy     -- one array each, memory-mapped when loading
+    
+    names are '{group}.{index}.{param name}', the groups being given by 
+    _param_groups (e.g. hnet/pnet), so that part of a model can be loaded
+    (e.g. load(path, groups=['hnet'])). The index is the position of the 
+    param within its group (param names need not be unique), so the 
+    params of a group are matched by position, the names and shapes being
+    checked.
+    with rng_state, the states of self.srng (theano RandomStreams) and of 
+    numpy's global rng are saved as well, to resume training exactly.
+    old checkpoints (np.save of the list of values + notes) still load.
+    """
+    # attributes making up the architecture signature
+    signature_attrs = []
+    
+    def _param_groups(self):
+        """ [(group, params)]; params not in any group are in 'params' """
+        return []
+    
+    def _param_names(self):
+        groups = self._param_groups()
+        names = []
+        counts = {}
+        for p in self.params:
+            group = 'params'
+            for g, params in groups:
+                if p in params:
+                    group = g
+                    break
+            i = counts.get(group, 0)
+            counts[group] = i + 1
+            name = re.sub(r'[^\w]', '_', str(p.name))
+            names.append('{}.{:03d}.{}'.format(group, i, name))
+        return names
+    
+    def _opt_state(self):
+        """ (names, shared variables) of the optimizer state """
+        updates = getattr(self, 'updates', None) or {}
+        params = set(self.params)
+        opt_vars = [v for v in updates.keys() 
+                    if v not in params and hasattr(v, 'get_value')]
+        names = ['opt.{:03d}.{}'.format(i, re.sub(r'[^\w]', '_', str(v.name)))
+                 for i, v in enumerate(opt_vars)]
+        return names, opt_vars
+    
+    def _signature(self):
+        signature = {'class': type(self).__name__}
+        for attr in self.signature_attrs:
+            if hasattr(self, attr):
+                signature[attr] = getattr(self, attr)
+        # normalize tuples/numpy types as in the manifest
+        return json.loads(json.dumps(signature, default=_jsonable))
+    
+    def _rng_state(self):
+        """ shared variables holding the RandomState's of self.srng """
+        srng = getattr(self, 'srng', None)
+        if srng is None or not hasattr(srng, 'state_updates'):
+            return []
+        return [su[0] for su in srng.state_updates]
+    
+    def save(self, save_path, notes=[], dtype=None, opt_state=False, 
+             rng_state=True, extra_arrays={}):
+        """
+        dtype: e.g. np.float16 to store reduced-precision params
+        opt_state: also save the optimizer state (for resuming training)
+        extra_arrays: {key: [arrays]} saved along (e.g. the best params so 
+        far), so that they are swapped in with the rest; see load_extra
+        """
+        names = self._param_names()
+        shared = list(self.params)
+        if opt_state:
+            opt_names, opt_vars = self._opt_state()
+            names += opt_names
+            shared += opt_vars
+        
+        # write to a temporary directory, then swap, so that an interrupted 
+        # save never leaves a broken checkpoint behind
+        tmp_path = save_path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        arrays = []
+        for name, p in zip(names, shared):
+            value = np.asarray(p.get_value())
+            if dtype is not None and not name.startswith('opt.'):
+                value = value.astype(dtype)
+            np.save(os.path.join(tmp_path, name + '.npy'), value)
+            arrays.append({'name': name,
+                           'shape': value.shape,
+                           'dtype': str(value.dtype)})
+        extra = {}
+        for key, values in extra_arrays.items():
+            if values is None:
+                continue
+            extra[key] = len(values)
+            for i, value in enumerate(values):
+                np.save(os.path.join(tmp_path, 
+                                     'extra.{}.{:03d}.npy'.format(key, i)),
+                        np.asarray(value))
+        rngs = []
+        if rng_state:
+            states = [('np', np.random.get_state())]
+            states += [('srng.{:03d}'.format(i), r.get_value().get_state()) 
+                       for i, r in enumerate(self._rng_state())]
+            for name, state in states:
+                # ('MT19937', keys, pos, has_gauss, cached_gaussian)
+                np.save(os.path.join(tmp_path, 'rng.' + name + '.npy'),
+                        state[1])
+                rngs.append({'name': name, 
+                             'state': [state[0]] + list(state[2:])})
+        manifest = {'signature': self._signature(),
+                    'arrays': arrays,
+                    'rngs': rngs,
+                    'extra': extra,
+                    'notes': notes}
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, default=_jsonable, indent=1)
+        
+        old_path = save_path + '.old'
+        if os.path.exists(save_path):
+            os.rename(save_path, old_path)
+        os.rename(tmp_path, save_path)
+        if os.path.exists(old_path):
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+            else:
+                os.remove(old_path)
+    
+    def load(self, save_path, groups=None, opt_state=False, rng_state=False,
+             mmap_mode='r'):
+        """
+        groups: only load the params of these groups (the architecture 
+        signature is then not checked)
+        returns the last note saved, if any
+        """
+        save_path = checkpoint_path(save_path)
+        if not os.path.isdir(save_path):
+            return self._load_npy(save_path)
+        
+        with open(os.path.join(save_path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if groups is None and manifest['signature'] != self._signature():
+            raise ValueError("mismatch: checkpoint of %r, model is %r" %
+                             (manifest['signature'], self._signature()))
+        saved = {a['name']: tuple(a['shape']) for a in manifest['arrays']}
+        
+        names = self._param_names()
+        shared = list(self.params)
+        if opt_state:
+            opt_names, opt_vars = self._opt_state()
+            names += opt_names
+            shared += opt_vars
+        
+        for name, p in zip(names, shared):
+            if groups is not None and name.split('.')[0] not in groups:
+                continue
+            if name not in saved:
+                raise ValueError("mismatch: no value saved for %s" % name)
+            if p.get_value().shape != saved[name]:
+                raise ValueError("mismatch: parameter %s has shape %r but "
+                                 "value to set has shape %r" %
+                                 (name, p.get_value().shape, saved[name]))
+            value = np.load(os.path.join(save_path, name + '.npy'),
+                            mmap_mode=mmap_mode)
+            p.set_value(np.asarray(value, dtype=p.dtype))
+        
+        if rng_state:
+            rngs = self._rng_state()
+            for rng in manifest.get('rngs', []):
+                keys = np.load(os.path.join(save_path, 
+                                            'rng.' + rng['name'] + '.npy'))
+                state = rng['state']
+                state = (str(state[0]), keys) + tuple(state[1:])
+                if rng['name'] == 'np':
+                    np.random.set_state(state)
+                else:
+                    i = int(rng['name'].split('.')[1])
+                    if i >= len(rngs):
+                        raise ValueError("mismatch: no random stream %d" % i)
+                    r = rngs[i].get_value()
+                    r.set_state(state)
+                    rngs[i].set_value(r)
+        
+        notes = manifest['notes']
+        return notes[-1] if len(notes) else None
+    
+    def load_extra(self, save_path, key):
+        """ the arrays saved as extra_arrays[key], or None """
+        save_path = checkpoint_path(save_path)
+        if not os.path.isdir(save_path):
+            return None
+        with open(os.path.join(save_path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        n = manifest.get('extra', {}).get(key)
+        if n is None:
+            return None
+        return [np.load(os.path.join(save_path, 
+                                     'extra.{}.{:03d}.npy'.format(key, i)))
+                for i in range(n)]
+    
+    def _load_npy(self, save_path):
+        """ old format: np.save of [param values] (+ notes) """
+        values = np.load(save_path)
+        if len(self.params) == len(values) - 1:
+            notes = values[-1]
+            values = values[:-1]
+        elif len(self.params) == len(values):
+            notes = None
+        else:
+            raise ValueError("mismatch: got %d values to set %d parameters" %
+                             (len(values), len(self.params)))
+
+        for p, v in zip(self.params, values):
+            if p.get_value().shape != v.shape:
+                raise ValueError("mismatch: parameter has shape %r but value to "
+                                 "set has shape %r" %
+                                 (p.get_value().shape, v.shape))
+            else:
+                p.set_value(v.astype(p.dtype))
+
+        return notes
+         
+  
 ######################
 
 def flatten_list(plist):
@@ -93,18 +357,17 @@ import pickle
 import numpy as np
 from six.moves import urllib
 import tarfile
+from encoding import onehot
 
 def to_categorical(y, nb_classes):
-    y = np.asarray(y, dtype='int32')
-    if not nb_classes:
-        nb_classes = np.max(y)+1
-    Y = np.zeros((len(y), nb_classes))
-    for i in range(len(y)):
-        Y[i, y[i]] = 1.
-    return Y
+    return onehot(y, nb_classes or None, dtype='float64')
 
 # load training and testing data
-def load_data10(randomize=True, return_val=False, one_hot=False, dirname="cifar-10-batches-py", mnistify=False):
+def load_data10(randomize=True, return_val=False, one_hot=False, dirname="cifar-10-batches-py", mnistify=False, cache_dir=None):
+    """
+    cache_dir: (or $DATA_CACHE) the batches are read from the binary cache 
+    of dataset_cache.py, built on first use
+    """
 
     def load_batch(fpath):
         with open(fpath, 'rb') as f:
@@ -138,22 +401,26 @@ def load_data10(randomize=True, return_val=False, one_hot=False, dirname="cifar-
         else:
             print("Not a tar.gz file: '%s '" % sys.argv[0])
 
-    tarpath = maybe_download("cifar-10-python.tar.gz",
-                             "http://www.cs.toronto.edu/~kriz/", dirname)
-    X_train = []
-    Y_train = []
-
-    for i in range(1, 6):
-        fpath = os.path.join(dirname, 'data_batch_' + str(i))
-        data, labels = load_batch(fpath)
-        if i == 1:
-            X_train = data
-            Y_train = labels
-        else:
-            X_train = np.concatenate([X_train, data], axis=0)
-            Y_train = np.concatenate([Y_train, labels], axis=0)
-
-    X_test, Y_test = load_batch(os.path.join(dirname, 'test_batch'))
+    def read_batches():
+        tarpath = maybe_download("cifar-10-python.tar.gz",
+                                 "http://www.cs.toronto.edu/~kriz/", dirname)
+        batches = [load_batch(os.path.join(dirname, 'data_batch_' + str(i)))
+                   for i in range(1, 6)]
+        X_train = np.concatenate([data for data, labels in batches], axis=0)
+        Y_train = np.concatenate([labels for data, labels in batches], axis=0)
+        return dict(train=(X_train, Y_train),
+                    test=load_batch(os.path.join(dirname, 'test_batch')))
+
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is not None:
+        name = os.path.basename(os.path.normpath(dirname))
+        splits = cached(name, read_batches, cache_dir)
+        (X_train, Y_train), (X_test, Y_test) = \
+            [(x.data[:], np.asarray(y)) for x, y in 
+             [splits['train'], splits['test']]]
+    else:
+        splits = read_batches()
+        (X_train, Y_train), (X_test, Y_test) = splits['train'], splits['test']
 
     X_train = np.dstack((X_train[:, :1024], X_train[:, 1024:2048],
                          X_train[:, 2048:])) / 255.
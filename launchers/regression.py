@@ -212,7 +212,7 @@ if __name__ == '__main__':
     # 
     parser.add_argument('--dataset',default='airfoil',type=str, choices=['airfoil', 'parkinsons'] + ['boston', 'concrete', 'energy', 'kin8nm', 'naval', 'power', 'protein', 'wine', 'yacht', 'year'])
     parser.add_argument('--data_path',default=None, type=str)
-    parser.add_argument('--flow',default='IAF',type=str, choices=['RealNVP', 'IAF'])
+    parser.add_argument('--flow',default='IAF',type=str, choices=['RealNVP', 'IAF', 'ConvNVP'])
     parser.add_argument('--save_dir',default=None, type=str)
     #
     parser.add_argument('--drop_prob',default=0.005, type=float) # .05, .01, .005
@@ -22,7 +22,7 @@ from lasagne.objectives import squared_error as se
 from theano.tensor.var import TensorVariable as tv
 
 from utils import log_normal
-from externals_modules.made_modules import MADE
+from externals_modules.made_modules import get_made_masks
 
 conv = lasagne.theano_extensions.conv
 softplus = lambda x: T.nnet.softplus(x) + delta
@@ -170,6 +170,133 @@ class CoupledWNDenseLayer(lasagne.layers.base.Layer):
 
 
 
+def get_factored_weight(add_param,W,V,d1,d2,rank,name):
+    """
+    (d1,d2) weight matrix, returned as the list of its factors:
+    [W] if rank is None, or [U,V] with U (d1,rank) and V (rank,d2)
+    """
+    if rank is None or rank >= min(d1,d2):
+        return [add_param(W,(d1,d2),name=name)]
+    return [add_param(W,(d1,rank),name=name+'_U'),
+            add_param(V,(rank,d2),name=name+'_V')]
+
+def factored_dot(X,Ws):
+    for W in Ws:
+        X = T.dot(X,W)
+    return X
+
+
+class CoupledBlockDenseLayer(lasagne.layers.base.Layer):
+    """
+    block-diagonal version of CoupledDenseLayer: the input is cut into 
+    blocks (e.g. one block per primary net layer) and, within each block, 
+    the first half conditions the second half through its own num_units 
+    hidden units. if rank is not None, the conditioner matrices of each 
+    block are factored with the given rank.
+    
+    blocks smaller than 2 are merged with their neighbour.
+    """
+    def __init__(self, incoming, num_units, block_sizes=None, rank=None,
+                 W=init.Normal(0.0001), V=init.Normal(0.01),
+                 b=init.Constant(0.), nonlinearity=nonlinearities.rectify,
+                 **kwargs):
+        super(CoupledBlockDenseLayer, self).__init__(incoming, **kwargs)
+        self.nonlinearity = (nonlinearities.identity if nonlinearity is None
+                             else nonlinearity)
+        
+        self.num_units = num_units
+        self.rank = rank
+        
+        num_inputs = self.input_shape[1]
+        if block_sizes is None:
+            block_sizes = [num_inputs,]
+        if sum(block_sizes) != num_inputs:
+            raise ValueError("mismatch: block sizes sum to %d for %d inputs" %
+                             (sum(block_sizes), num_inputs))
+        sizes = list()
+        for size in block_sizes:
+            if size < 2 and len(sizes):
+                sizes[-1] += size
+            else:
+                sizes.append(size)
+        if sizes[0] < 2 and len(sizes) > 1:
+            sizes[1] += sizes.pop(0)
+        self.block_sizes = sizes
+        
+        self.P = list()
+        for k, size in enumerate(sizes):
+            num_inputs1 = size // 2
+            num_inputs2 = size - num_inputs1
+            P = dict()
+            P['W1'] = get_factored_weight(self.add_param,W,V,
+                                          num_inputs1,num_units,rank,
+                                          'cpbd_W1_{}'.format(k))
+            P['W21'] = get_factored_weight(self.add_param,W,V,
+                                           num_units,num_inputs2,rank,
+                                           'cpbd_W21_{}'.format(k))
+            P['W22'] = get_factored_weight(self.add_param,W,V,
+                                           num_units,num_inputs2,rank,
+                                           'cpbd_W22_{}'.format(k))
+            if b is None:
+                P['b1'] = P['b21'] = P['b22'] = None
+            else:
+                P['b1'] = self.add_param(b, (num_units,), 
+                                         name="cpbd_b1_{}".format(k),
+                                         regularizable=False)
+                P['b21'] = self.add_param(b, (num_inputs2,), 
+                                          name="cpbd_b21_{}".format(k),
+                                          regularizable=False)
+                P['b22'] = self.add_param(b, (num_inputs2,), 
+                                          name="cpbd_b22_{}".format(k),
+                                          regularizable=False)
+            self.P.append(P)
+            
+    def get_output_shape_for(self, input_shape):
+        return input_shape
+
+    def get_output_for(self, input, **kwargs):
+        outputs = list()
+        ls = 0
+        t = 0
+        for size, P in zip(self.block_sizes, self.P):
+            num_inputs1 = size // 2
+            input1 = input[:,t:t+num_inputs1]
+            input2 = input[:,t+num_inputs1:t+size]
+            
+            a = factored_dot(input1,P['W1'])
+            if P['b1'] is not None:
+                a = a + P['b1']
+            h = self.nonlinearity(a)
+            
+            s_ = factored_dot(h,P['W21'])
+            if P['b21'] is not None:
+                s_ = s_ + P['b21']
+            s = T.exp(s_) + 0.001
+            
+            m = factored_dot(h,P['W22'])
+            if P['b22'] is not None:
+                m = m + P['b22']
+            
+            outputs += [input1, s * input2 + m]
+            ls += T.log(s).sum(1)
+            t += size
+        
+        return T.concatenate(outputs,1), ls
+
+
+class CoupledLowRankDenseLayer(CoupledBlockDenseLayer):
+    """
+    CoupledDenseLayer with the conditioner matrices factored as U*V, so 
+    the number of parameters grows as rank*(num_inputs+num_units) instead 
+    of num_inputs*num_units
+    """
+    def __init__(self, incoming, num_units, rank=16, **kwargs):
+        super(CoupledLowRankDenseLayer, self).__init__(incoming, num_units,
+                                                       block_sizes=None,
+                                                       rank=rank,
+                                                       **kwargs)
+
+
 def get_wn_params(P,add_param,specs,name,d1,d2):
     u,g,b = specs
     P['u_{}'.format(name)] = add_param(u,(d1,d2))   
@@ -216,22 +343,14 @@ class IAFDenseLayer(lasagne.layers.base.Layer):
         self.num_units = num_units
         
         
-        aux_input = T.matrix()
         masks = list()      
         P = dict()
         name = 'iaf'
         for l in range(L):
-            made = MADE(aux_input,incoming.input_shape[1],
-                        hidden_sizes=[num_units,]*num_hids,
-                        hidden_activation=None,
-                        random_seed=1234+l)
-            
-            
-            made.shuffle('Once')
-            made.shuffle('Full')
-            
-            # saving the masks generated by `MADE`
-            masks.append([m.get_value() for m in made.masks])
+            # masks of a MADE with a random ordering (drawn in numpy)
+            masks.append(get_made_masks(self.input_shape[1],
+                                        [num_units,]*num_hids,
+                                        random_seed=1234+l))
             # initializing parameters, 
             # # last one is mean
             for h,m in enumerate(masks[l]):
@@ -317,7 +436,11 @@ class IAFDenseLayer(lasagne.layers.base.Layer):
         
 class CoupledConv1DLayer(lasagne.layers.base.Layer):
     """
-    shape[1] should be even number
+    coupling layer whose conditioner is a 1D convolution over the feature
+    axis, so the number of parameters does not grow with shape[1].
+    filter_size should be odd (the convolutions keep the length).
+    the batch axis is never used statically, so any number of hypernet
+    samples can be pushed through the layer.
     """
     def __init__(self, incoming, num_units, filter_size,
                  W=init.GlorotUniform(),
@@ -326,6 +449,9 @@ class CoupledConv1DLayer(lasagne.layers.base.Layer):
         super(CoupledConv1DLayer, self).__init__(incoming, **kwargs)
         self.nonlinearity = (nonlinearities.identity if nonlinearity is None
                              else nonlinearity)
+        if filter_size % 2 != 1:
+            raise ValueError("CoupledConv1DLayer needs an odd filter_size, "
+                             "got %d" % filter_size)
         self.filter_size = filter_size
         self.num_units = num_units
         self.flip_filters = flip_filters
@@ -363,43 +489,48 @@ class CoupledConv1DLayer(lasagne.layers.base.Layer):
         W21_shape = (1,num_units,filter_size)
         W22_shape = (1,num_units,filter_size)
         num_inputs = self.input_shape[1]
-        input1 = input[:,:num_inputs/2]
-        input2 = input[:,num_inputs/2:]
+        num_inputs1 = num_inputs // 2
+        num_inputs2 = num_inputs - num_inputs1
+        input1 = input[:,:num_inputs1]
+        input2 = input[:,num_inputs1:]
         output1 = input1
         
-        input_shape = self.input_shape 
-        input1_shape = (input_shape[0], 1, num_inputs/2)
-        h_shape = (input_shape[0], num_units, num_inputs/2)
-        conved = self.convolution(input1.reshape((-1,1,num_inputs/2)), self.W1,
-                                  input1_shape, W1_shape,
-                                  subsample=(1,),
-                                  border_mode=border_mode,
-                                  filter_flip=self.flip_filters)
+        # pad the conditioning half so that the conv output matches input2
+        if num_inputs2 != num_inputs1:
+            input1 = T.concatenate([input1,T.zeros_like(input1[:,:1])],1)
+        
+        input1_shape = (None, 1, num_inputs2)
+        h_shape = (None, num_units, num_inputs2)
+        a = self.convolution(input1.dimshuffle(0,'x',1), self.W1,
+                             input1_shape, W1_shape,
+                             subsample=(1,),
+                             border_mode=border_mode,
+                             filter_flip=self.flip_filters)
 
         if self.b1 is not None:
-            a = conved + self.b1.dimshuffle('x',0,'x')
+            a = a + self.b1.dimshuffle('x',0,'x')
         h = self.nonlinearity(a)
         
-        conved = self.convolution(h, self.W21,
-                                  h_shape, W21_shape,
-                                  subsample=(1,),
-                                  border_mode=border_mode,
-                                  filter_flip=self.flip_filters)
+        s_ = self.convolution(h, self.W21,
+                              h_shape, W21_shape,
+                              subsample=(1,),
+                              border_mode=border_mode,
+                              filter_flip=self.flip_filters)
         
         if self.b21 is not None:
-            s_ = conved + self.b21.dimshuffle('x',0,'x')
-        s = T.nnet.softplus(s_).reshape((-1,num_inputs/2)) + delta
+            s_ = s_ + self.b21.dimshuffle('x',0,'x')
+        s = T.nnet.softplus(s_[:,0,:]) + delta
         ls = T.log(s)
         
-        conved = self.convolution(h, self.W22,
-                                  h_shape, W22_shape,
-                                  subsample=(1,),
-                                  border_mode=border_mode,
-                                  filter_flip=self.flip_filters)
+        m = self.convolution(h, self.W22,
+                             h_shape, W22_shape,
+                             subsample=(1,),
+                             border_mode=border_mode,
+                             filter_flip=self.flip_filters)
         
         if self.b22 is not None:
-            m = conved + self.b22.dimshuffle('x',0,'x')
-        m = m.reshape((-1,num_inputs/2))
+            m = m + self.b22.dimshuffle('x',0,'x')
+        m = m[:,0,:]
         
         output2 = s * input2 + m
         output = T.concatenate([output1,output2],1)
@@ -463,6 +594,26 @@ class ConvexBiasLayer(lasagne.layers.base.Layer):
         return output, (T.ones_like(input)*T.log(s)).sum(1)
 
 
+class InputNormLayer(lasagne.layers.Layer):
+    """
+    casts the input (e.g. uint8 images) to floatX inside the graph, then
+    scales and centers it:  cast(input) * scale - mean
+    mean: None, or an array broadcastable to the shape of one example
+    """
+    def __init__(self, incoming, scale=1., mean=None, **kwargs):
+        super(InputNormLayer, self).__init__(incoming, **kwargs)
+        self.scale = scale
+        self.mean = mean
+        
+    def get_output_for(self, input, **kwargs):
+        output = T.cast(input, floatX)
+        if self.scale != 1:
+            output = output * np.cast[floatX](self.scale)
+        if self.mean is not None:
+            output = output - np.cast[floatX](self.mean)
+        return output
+
+
 class IndexLayer(lasagne.layers.Layer):
     """
     Return the given index of input tuple
@@ -521,6 +672,23 @@ class PermuteLayer(lasagne.layers.Layer):
         slc[self.axis] = self.indices
         return input[slc]
 
+class BlockPermuteLayer(PermuteLayer):
+    """
+    permute the features within each block only (see CoupledBlockDenseLayer)
+    """
+    def __init__(self, incoming, block_sizes, axis=-1, **kwargs):
+        num_units = sum(block_sizes)
+        super(BlockPermuteLayer, self).__init__(incoming, num_units, axis,
+                                                **kwargs)
+        indices = np.arange(num_units)
+        while max(block_sizes) > 1 and \
+              np.all(indices == np.arange(num_units)):
+            t = 0
+            for size in block_sizes:
+                indices[t:t+size] = t + np.random.permutation(size)
+                t += size
+        self.indices = indices
+
 class SplitLayer(lasagne.layers.Layer):
     
     def __init__(self,incoming, index, axis=-1, **kwargs):
@@ -788,6 +956,10 @@ class WeightNormLayer(lasagne.layers.Layer):
             self.g = g
         elif g is not None:
             self.g = self.add_param(g, (k,), name="g")
+        # a (batch_size, k) g holds one scale per example (e.g. one weight 
+        # sample per example): rescale the outputs instead of the weights
+        self.per_example = type(g) == tv and g.ndim == 2 and \
+                           not g.broadcastable[0]
         if len(self.input_shape)==4:
             self.axes_to_sum = (0,2,3)
             self.dimshuffle_args = ['x',0,'x','x']
@@ -804,12 +976,17 @@ class WeightNormLayer(lasagne.layers.Layer):
         else:
             W_axes_to_sum = 0
             W_dimshuffle_args = ['x',0]
-        if g is not None:
+        if g is not None and not self.per_example:
             incoming.W = self.g * incoming.W_param / T.sqrt(T.sum(T.square(incoming.W_param),axis=W_axes_to_sum)).dimshuffle(*W_dimshuffle_args)
         else:
             incoming.W = incoming.W_param / T.sqrt(T.sum(T.square(incoming.W_param),axis=W_axes_to_sum,keepdims=True))        
 
     def get_output_for(self, input, init=False, **kwargs):
+        if self.per_example:
+            if input.ndim == 4:
+                input = input * self.g.dimshuffle(0,1,'x','x')
+            else:
+                input = input * self.g
         if init:
             m = T.mean(input, self.axes_to_sum)
             input -= m.dimshuffle(*self.dimshuffle_args)
@@ -838,6 +1015,238 @@ def stochastic_weight_norm(layer, weight, bias=None, **kwargs):
     return layer_out
 
 
+# stacked models: n_models independent sets of params with a leading model 
+# axis, so that the (small) dots of the models become batched dots
+
+def stacked_weightnormdot(X,W,g,b,nonl=None):
+    """
+    X: (n_models,n,d1), or (n_models,d1) 
+    W: (n_models,d1,d2), g and b: (n_models,d2)
+    """
+    norm = T.sqrt(T.sum(T.square(W),axis=1,keepdims=True))
+    W_normed = W / norm * g.dimshuffle(0,'x',1)
+    if X.ndim == 3:
+        b = b.dimshuffle(0,'x',1)
+    h = T.batched_dot(X,W_normed) + b
+    if nonl is not None:
+        return nonl(h)
+    else:
+        return h
+
+def get_stacked_wn_params(P,add_param,specs,name,n_models,d1,d2):
+    u,g,b = specs
+    P['u_{}'.format(name)] = add_param(u,(n_models,d1,d2))   
+    P['g_{}'.format(name)] = add_param(g,(n_models,d2))     
+    P['b_{}'.format(name)] = add_param(b,(n_models,d2),
+                                       regularizable=False)        
+
+
+class StackedLinearFlowLayer(lasagne.layers.base.Layer):    
+    """
+    LinearFlowLayer with one scale and shift per model: 
+    input of shape (n_models,num_inputs)
+    """
+    def __init__(self, incoming, W=init.Normal(0.01,-7),
+                 b=init.Normal(0.01,0),
+                 **kwargs):
+        super(StackedLinearFlowLayer, self).__init__(incoming, **kwargs)
+        
+        n_models, num_inputs = self.input_shape
+
+        self.W = self.add_param(W, (n_models,num_inputs), name="lf_W")
+        if b is None:
+            self.b = None
+        else:
+            self.b = self.add_param(b, (n_models,num_inputs), name="lf_b",
+                                    regularizable=False)
+            
+    def get_output_shape_for(self, input_shape):
+        return input_shape
+
+    def get_output_for(self, input, **kwargs):
+        s = T.exp(self.W) + delta
+        output = input * s
+        if self.b is not None:
+            output = output + self.b
+        
+        return output, T.log(s).sum(1)
+
+
+class StackedCoupledDenseLayer(lasagne.layers.base.Layer):    
+    """
+    CoupledDenseLayer with one conditioner per model: 
+    input of shape (n_models,num_inputs)
+    """
+    def __init__(self, incoming, num_units, W=init.Normal(0.0001),
+                 b=init.Constant(0.), nonlinearity=nonlinearities.rectify,
+                 **kwargs):
+        super(StackedCoupledDenseLayer, self).__init__(incoming, **kwargs)
+        self.nonlinearity = (nonlinearities.identity if nonlinearity is None
+                             else nonlinearity)
+
+        self.num_units = num_units
+
+        n_models = self.input_shape[0]
+        num_inputs1 = int(self.input_shape[1]/2)
+        num_inputs2 = self.input_shape[1] - num_inputs1
+
+        self.W1 = self.add_param(W, (n_models, num_inputs1, num_units), 
+                                 name="cpds_W1")
+        self.W21 = self.add_param(W, (n_models, num_units, num_inputs2), 
+                                  name="cpds_W21")
+        self.W22 = self.add_param(W, (n_models, num_units, num_inputs2), 
+                                  name="cdds_W22")
+        if b is None:
+            self.b1 = None
+            self.b21 = None
+            self.b22 = None
+        else:
+            self.b1 = self.add_param(b, (n_models, num_units), 
+                                     name="cpds_b1", regularizable=False)
+            self.b21 = self.add_param(b, (n_models, num_inputs2), 
+                                      name="cpds_b21", regularizable=False)
+            self.b22 = self.add_param(b, (n_models, num_inputs2), 
+                                      name="cpds_b22", regularizable=False)
+            
+    def get_output_shape_for(self, input_shape):
+        return input_shape
+
+    def get_output_for(self, input, **kwargs):
+        num_inputs = input.shape[1]
+        input1 = input[:,:num_inputs/2]
+        input2 = input[:,num_inputs/2:]
+        output1 = input1
+        
+        a = T.batched_dot(input1,self.W1)
+        if self.b1 is not None:
+            a = a + self.b1
+        h = self.nonlinearity(a)
+        
+        s_ = T.batched_dot(h,self.W21)
+        if self.b21 is not None:
+            s_ = s_ + self.b21
+        s = T.exp(s_) + 0.001
+        ls = T.log(s)
+        
+        m = T.batched_dot(h,self.W22)
+        if self.b22 is not None:
+            m = m + self.b22
+            
+        output2 = s * input2 + m
+        output = T.concatenate([output1,output2],1)
+        
+        return output, ls.sum(1)
+
+
+class StackedIAFDenseLayer(lasagne.layers.base.Layer):    
+    """
+    IAFDenseLayer (without cond_bias) with one set of MADEs per model, the 
+    masks being shared by the models: input of shape (n_models,num_inputs)
+    """
+    def __init__(self, incoming, num_units, 
+                 num_hids=1, L=1,
+                 W=init.Normal(0.0001),
+                 r=init.Normal(0.0001),
+                 b=init.Constant(0.), nonlinearity=nonlinearities.rectify,
+                 **kwargs):
+        super(StackedIAFDenseLayer, self).__init__(incoming, **kwargs)
+        self.nonlinearity = (nonlinearities.identity if nonlinearity is None
+                             else nonlinearity)
+        self.num_units = num_units
+        
+        n_models = self.input_shape[0]
+        masks = list()      
+        P = dict()
+        name = 'iaf'
+        for l in range(L):
+            masks.append(get_made_masks(self.input_shape[1],
+                                        [num_units,]*num_hids,
+                                        random_seed=1234+l))
+            # # last one is mean
+            for h,m in enumerate(masks[l]):
+                d1,d2 = m.shape
+                get_stacked_wn_params(P,self.add_param,[W,r,b],
+                                      '{}_l{}h{}'.format(name,l,h),
+                                      n_models,d1,d2)
+            # # std
+            get_stacked_wn_params(P,self.add_param,[W,r,b],
+                                  '{}_l{}h{}s'.format(name,l,h),
+                                  n_models,d1,d2)
+        
+        self.P = P
+        self.num_hids = num_hids
+        self.L = L
+        self.masks = masks
+        
+    def get_output_shape_for(self, input_shape):
+        return input_shape
+
+    def get_output_for(self, input, **kwargs):
+        zs = list()
+        zs.append(input)
+        ss = T.zeros((input.shape[0],)) # logdet jacobian
+        
+        P = self.P
+        nonl = self.nonlinearity
+        name = 'iaf'
+        
+        for l in range(self.L):
+            hidden = zs[l]
+            for h in range(self.num_hids+1):
+                mask = self.masks[l][h]
+                u = P['u_{}_l{}h{}'.format(name,l,h)]
+                g = P['g_{}_l{}h{}'.format(name,l,h)]
+                b = P['b_{}_l{}h{}'.format(name,l,h)]
+                u_ = T.switch(mask.reshape((1,)+mask.shape),u,0)
+                if h != self.num_hids:
+                    hidden = stacked_weightnormdot(hidden,u_,g,b,nonl=nonl)
+                else:
+                    mean = stacked_weightnormdot(hidden,u_,g,b,nonl=None)
+            
+            u = P['u_{}_l{}h{}s'.format(name,l,h)]
+            g = P['g_{}_l{}h{}s'.format(name,l,h)]
+            b = P['b_{}_l{}h{}s'.format(name,l,h)]
+            u_ = T.switch(mask.reshape((1,)+mask.shape),u,0)
+            std = stacked_weightnormdot(hidden,u_,g,b,nonl=exp)
+            
+            z = mean + std * zs[l]
+            zs.append(z)
+            ss += T.sum(T.log(std),1)
+        
+        return z, ss
+
+
+class StackedWeightNormDenseLayer(lasagne.layers.base.Layer):
+    """
+    dense layer of the stacked primary nets, 
+    input of shape (n_models,batch_size,num_inputs): 
+        W is normalized per (model, unit) and rescaled by g, the 
+        (n_models,num_units) output of the hypernets
+    """
+    def __init__(self, incoming, num_units, g,
+                 W=lasagne.init.Normal(0.05),
+                 b=lasagne.init.Constant(0.), 
+                 nonlinearity=nonlinearities.rectify,
+                 **kwargs):
+        super(StackedWeightNormDenseLayer, self).__init__(incoming, **kwargs)
+        self.nonlinearity = (nonlinearities.identity if nonlinearity is None
+                             else nonlinearity)
+        self.num_units = num_units
+        n_models, num_inputs = self.input_shape[0], self.input_shape[2]
+        self.W = self.add_param(W, (n_models,num_inputs,num_units), name="W")
+        self.b = self.add_param(b, (n_models,num_units), name="b",
+                                regularizable=False)
+        self.g = g
+    
+    def get_output_shape_for(self, input_shape):
+        return input_shape[:2] + (self.num_units,)
+    
+    def get_output_for(self, input, **kwargs):
+        return stacked_weightnormdot(input,self.W,self.g,self.b,
+                                     nonl=self.nonlinearity)
+
+
+
         
         
 # new BHN with WN/BN
@@ -869,6 +1278,27 @@ def NVP_dense_layer(incoming,
                     
     return layer, logdets_layers
 
+def NVP_conv_layer(incoming, 
+                   num_units=16,
+                   L=2,
+                   filter_size=5,
+                   W=init.GlorotUniform(),
+                   b=init.Constant(0.), 
+                   nonlinearity=nonlinearities.rectify):
+    
+    layer = incoming
+    shape = layer.output_shape[1]
+    logdets_layers = list()
+    
+    for c in range(L):
+       layer = PermuteLayer(layer,shape)
+       layer_temp = CoupledConv1DLayer(layer,num_units,filter_size,
+                                       W=W,b=b,nonlinearity=nonlinearity)
+       layer = IndexLayer(layer_temp,0)
+       logdets_layers.append(IndexLayer(layer_temp,1))
+                    
+    return layer, logdets_layers
+
 def IAF_dense_layer(incoming, 
                     num_units=200,
                     L=2,
@@ -917,6 +1347,9 @@ def hypernet(net,
         elif flow == 'IAF':
             layer, ld_layers = IAF_dense_layer(layer, hidden_size,
                                                layers, **kargs)        
+        elif flow == 'ConvNVP':
+            layer, ld_layers = NVP_conv_layer(layer, hidden_size,
+                                              layers, **kargs)
         logdets_layers = logdets_layers + ld_layers
         
     return layer, ElemwiseSumLayer(logdets_layers), output_size
@@ -1073,6 +1506,170 @@ def N_get_output(layer_or_layers, inputs, hnet, input_h,
         return all_outputs[layer_or_layers]
 
 
+def linear_output(layer, input):
+    """
+    output of a DenseLayer/Conv2DLayer before bias and nonlinearity
+    """
+    if isinstance(layer, Conv2DLayer):
+        return layer.convolve(input)
+    elif isinstance(layer, DenseLayer):
+        num_leading_axes = layer.num_leading_axes
+        if num_leading_axes < 0:
+            num_leading_axes += input.ndim
+        if input.ndim > num_leading_axes + 1:
+            input = input.flatten(num_leading_axes + 1)
+        return T.dot(input, layer.W)
+    else:
+        raise TypeError("cannot normalize layer %r" % layer)
+
+def weight_norm(layer):
+    """
+    norm of the weight vector of each unit/filter of layer, broadcastable
+    against its output
+    """
+    W = layer.W
+    if W.ndim == 4:
+        return T.sqrt(T.sum(T.square(W),axis=(1,2,3))).dimshuffle('x',0,'x','x')
+    else:
+        return T.sqrt(T.sum(T.square(W),axis=0)).dimshuffle('x',0)
+
+def conditional_norm_outputs(layer_or_layers, inputs, hnet, input_h,
+                             norm_type='BN', static_bias=None, nlb=nlb,
+                             **kwargs):
+    """
+    same conditional normalization as N_get_output (the output of each 
+    layer selected by nlb is normalized, rescaled and shifted by the 
+    hypernet), but:
+        - the lasagne layers are left untouched (their biases are simply 
+          not used), so this can be called on any network, several times
+        - the normalization layers are built once, and the train and test
+          outputs are returned together (test: deterministic, and BN 
+          running averages, which the train output updates)
+        - input_h can hold several hypernet samples (one per row): the 
+          inputs are replicated along the batch axis, and the outputs have 
+          shape (n_samples*batch_size, ...), sample-major.
+    
+    returns train output(s), test output(s), and the params of the primary 
+    net that are actually used
+    """
+    kwargs.pop('deterministic', None)
+    
+    treat_as_input = inputs.keys() if isinstance(inputs, dict) else []
+    all_layers = get_all_layers(layer_or_layers, treat_as_input)
+    input_exprs = dict((layer, layer.input_var)
+                       for layer in all_layers
+                       if isinstance(layer, InputLayer) and
+                       layer not in treat_as_input)
+    if isinstance(inputs, dict):
+        input_exprs.update((layer, utils.as_theano_expression(expr))
+                           for layer, expr in inputs.items())
+    elif inputs is not None:
+        if len(input_exprs) > 1:
+            raise ValueError("conditional_norm_outputs() was called with a "
+                             "single input expression on a network with "
+                             "multiple input layers. Please call it with a "
+                             "dictionary of input expressions instead.")
+        for input_layer in input_exprs:
+            input_exprs[input_layer] = utils.as_theano_expression(inputs)
+    
+    N_params = lasagne.layers.get_output(hnet,input_h)
+    n_samples = N_params.shape[0]
+    batch_size = list(input_exprs.values())[0].shape[0]
+    
+    def replicate(x):
+        shape = [x.shape[i] for i in range(x.ndim)]
+        x = T.alloc(x, n_samples, *shape)
+        return x.reshape([n_samples*shape[0],]+shape[1:], ndim=len(shape))
+    
+    train_outputs = dict((layer, replicate(expr)) 
+                         for layer, expr in input_exprs.items())
+    test_outputs = dict(train_outputs)
+    
+    index = 0
+    if static_bias is not None:
+        index_b = 0
+        if static_bias.ndim == 1:
+            static_bias = static_bias.dimshuffle('x',0)
+    
+    params = list()
+    for layer in all_layers:
+        if layer in train_outputs:
+            continue
+        
+        if isinstance(layer, MergeLayer):
+            train_input = [train_outputs[l] for l in layer.input_layers]
+            test_input = [test_outputs[l] for l in layer.input_layers]
+        else:
+            train_input = train_outputs[layer.input_layer]
+            test_input = test_outputs[layer.input_layer]
+        
+        if not isinstance(layer, ElemwiseSumLayer) and nlb(layer):
+            nonlinearity = getattr(layer, 'nonlinearity', None)
+            if nonlinearity is None:
+                nonlinearity = nonlinearities.identity
+            
+            train_output = linear_output(layer, train_input)
+            if test_input is train_input:
+                test_output = train_output
+            else:
+                test_output = linear_output(layer, test_input)
+            
+            if norm_type == 'BN':
+                N_layer = BatchNormLayer(layer,beta=None,gamma=None)
+                train_output = N_layer.get_output_for(train_output, 
+                                                      deterministic=False)
+                test_output = N_layer.get_output_for(test_output, 
+                                                     deterministic=True)
+            elif norm_type == 'WN':
+                # rectified, as by the default nonlinearity of the 
+                # WeightNormLayer N_get_output puts there
+                norm = weight_norm(layer)
+                train_output = nonlinearities.rectify(train_output / norm)
+                test_output = nonlinearities.rectify(test_output / norm)
+            else:
+                raise Exception('normalization method {} not ' \
+                                'supported.'.format(norm_type))
+            
+            size = layer.output_shape[1]
+            gamma, index = slicing(N_params,index,size)
+            gamma = gamma.repeat(batch_size,axis=0)
+            if static_bias is None:
+                beta, index = slicing(N_params,index,size)
+                beta = beta.repeat(batch_size,axis=0)
+            else:
+                beta, index_b = slicing(static_bias,index_b,size)
+            if len(layer.output_shape) == 4:
+                gamma = gamma.dimshuffle(0,1,'x','x')
+                beta = beta.dimshuffle(0,1,'x','x')
+            
+            train_outputs[layer] = nonlinearity(gamma * train_output + beta)
+            test_outputs[layer] = nonlinearity(gamma * test_output + beta)
+            bias = getattr(layer, 'b', None)
+            params += [p for p in layer.get_params(trainable=True) 
+                       if p is not bias]
+        else:
+            train_outputs[layer] = layer.get_output_for(train_input, 
+                                                        deterministic=False,
+                                                        **kwargs)
+            test_outputs[layer] = layer.get_output_for(test_input, 
+                                                       deterministic=True,
+                                                       **kwargs)
+            params += layer.get_params(trainable=True)
+    
+    hs = hnet.output_shape[1]
+    errmsg = 'mismatch: hnet output ({}) cbn params ({})'.format(hs,index)
+    assert hs == index, errmsg
+    
+    try:
+        return ([train_outputs[layer] for layer in layer_or_layers],
+                [test_outputs[layer] for layer in layer_or_layers],
+                params)
+    except TypeError:
+        return (train_outputs[layer_or_layers], 
+                test_outputs[layer_or_layers],
+                params)
+
+
 def get_elbo(pred,
              targ,
              weights,
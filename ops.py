@@ -7,84 +7,151 @@ Created on Fri May 12 22:54:50 2017
 """
 
 
+import os
 import cPickle as pickle
 import gzip
 import numpy as np
 floatX = 'float32'
 
-def onehot(labels, n_classes=10):
-    rval = np.zeros((len(labels), n_classes))
-    for n, label in enumerate(labels):
-        rval[n, label] == 1
-    return rval
+from dataset_cache import get_cache_dir, cached, OneHotView
+from encoding import onehot, to_labels
 
 
-def load_mnist(filename):
+def _labels(y, n_classes, one_hot):
+    """ float one-hot rows, or int32 labels """
+    if one_hot:
+        return onehot(y, n_classes)
+    return to_labels(y)
+
+
+def _label_views(y, n_classes, one_hot):
+    if one_hot:
+        return OneHotView(y, n_classes)
+    return y
+
+
+def _read_mnist(filename):
     try:
         tr,va,te = pickle.load(gzip.open('mnist.pkl.gz','r'))
     except:
         tr,va,te = pickle.load(gzip.open(filename,'r'))
-    tr_x,tr_y = tr
-    va_x,va_y = va
-    te_x,te_y = te
+    return dict(train=tr, valid=va, test=te)
+
+
+def _views(data, lazy):
+    """ the cached views, or the float32 arrays (int32 for int labels) """
+    if lazy:
+        return data
+    return [np.asarray(d[:], dtype='int32' if np.dtype(d.dtype).kind in 'iu'
+                       else floatX) for d in data]
+
+
+def load_mnist(filename, cache_dir=None, lazy=False, one_hot=True):
+    """
+    cache_dir: (or $DATA_CACHE) read from the binary cache of 
+    dataset_cache.py, built on first use
+    lazy: with the cache, return ImageView/OneHotView instead of arrays
+    one_hot: one-hot float targets, or int32 labels (int_targets models)
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is not None:
+        splits = cached('mnist', lambda: _read_mnist(filename), cache_dir)
+        data = list()
+        for split in ['train', 'valid', 'test']:
+            x, y = splits[split]
+            data += [x, _label_views(y, 10, one_hot)]
+        return _views(data, lazy)
+
+    splits = _read_mnist(filename)
+    tr_x,tr_y = splits['train']
+    va_x,va_y = splits['valid']
+    te_x,te_y = splits['test']
     print tr_y.shape
-    # doesn't work on hades :/ 
-    try:
-        from sklearn.preprocessing import OneHotEncoder
-        enc = OneHotEncoder(10)
-        tr_y = enc.fit_transform(tr_y.reshape((-1,1))).toarray().reshape(50000,10).astype(int)
-        va_y = enc.fit_transform(va_y.reshape((-1,1))).toarray().reshape(10000,10).astype(int)    
-        te_y = enc.fit_transform(te_y.reshape((-1,1))).toarray().reshape(10000,10).astype(int)
-    except:
-        tr_y = onehot(tr_y)
-        va_y = onehot(va_y)
-        te_y = onehot(te_y)
+    tr_y, va_y, te_y = [_labels(y, 10, one_hot) for y in [tr_y, va_y, te_y]]
     f = lambda d:d.astype(floatX) 
-    return (f(d) for d in [tr_x, tr_y, va_x, va_y, te_x, te_y])
+    return (f(tr_x), tr_y, f(va_x), va_y, f(te_x), te_y)
     
 
-def load_cifar10(filename,val=0.1,seed=1000):
+def _read_cifar10(filename):
     tr_x, tr_y, te_x, te_y = pickle.load(open(filename,'r'))
-    enc = OneHotEncoder(10)
-    tr_y = enc.fit_transform(tr_y).toarray().reshape(50000,10).astype(int)
-    te_y = enc.fit_transform(te_y).toarray().reshape(10000,10).astype(int)
-    
-    n = tr_x.shape[0]
+    return dict(train=(tr_x,tr_y), test=(te_x,te_y))
+
+
+def _cache_name(filename):
+    return os.path.basename(filename).replace('.','_')
+
+
+def split_valid(n,val=0.1,seed=1000):
     trn_ind = set(range(n))
     rng = np.random.RandomState(seed)
     val_ind = rng.choice(n,int(n*val),False)
     trn_ind = np.array(list(trn_ind.difference(val_ind)))
+    return trn_ind, val_ind
+
+
+def load_cifar10(filename,val=0.1,seed=1000,cache_dir=None,lazy=False,
+                 one_hot=True):
+    """
+    cache_dir, lazy, one_hot: see load_mnist
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is not None:
+        splits = cached(_cache_name(filename),
+                        lambda: _read_cifar10(filename), cache_dir)
+        (tr_x, tr_y), (te_x, te_y) = splits['train'], splits['test']
+        trn_ind, val_ind = split_valid(len(tr_x),val,seed)
+        return _views([tr_x.take(trn_ind), _label_views(tr_y[trn_ind],10,one_hot),
+                       tr_x.take(val_ind), _label_views(tr_y[val_ind],10,one_hot),
+                       te_x, _label_views(te_y,10,one_hot)], lazy)
+
+    tr_x, tr_y, te_x, te_y = pickle.load(open(filename,'r'))
+    tr_y = _labels(tr_y, 10, one_hot)
+    te_y = _labels(te_y, 10, one_hot)
+    
+    trn_ind, val_ind = split_valid(tr_x.shape[0],val,seed)
     tr_x, tr_y, va_x, va_y = tr_x[trn_ind], tr_y[trn_ind], \
                              tr_x[val_ind], tr_y[val_ind]
                              
     f = lambda d:d.astype(floatX) 
-    return (f(d) for d in [tr_x, tr_y, va_x, va_y, te_x, te_y])
+    return (f(tr_x), tr_y, f(va_x), va_y, f(te_x), te_y)
 
 
 def get_index(vec,key):
     return np.arange(vec.shape[0])[key(vec)]
 
-def load_cifar5(filename,val=0.1,seed=1000):
+def load_cifar5(filename,val=0.1,seed=1000,cache_dir=None,lazy=False,
+                one_hot=True):
+    """
+    cache_dir, lazy, one_hot: see load_mnist
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is not None:
+        splits = cached(_cache_name(filename),
+                        lambda: _read_cifar10(filename), cache_dir)
+        (tr_x, tr_y), (te_x, te_y) = splits['train'], splits['test']
+        tr_ind  = get_index(tr_y,lambda y:y<=4)
+        te_ind  = get_index(te_y,lambda y:y<=4)
+        tr_x, tr_y = tr_x.take(tr_ind), tr_y[tr_ind]
+        te_x, te_y = te_x.take(te_ind), te_y[te_ind]
+        trn_ind, val_ind = split_valid(len(tr_x),val,seed)
+        return _views([tr_x.take(trn_ind), _label_views(tr_y[trn_ind],5,one_hot),
+                       tr_x.take(val_ind), _label_views(tr_y[val_ind],5,one_hot),
+                       te_x, _label_views(te_y,5,one_hot)], lazy)
+
     tr_x, tr_y, te_x, te_y = pickle.load(open(filename,'r'))
     tr_ind  = get_index(tr_y.flatten(),lambda y:y<=4)
     te_ind  = get_index(te_y.flatten(),lambda y:y<=4)
     tr_x, tr_y = tr_x[tr_ind], tr_y[tr_ind]
     te_x, te_y = te_x[te_ind], te_y[te_ind]
-    enc = OneHotEncoder(5)
-    tr_n, te_n = tr_x.shape[0], te_x.shape[0]
-    tr_y = enc.fit_transform(tr_y).toarray().reshape(tr_n,5).astype(int)
-    te_y = enc.fit_transform(te_y).toarray().reshape(te_n,5).astype(int)
+    tr_y = _labels(tr_y, 5, one_hot)
+    te_y = _labels(te_y, 5, one_hot)
     
-    n = tr_x.shape[0]
-    trn_ind = set(range(n))
-    rng = np.random.RandomState(seed)
-    val_ind = rng.choice(n,int(n*val),False)
-    trn_ind = np.array(list(trn_ind.difference(val_ind)))
+    trn_ind, val_ind = split_valid(tr_x.shape[0],val,seed)
     tr_x, tr_y, va_x, va_y = tr_x[trn_ind], tr_y[trn_ind], \
                              tr_x[val_ind], tr_y[val_ind]
                                  
     f = lambda d:d.astype(floatX) 
-    return (f(d) for d in [tr_x, tr_y, va_x, va_y, te_x, te_y])
+    return (f(tr_x), tr_y, f(va_x), va_y, f(te_x), te_y)
 
 
 
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Background prefetching of minibatches: a worker thread fills a bounded queue
+while the main thread runs the compiled theano functions (numpy slicing and
+the theano calls release the GIL for most of their time).
+"""
+
+import sys
+import threading
+import Queue
+import numpy as np
+
+
+_end = object()
+
+class _Error(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class Prefetcher(object):
+    """
+    iterates over `iterator` in a worker thread, at most max_queue items
+    ahead; exceptions of the worker are raised in the main thread.
+
+        for x, y in Prefetcher(minibatches(...)):
+            train_func(x, y, ...)
+    """
+
+    def __init__(self, iterator, max_queue=4):
+        self.queue = Queue.Queue(max_queue)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._work, args=(iterator,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _work(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return
+        except Exception:
+            self._put(_Error(sys.exc_info()))
+            return
+        self._put(_end)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item = self.queue.get()
+        if item is _end:
+            raise StopIteration
+        if isinstance(item, _Error):
+            etype, value, tb = item.exc_info
+            raise etype, value, tb
+        return item
+
+    def close(self):
+        """ 
+        stops the worker (when not iterating until the end):
+            batches = Prefetcher(...)
+            try:
+                for x, y in batches: ...
+            finally:
+                batches.close()
+        """
+        self.stop.set()
+        self.thread.join()
+
+
+def memmap_minibatches(X, Y, inds, bs, window=2**16, transform=None,
+                       rng=np.random):
+    """
+    one epoch of float32 minibatches of X[inds], Y[inds], for X and Y
+    (possibly memory-mapped) too large to be shuffled in memory:
+    inds are read in sorted windows of ~`window` rows, so that reads are
+    mostly sequential, the windows in a random order, and the minibatches
+    are shuffled within each window. Only one window is in memory at a time.
+
+    transform(x, y) -> x, y  is applied to each window (e.g. normalization)
+    """
+    window = max(window // bs, 1) * bs
+    inds = np.sort(inds)
+    starts = np.arange(0, len(inds), window)
+    rng.shuffle(starts)
+    for s in starts:
+        w = inds[s:s+window]
+        x = np.asarray(X[w], dtype='float32')
+        y = np.asarray(Y[w], dtype='float32')
+        if transform is not None:
+            x, y = transform(x, y)
+        perm = rng.permutation(len(w))
+        # the last incomplete minibatch of a window is dropped
+        for j in range(0, len(w) - bs + 1, bs):
+            p = perm[j:j+bs]
+            yield x[p], y[p]
+
+
+def minibatches(X, Y, bs, shuffle=False, drop_last=True, augment=None,
+                dtype=None, rng=np.random):
+    """
+    one epoch of minibatches (x, y) of X, Y, in order or shuffled.
+    with drop_last the last incomplete minibatch is dropped, as in the
+    `for i in range(N/bs)` loops of the training functions.
+
+    augment(x, y) -> x, y  is applied to each minibatch, then x and y are 
+    cast to dtype (if not None)
+    """
+    N = X.shape[0]
+    n = N // bs if drop_last else N // bs + int(N % bs > 0)
+    if shuffle:
+        inds = rng.permutation(N)
+    for i in range(n):
+        if shuffle:
+            x = X[inds[i*bs:(i+1)*bs]]
+            y = Y[inds[i*bs:(i+1)*bs]]
+        else:
+            x = X[i*bs:(i+1)*bs]
+            y = Y[i*bs:(i+1)*bs]
+        if augment is not None:
+            x, y = augment(x, y)
+        if dtype is not None:
+            x = np.asarray(x, dtype=dtype)
+            y = np.asarray(y, dtype=dtype)
+        yield x, y
+
+
+def iterate_minibatches(X, Y, bs, prefetch=0, **kargs):
+    """
+    minibatches(X, Y, bs, **kargs), prepared by a worker thread up to 
+    `prefetch` minibatches ahead if prefetch > 0. The worker is stopped
+    when the loop ends, including on break or an exception.
+    """
+    batches = minibatches(X, Y, bs, **kargs)
+    if prefetch:
+        batches = Prefetcher(batches, max_queue=prefetch)
+    try:
+        for batch in batches:
+            yield batch
+    finally:
+        if prefetch:
+            batches.close()
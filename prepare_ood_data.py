@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+One-time, numpy-only conversion of the out-of-distribution benchmarks of
+dk_anomaly_detection.py (from hendrycks/error-detection) into data_dir:
+    not_mnist.npy     notMNIST test set, from notMNIST.pickle      (N, 784)
+    CIFAR10-bw.npy    CIFAR-10 test set, grayscale, bilinear resize
+                      to 28x28 (as tf.image.resize_images)         (N, 784)
+    omniglot.npy      Omniglot background characters of the safe
+                      alphabets, from data_background.mat, area
+                      resize to 28x28, uint8 0-255 (as imresize)   (N, 784)
+    manifest.json     shape, dtype and sha256 of each array
+Each dataset is converted in one batched pass (a pair of matrix products
+for the resize).
+
+    python prepare_ood_data.py --data_dir ./data
+    python prepare_ood_data.py --data_dir ./data --check
+"""
+
+import os
+import json
+import hashlib
+import cPickle as pickle
+import numpy as np
+
+
+names = ['not_mnist', 'CIFAR10-bw', 'omniglot']
+
+# alphabets of omniglot whose characters don't overlap with the digits
+safe_list = [0,2,5,6,8,12,13,14,15,16,17,18,19,21,26]
+
+# weights of tf.image.rgb_to_grayscale
+gray_weights = np.array([0.2989, 0.5870, 0.1140])
+
+
+def rgb_to_grayscale(x):
+    """ (..., 3) -> (...) """
+    return np.dot(x, gray_weights)
+
+
+def resize_matrix(n_in, n_out, method='bilinear'):
+    """
+    (n_out, n_in) matrix resizing an axis of length n_in to n_out
+        bilinear: as tf.image.resize_images (align_corners=False)
+        area:     average over the (fractional) input pixels covered
+    """
+    scale = n_in / float(n_out)
+    if method == 'bilinear':
+        src = np.arange(n_out) * scale
+        lo = np.floor(src).astype(int)
+        hi = np.minimum(lo + 1, n_in - 1)
+        frac = src - lo
+        R = np.zeros((n_out, n_in))
+        R[np.arange(n_out), lo] += 1 - frac
+        R[np.arange(n_out), hi] += frac
+    elif method == 'area':
+        start = np.arange(n_out)[:,None] * scale
+        j = np.arange(n_in)[None,:]
+        overlap = np.minimum(start + scale, j + 1) - np.maximum(start, j)
+        R = np.maximum(overlap, 0) / scale
+    else:
+        raise ValueError('no resize method `{}`'.format(method))
+    return R
+
+
+def resize(x, size, method='bilinear'):
+    """ resizes a batch of images (N, H, W) to (N,) + size """
+    Rh = resize_matrix(x.shape[1], size[0], method)
+    Rw = resize_matrix(x.shape[2], size[1], method)
+    return np.matmul(np.matmul(Rh, x), Rw.T)
+
+
+def convert_notmnist(data_dir):
+    with open(os.path.join(data_dir, 'notMNIST.pickle'), 'rb') as f:
+        save = pickle.load(f)
+    return save['test_dataset'].reshape((-1, 28 * 28))
+
+
+def convert_cifar_bw(cifar_dir='cifar-10-batches-py'):
+    from helpers import load_data10
+    _, _, X_test, _ = load_data10(randomize=False, dirname=cifar_dir)
+    x = resize(rgb_to_grayscale(X_test), (28, 28), 'bilinear')
+    return x.reshape((-1, 28 * 28)).astype('float32')
+
+
+def convert_omniglot(data_dir, chunk_size=2000):
+    import scipy.io as sio
+    m = sio.loadmat(os.path.join(data_dir, 'data_background.mat'))
+    examples = [example[0]
+                for safe_number in safe_list
+                for alphabet in m['images'][safe_number]
+                for letters in alphabet
+                for letter in letters
+                for example in letter]
+    # resized chunk_size characters at a time, in float32: the 105x105 
+    # characters of all the alphabets would take several GB as floats
+    chunks = []
+    for s in range(0, len(examples), chunk_size):
+        x = np.asarray(examples[s:s+chunk_size], dtype='float32')
+        # imresize scaled the (binary) characters to 0-255 before resizing
+        x = resize(255 * (1 - x), (28, 28), 'area')
+        chunks.append(np.rint(x).astype('uint8').reshape((-1, 28 * 28)))
+    return np.concatenate(chunks)
+
+
+def array_hash(x):
+    return hashlib.sha256(np.ascontiguousarray(x)).hexdigest()
+
+
+def describe(x):
+    return dict(shape=list(x.shape), dtype=str(x.dtype), sha256=array_hash(x))
+
+
+def prepare(data_dir='./data', cifar_dir='cifar-10-batches-py',
+            overwrite=False):
+    """ converts the missing datasets and updates the manifest """
+    converters = {'not_mnist': lambda: convert_notmnist(data_dir),
+                  'CIFAR10-bw': lambda: convert_cifar_bw(cifar_dir),
+                  'omniglot': lambda: convert_omniglot(data_dir)}
+    manifest = read_manifest(data_dir)
+    for name in names:
+        path = os.path.join(data_dir, name + '.npy')
+        if overwrite or not os.path.isfile(path):
+            print 'converting {}'.format(name)
+            x = converters[name]()
+            np.save(path, x)
+        else:
+            x = np.load(path, mmap_mode='r')
+        manifest[name] = describe(x)
+    with open(os.path.join(data_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+def read_manifest(data_dir):
+    path = os.path.join(data_dir, 'manifest.json')
+    if not os.path.isfile(path):
+        return dict()
+    with open(path) as f:
+        return json.load(f)
+
+
+def check(data_dir='./data'):
+    """ names of the datasets which don't match the manifest """
+    manifest = read_manifest(data_dir)
+    bad = list()
+    for name in names:
+        path = os.path.join(data_dir, name + '.npy')
+        if name not in manifest or not os.path.isfile(path) or \
+           describe(np.load(path, mmap_mode='r')) != manifest[name]:
+            bad.append(name)
+    return bad
+
+
+def load_ood_data(data_dir='./data', cifar_dir='cifar-10-batches-py'):
+    """ notMNIST, CIFAR10-bw, Omniglot; converted on first use """
+    if not all(os.path.isfile(os.path.join(data_dir, name + '.npy'))
+               for name in names):
+        prepare(data_dir, cifar_dir)
+    return [np.load(os.path.join(data_dir, name + '.npy')) for name in names]
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir',default='./data',type=str)
+    parser.add_argument('--cifar_dir',default='cifar-10-batches-py',type=str)
+    parser.add_argument('--overwrite',default=0,type=int)
+    parser.add_argument('--check',action='store_true',
+                        help="only check the arrays against the manifest")
+    args = parser.parse_args()
+    print args
+
+    if args.check:
+        bad = check(args.data_dir)
+        print 'mismatch: {}'.format(bad) if bad else 'all match the manifest'
+    else:
+        manifest = prepare(args.data_dir, args.cifar_dir, args.overwrite)
+        for name in names:
+            print name, manifest[name]['shape'], manifest[name]['dtype']
@@ -25,6 +25,8 @@ from BHNs_MLP_Regression import MLPWeightNorm_BHN, MCdropout_MLP, Backprop_MLP
 from dk_get_regression_data import get_regression_dataset
 #from ops import load_mnist
 from utils import log_normal, log_laplace
+from prefetch import iterate_minibatches
+from helpers import checkpoint_exists
 
 import lasagne
 import theano
@@ -46,6 +48,7 @@ times['imports'] = t1 - t0
 
 # TODO:
 n_mc = 20
+verbose = 1
 
 
 """
@@ -57,6 +60,23 @@ def save_list(path, ll):
     thefile = open(path, 'w')
     for item in ll:
         thefile.write("%s\n" % item)
+
+def save_learning_curves(save_path, taus, tr_RMSEs, va_RMSEs, te_RMSEs, tr_LLs, va_LLs, te_LLs):
+    save_list(save_path + "_tr_RMSEs", tr_RMSEs)
+    save_list(save_path + "_va_RMSEs", va_RMSEs)
+    save_list(save_path + "_te_RMSEs", te_RMSEs)
+    for n, tau in enumerate(taus):
+        save_list(save_path + '_tau=' + str(tau) + "_tr_LLs", tr_LLs[n])
+        save_list(save_path + '_tau=' + str(tau) + "_va_LLs", va_LLs[n])
+        save_list(save_path + '_tau=' + str(tau) + "_te_LLs", te_LLs[n])
+
+def save_final_results(save_path, taus, va_RMSE, te_RMSE, va_LL, te_LL, tag=''):
+    """ the _FINAL_ files read by analyze_regression.py (tag='__eval_only_' for eval_only runs) """
+    np.savetxt(save_path + tag + "_FINAL_va_RMSE=" + str(np.round(va_RMSE, 3)), [va_RMSE])
+    np.savetxt(save_path + tag + "_FINAL_te_RMSE=" + str(np.round(te_RMSE, 3)), [te_RMSE])
+    for n, tau in enumerate(taus):
+        np.savetxt(save_path + '_tau=' + str(tau) + tag + "_FINAL_va_LL=" + str(np.round(va_LL[n], 3)), [va_LL[n]])
+        np.savetxt(save_path + '_tau=' + str(tau) + tag + "_FINAL_te_LL=" + str(np.round(te_LL[n], 3)), [te_LL[n]])
     
 def rmse(predictions, targets):
     return np.sqrt(((predictions - targets) ** 2).mean())
@@ -82,8 +102,18 @@ def train_model(model, save_,save_path,
                 y_mean, y_std,
                 lr0,lrdecay,bs,epochs,anneal,
                 e0=0, rec=0, taus=None,
-                timing=True):
+                timing=True,
+                resume=False, checkpoint_every=10,
+                prefetch=0):
                 #save_=True):
+    """
+    resume: every `checkpoint_every` epochs, params, optimizer and rng 
+    states, the best params and the records so far are checkpointed 
+    together to save_path+'_resume';
+    if that checkpoint exists, training restarts from there.
+    prefetch: if > 0, minibatches are prepared by a worker thread (see 
+    prefetch.py)
+    """
     
     if timing:
         start_time = time.time()
@@ -99,6 +129,21 @@ def train_model(model, save_,save_path,
     va_LLs = [[] for tau in taus]
     te_LLs = [[] for tau in taus]
     best_va_LLs = [-np.inf,] * len(taus)
+    best_params = None
+    
+    if resume:
+        resume_path = save_path + '_resume'
+        if checkpoint_exists(resume_path):
+            state = model.load(resume_path, opt_state=True, rng_state=True)
+            e0 = state['e']
+            tr_RMSEs, va_RMSEs, te_RMSEs = state['RMSEs']
+            tr_LLs, va_LLs, te_LLs = state['LLs']
+            best_va_LLs = state['best_va_LLs']
+            best_params = model.load_extra(resume_path, 'best_params')
+            if timing:
+                start_time -= state['train_time'] + state['eval_time']
+                eval_time = state['eval_time']
+            print 'resuming after epoch {}'.format(e0)
     
     for e in range(epochs):
         
@@ -115,9 +160,7 @@ def train_model(model, save_,save_path,
         else:
             w = 1.0         
             
-        for i in range(N/bs):
-            x = X[i*bs:(i+1)*bs]
-            y = Y[i*bs:(i+1)*bs]
+        for x, y in iterate_minibatches(X,Y,bs,prefetch):
             loss = model.train_func(x,y,N,lr,w)
 
          
@@ -152,6 +195,20 @@ def train_model(model, save_,save_path,
                     if save_:
                         best_params = [p.get_value() for p in model.params]#save(save_path + '_best_tau=' + str(tau))
 
+        if resume and (e % checkpoint_every == 0 or e == epochs-1):
+            if timing:
+                elapsed = time.time() - start_time
+            else:
+                elapsed = eval_time = 0
+            model.save(resume_path, [{'e': e,
+                                      'RMSEs': [tr_RMSEs, va_RMSEs, te_RMSEs],
+                                      'LLs': [tr_LLs, va_LLs, te_LLs],
+                                      'best_va_LLs': best_va_LLs,
+                                      'train_time': elapsed - eval_time,
+                                      'eval_time': eval_time}],
+                       opt_state=True,
+                       extra_arrays={'best_params': best_params})
+
     if verbose:
         np.save(save_path + '_best_tau=' + str(tau), best_params)
 
@@ -165,9 +222,14 @@ def train_model(model, save_,save_path,
 
 def evaluate_model(predict,X,Y,
         y_mean=None, y_std=None,
-        n_mc=100,max_n=100, taus=10.**np.arange(-3,6)):
-
-    MCt = np.zeros((n_mc,X.shape[0],1))
+        n_mc=100,max_n=100, taus=10.**np.arange(-3,6),
+        dtype=np.float64):
+    """
+    dtype : storage of the MC samples; with np.float16 the (normalized) 
+    samples are stored in half precision and unnormalized in float32
+    """
+
+    MCt = np.zeros((n_mc,X.shape[0],1),dtype=dtype)
     N = X.shape[0]
     num_batches = np.ceil(N / float(max_n)).astype(int)
     for i in range(n_mc):
@@ -175,6 +237,8 @@ def evaluate_model(predict,X,Y,
             x = X[j*max_n:(j+1)*max_n]
             MCt[i,j*max_n:(j+1)*max_n] = predict(x)
 
+    if MCt.dtype == np.float16:
+        MCt = MCt.astype(np.float32)
     if y_std is not None:
         MCt *= y_std
     if y_mean is not None:
@@ -216,7 +280,8 @@ if __name__ == '__main__':
     parser.add_argument('--dataset',default='airfoil',type=str, choices=['airfoil', 'parkinsons'] + ['boston', 'concrete', 'energy', 'kin8nm', 'naval', 'power', 'protein', 'wine', 'yacht', 'year'])
     parser.add_argument('--train_on_valid',default=0, type=int, help="whether to train on the validation set")
     parser.add_argument('--data_path',default=None, type=str)
-    parser.add_argument('--flow',default='IAF',type=str, choices=['RealNVP', 'IAF'])
+    parser.add_argument('--store_path',default=None, type=str, help="binary store of the datasets (see dk_get_regression_data.build_regression_store)")
+    parser.add_argument('--flow',default='IAF',type=str, choices=['RealNVP', 'IAF', 'ConvNVP'])
     parser.add_argument('--save_dir',default=None, type=str)
     #
     parser.add_argument('--drop_prob',default=0.005, type=float) # .05, .01, .005
@@ -228,6 +293,8 @@ if __name__ == '__main__':
     parser.add_argument('--split',default=0, type=str) # TODO: , help="defaults to None, in which case this script will launch a copy of itself on ALL of the available splits")
     parser.add_argument('--eval_only',default=0, type=int, help="just run the final evaluation, NO training!")
     parser.add_argument('--verbose',default=1, type=int)
+    parser.add_argument('--resume',default=0, type=int, help="checkpoint periodically and resume from the last checkpoint (needs save_dir)")
+    parser.add_argument('--mc_dtype',default='float64', type=str, choices=['float64', 'float32', 'float16'], help="storage of the MC samples in the final evaluation")
     #parser.add_argument('--analyze',default=0, type=int, help="just run the final evaluation, NO training!")
 
     #parser.add_argument('--save_results',default='./results/',type=str)
@@ -241,10 +308,13 @@ if __name__ == '__main__':
 
     eval_only = int(args_dict.pop('eval_only'))
     verbose = int(args_dict.pop('verbose'))
+    resume = int(args_dict.pop('resume'))
 
     flags = [flag.lstrip('--') for flag in sys.argv[1:] if (not flag.startswith('--save_dir') and 
                                                             not flag.startswith('--eval_only') and
-                                                            not flag.startswith('--verbose'))]
+                                                            not flag.startswith('--verbose') and
+                                                            not flag.startswith('--resume') and
+                                                            not flag.startswith('--store_path'))]
     exp_description = '_'.join(flags)
 
 
@@ -286,7 +356,7 @@ if __name__ == '__main__':
 
     # 
     if 1:
-        input_dim, tr_x, tr_y, va_x, va_y, te_x, te_y, y_mean, y_std = get_regression_dataset(dataset, split, data_path=data_path)
+        input_dim, tr_x, tr_y, va_x, va_y, te_x, te_y, y_mean, y_std = get_regression_dataset(dataset, split, data_path=data_path, store_path=store_path)
         if train_on_valid:
             print tr_x.shape
             tr_x = np.concatenate((tr_x, va_x), axis=0)
@@ -335,7 +405,8 @@ if __name__ == '__main__':
                                                             te_x, te_y,
                                                             y_mean, y_std,
                             lr0,lrdecay,bs,epochs,anneal,
-                            taus=taus)
+                            taus=taus,
+                            resume=resume and save_)
             tr_LLs, tr_RMSEs, va_LLs, va_RMSEs, te_LLs, te_RMSEs, train_time, eval_time = result
 
             t4 = time.time()
@@ -344,8 +415,8 @@ if __name__ == '__main__':
 
         print "done training, begin final evaluation"
         #tr_RMSE, tr_LL = evaluate_model(network.predict, tr_x, tr_y, n_mc=10000, taus=taus)  
-        va_RMSE, va_LL = evaluate_model(network.predict, va_x, va_y, n_mc=1000, taus=taus, y_mean=y_mean, y_std=y_std) 
-        te_RMSE, te_LL = evaluate_model(network.predict, te_x, te_y, n_mc=1000, taus=taus, y_mean=y_mean, y_std=y_std) 
+        va_RMSE, va_LL = evaluate_model(network.predict, va_x, va_y, n_mc=1000, taus=taus, y_mean=y_mean, y_std=y_std, dtype=mc_dtype) 
+        te_RMSE, te_LL = evaluate_model(network.predict, te_x, te_y, n_mc=1000, taus=taus, y_mean=y_mean, y_std=y_std, dtype=mc_dtype) 
         #total_runtime = time.time() - t0 
         #print "total_runtime=", total_runtime 
 
@@ -355,11 +426,7 @@ if __name__ == '__main__':
         if save_:
             if eval_only: 
                 # we only overwrite the _FINAL_ results
-                np.savetxt(save_path + "__eval_only__FINAL_va_RMSE=" + str(np.round(va_RMSE, 3)), [va_RMSE])
-                np.savetxt(save_path + "__eval_only__FINAL_te_RMSE=" + str(np.round(te_RMSE, 3)), [te_RMSE])
-                for n, tau in enumerate(taus):
-                    np.savetxt(save_path + '_tau=' + str(tau) + "__eval_only__FINAL_va_LL=" + str(np.round(va_LL[n], 3)), [va_LL[n]])
-                    np.savetxt(save_path + '_tau=' + str(tau) + "__eval_only__FINAL_te_LL=" + str(np.round(te_LL[n], 3)), [te_LL[n]])
+                save_final_results(save_path, taus, va_RMSE, te_RMSE, va_LL, te_LL, tag='__eval_only_')
 
 
             elif verbose:
@@ -367,22 +434,11 @@ if __name__ == '__main__':
                 network.save(save_path + '_final')
 
                 # learning curves
-                save_list(save_path + "_tr_RMSEs", tr_RMSEs)
-                save_list(save_path + "_va_RMSEs", va_RMSEs)
-                save_list(save_path + "_te_RMSEs", te_RMSEs)
-                for n, tau in enumerate(taus):
-                    save_list(save_path + '_tau=' + str(tau) + "_tr_LLs", tr_LLs[n])
-                    save_list(save_path + '_tau=' + str(tau) + "_va_LLs", va_LLs[n])
-                    save_list(save_path + '_tau=' + str(tau) + "_te_LLs", te_LLs[n])
+                save_learning_curves(save_path, taus, tr_RMSEs, va_RMSEs, te_RMSEs, tr_LLs, va_LLs, te_LLs)
 
                 # final results (with full evaluation) TODO: EARLY STOPPING!!!
                 #np.savetxt(save_path + "_FINAL_tr_RMSE=" + str(np.round(tr_RMSE, 3)), [tr_RMSE])
-                np.savetxt(save_path + "_FINAL_va_RMSE=" + str(np.round(va_RMSE, 3)), [va_RMSE])
-                np.savetxt(save_path + "_FINAL_te_RMSE=" + str(np.round(te_RMSE, 3)), [te_RMSE])
-                for n, tau in enumerate(taus):
-                    #np.savetxt(save_path + '_tau=' + str(tau) + "_FINAL_tr_LL=" + str(np.round(tr_LL[n], 3)), [tr_LL[n]])
-                    np.savetxt(save_path + '_tau=' + str(tau) + "_FINAL_va_LL=" + str(np.round(va_LL[n], 3)), [va_LL[n]])
-                    np.savetxt(save_path + '_tau=' + str(tau) + "_FINAL_te_LL=" + str(np.round(te_LL[n], 3)), [te_LL[n]])
+                save_final_results(save_path, taus, va_RMSE, te_RMSE, va_LL, te_LL)
 
                 t6 = time.time()
                 times['saving'] = t6 - t5
@@ -405,12 +461,7 @@ if __name__ == '__main__':
                 np.save(save_path + to_str(times), times)
 
             else:
-                np.savetxt(save_path + "_FINAL_va_RMSE=" + str(np.round(va_RMSE, 3)), [va_RMSE])
-                np.savetxt(save_path + "_FINAL_te_RMSE=" + str(np.round(te_RMSE, 3)), [te_RMSE])
-                for n, tau in enumerate(taus):
-                    #np.savetxt(save_path + '_tau=' + str(tau) + "_FINAL_tr_LL=" + str(np.round(tr_LL[n], 3)), [tr_LL[n]])
-                    np.savetxt(save_path + '_tau=' + str(tau) + "_FINAL_va_LL=" + str(np.round(va_LL[n], 3)), [va_LL[n]])
-                    np.savetxt(save_path + '_tau=' + str(tau) + "_FINAL_te_LL=" + str(np.round(te_LL[n], 3)), [te_LL[n]])
+                save_final_results(save_path, taus, va_RMSE, te_RMSE, va_LL, te_LL)
 
                 t6 = time.time()
                 times['saving'] = t6 - t5
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs a regression grid search locally, on a pool of processes, instead of
+launching one job (one dataset load + one theano compilation) per setting
+as launchers/launch_*.py do with regression.py:
+    - settings are grouped by (dataset, split): each split is loaded once
+    - within a group, settings with the same architecture and seed share
+      one compiled model: lbda is a shared variable, lr0 an input of
+      train_func, and the params, optimizer state and random streams are
+      reset to their values after the build between settings. A setting
+      with another seed (e.g. every setting when --seed is not given) gets
+      a new build under its seed, so that it starts exactly as the
+      regression.py job would
+    - results are written with the file names of regression.py, i.e.
+      {save_dir}/regression.py___{flags}_FINAL_..., so analyze_regression.py
+      reads them as is. Settings with results already saved are skipped.
+
+    python regression_grid.py --EXP dev_regression
+"""
+
+import os
+# one BLAS thread per worker
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
+import glob
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+
+import theano
+from lasagne.layers import DropoutLayer, get_all_layers
+from lasagne.random import set_rng
+from theano.tensor.shared_randomstreams import RandomStreams
+floatX = theano.config.floatX
+
+from BHNs_MLP_Regression import MLPWeightNorm_BHN, MCdropout_MLP
+from dk_get_regression_data import get_regression_dataset, \
+                                   build_regression_store
+from utils import log_normal
+from regression import train_model, evaluate_model, \
+                       save_learning_curves, save_final_results
+
+
+taus = 10.**np.arange(-3,6)
+
+# defaults of regression.py
+defaults = dict(lrdecay=0, lr0=0.001, coupling=4, lbda=1, bs=32, epochs=1000,
+                model='BHN', anneal=0, n_hiddens=1, n_units=50, reinit=1,
+                flow='IAF', drop_prob=0.005)
+types = dict(lrdecay=int, lr0=float, coupling=int, lbda=float, bs=int,
+             epochs=int, anneal=int, n_hiddens=int, n_units=int, reinit=int,
+             drop_prob=float)
+
+# same grids as launchers/launch_{EXP}.py
+def get_grid(EXP):
+    if EXP == "dev_regression":
+        datasets = ['airfoil', 'parkinsons']
+        epochs = 400
+        n_units = 50
+        splits = range(20)
+    elif EXP == "large":
+        datasets = ['naval', 'kin8nm', 'power']
+        epochs = 400
+        n_units = 50
+        splits = range(20)
+    elif EXP == "protein":
+        datasets = ['protein']
+        epochs = 200
+        n_units = 100
+        splits = range(5)
+    elif EXP == "small":
+        datasets = ['boston', 'concrete', 'energy', 'wine', 'yacht']
+        epochs = 400
+        n_units = 50
+        splits = range(20)
+    elif EXP == "year":
+        datasets = ['year']
+        epochs = 100
+        n_units = 100
+        splits = range(1)
+    else:
+        raise Exception('no experiment named `{}`'.format(EXP))
+
+    grid = []
+    grid += [['dataset', datasets]]
+    grid += [["epochs", [epochs]]]
+    grid += [["lbda", 100.**np.arange(-3,2)]]
+    grid += [["lr0", ['.01', '.001']]]
+    grid += [["n_units", [n_units]]]
+    grid += [['split', splits]]
+    models = [[('model', 'MCD'), ('drop_prob', '.01')],
+              [('model', 'BHN'), ('flow', 'IAF'), ('coupling', '4')]]
+    return grid, models
+
+
+def grid_search(grid, models):
+    """ list of settings, each a list of (arg, str(value)) in command-line order """
+    lists = [[(arg, str(val)) for val in vals] for arg, vals in grid]
+    return [list(item) + model
+            for item in itertools.product(*lists) for model in models]
+
+
+def build_network(hp, input_dim, tr_x, seed):
+    """
+    the network of regression.py with this seed, with the state it has
+    right after the build (params, optimizer state, random streams and
+    np.random), to be restored when it is reused for a setting with the
+    same seed
+    """
+    lbda = theano.shared(np.cast[floatX](hp['lbda']))
+    set_rng(np.random.RandomState(seed))
+    np.random.seed(seed+1000)
+    # as in regression.py (where --drop_prob is not used either)
+    if hp['model'] == 'MCD':
+        network = MCdropout_MLP(n_hiddens=hp['n_hiddens'],
+                                n_units=hp['n_units'],
+                                lbda=lbda,
+                                input_dim=input_dim)
+        streams = [l._srng for l in get_all_layers(network.layer)
+                   if isinstance(l, DropoutLayer)]
+    elif hp['model'] == 'BHN':
+        if hp['reinit']:
+            init_batch = tr_x[-64:]
+        else:
+            init_batch = None
+        network = MLPWeightNorm_BHN(lbda=lbda,
+                                    srng=RandomStreams(seed=seed+2000),
+                                    prior=log_normal,
+                                    coupling=hp['coupling'],
+                                    n_hiddens=hp['n_hiddens'],
+                                    n_units=hp['n_units'],
+                                    input_dim=input_dim,
+                                    flow=hp['flow'],
+                                    init_batch=init_batch)
+        streams = [network.srng]
+    else:
+        raise Exception('no model named `{}`'.format(hp['model']))
+
+    shared = list(network.params) + network._opt_state()[1] + \
+             [su[0] for srng in streams for su in srng.state_updates]
+    return dict(network=network, lbda=lbda, seed=seed,
+                state0=[(v, v.get_value()) for v in shared],
+                np_state0=np.random.get_state())
+
+
+def run_group(job):
+    """ all the settings of one (dataset, split) """
+    t0 = time.time()
+    dataset, split, settings = job['dataset'], job['split'], job['settings']
+    data = get_regression_dataset(dataset, split, data_path=job['data_path'],
+                                  store_path=job['store_path'])
+    input_dim, tr_x, tr_y, va_x, va_y, te_x, te_y, y_mean, y_std = data
+
+    # the seeds of the settings are not drawn from np.random, which the
+    # builds and the training reseed
+    seed_rng = np.random.RandomState()
+    networks = {}
+    n_run = 0
+    n_built = 0
+    for flags in settings:
+        save_path = os.path.join(job['save_dir'], job['script_name']) + \
+                    '___' + '_'.join([k + '=' + v for k, v in flags])
+        if glob.glob(save_path + '_FINAL_va_RMSE=*'):
+            continue
+
+        hp = dict(defaults)
+        for k, v in flags:
+            hp[k] = types[k](v) if k in types else v
+        seed = job['seed']
+        if seed is None:
+            seed = seed_rng.randint(2**31 - 1)
+
+        arch = (hp['model'], hp['n_hiddens'], hp['n_units'],
+                hp['flow'], hp['coupling'], hp['reinit'])
+        net = networks.get(arch)
+        if net is None or net['seed'] != seed:
+            # only the last build of an architecture is kept
+            net = networks[arch] = build_network(hp, input_dim, tr_x, seed)
+            n_built += 1
+        else:
+            for v, v0 in net['state0']:
+                v.set_value(v0)
+            np.random.set_state(net['np_state0'])
+        network = net['network']
+        net['lbda'].set_value(np.cast[floatX](hp['lbda']))
+
+        result = train_model(network, True, save_path,
+                             tr_x, tr_y, va_x, va_y, te_x, te_y,
+                             y_mean, y_std,
+                             hp['lr0'], hp['lrdecay'], hp['bs'],
+                             hp['epochs'], hp['anneal'],
+                             taus=taus)
+        tr_LLs, tr_RMSEs, va_LLs, va_RMSEs, te_LLs, te_RMSEs = result[:6]
+
+        va_RMSE, va_LL = evaluate_model(network.predict, va_x, va_y,
+                                        n_mc=1000, taus=taus,
+                                        y_mean=y_mean, y_std=y_std)
+        te_RMSE, te_LL = evaluate_model(network.predict, te_x, te_y,
+                                        n_mc=1000, taus=taus,
+                                        y_mean=y_mean, y_std=y_std)
+
+        network.save(save_path + '_final')
+        save_learning_curves(save_path, taus, tr_RMSEs, va_RMSEs, te_RMSEs,
+                             tr_LLs, va_LLs, te_LLs)
+        save_final_results(save_path, taus, va_RMSE, te_RMSE, va_LL, te_LL)
+        n_run += 1
+
+    return dataset, split, n_run, n_built, time.time() - t0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--EXP', type=str, default='dev_regression')
+    parser.add_argument('--save_dir', type=str, default=None,
+                        help="defaults to $SAVE_PATH/launch_{EXP}.py")
+    parser.add_argument('--data_path', type=str, default=None)
+    parser.add_argument('--store_path', type=str, default=None)
+    parser.add_argument('--script_name', type=str, default='regression.py')
+    parser.add_argument('--n_workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    print args
+
+    save_dir = args.save_dir
+    if save_dir is None:
+        save_dir = os.path.join(os.environ['SAVE_PATH'],
+                                'launch_' + args.EXP + '.py')
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    data_path = args.data_path
+    if data_path is None:
+        data_path = os.path.join(os.environ['HOME'], 'BayesianHypernetCW/')
+
+    grid, models = get_grid(args.EXP)
+    if args.store_path is not None:
+        # built once here, not concurrently by the workers
+        for dataset in dict(grid)['dataset']:
+            if not os.path.isfile(os.path.join(args.store_path, dataset,
+                                               'index_train.npy')):
+                build_regression_store(dataset, data_path, args.store_path)
+    groups = {}
+    for flags in grid_search(grid, models):
+        fd = dict(flags)
+        groups.setdefault((fd['dataset'], fd['split']), []).append(flags)
+    jobs = [dict(dataset=dataset, split=split, settings=settings,
+                 save_dir=save_dir, data_path=data_path,
+                 store_path=args.store_path,
+                 script_name=args.script_name, seed=args.seed)
+            for (dataset, split), settings in sorted(groups.items())]
+    print 'running {} settings in {} groups on {} workers'.format(
+        sum([len(job['settings']) for job in jobs]), len(jobs),
+        args.n_workers)
+
+    t0 = time.time()
+    pool = multiprocessing.Pool(args.n_workers)
+    for dataset, split, n_run, n_compiled, t in \
+            pool.imap_unordered(run_group, jobs):
+        print '{} split {}: {} settings, {} compiled models, {:.1f}s'.format(
+            dataset, split, n_run, n_compiled, t)
+    pool.close()
+    pool.join()
+    print 'done, total time = {:.1f}s'.format(time.time() - t0)
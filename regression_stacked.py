@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Trains the BHNs of several splits of a UCI dataset (the 20-split protocol of
+get_proper_regression_data) at once, as one StackedMLPWeightNorm_BHN: model s
+is trained on split s, with its own minibatches, and the 50-unit MLPs run as
+batched dots instead of one small dot per split.
+
+Results of each split are written as in regression.py:
+    {save_dir}/{fname}___{flags}_split={s}_FINAL_...
+
+    python regression_stacked.py --dataset=boston --splits 0 1 2 3
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+import theano
+from lasagne.random import set_rng
+from theano.tensor.shared_randomstreams import RandomStreams
+floatX = theano.config.floatX
+
+from BHNs_MLP_Regression import StackedMLPWeightNorm_BHN
+from dk_get_regression_data import get_regression_dataset
+from utils import log_normal
+from regression import get_LL, rmse, save_final_results
+
+
+def stack(arrays):
+    """ pad the arrays of the splits to the same length and stack them """
+    n = max([len(a) for a in arrays])
+    out = np.zeros((len(arrays),n)+arrays[0].shape[1:],dtype=floatX)
+    for s,a in enumerate(arrays):
+        out[s,:len(a)] = a
+    return out
+
+
+def evaluate_stacked(predict, Xs, Ys, y_means, y_stds,
+                     n_mc=100, max_n=100, taus=10.**np.arange(-3,6)):
+    """ per split RMSE and LLs, as regression.evaluate_model """
+    X = stack(Xs)
+    N = X.shape[1]
+    MCt = np.zeros((n_mc,)+X.shape[:2]+(1,),dtype=floatX)
+    for i in range(n_mc):
+        for j in range(0,N,max_n):
+            MCt[i,:,j:j+max_n] = predict(X[:,j:j+max_n])
+
+    RMSEs, LLs = [], []
+    for s,Y in enumerate(Ys):
+        MCs = MCt[:,s,:len(Y)] * y_stds[s] + y_means[s]
+        RMSEs.append(rmse(MCs.mean(0), Y))
+        LLs.append([get_LL(MCs, Y, tau) for tau in taus])
+    return RMSEs, LLs
+
+
+def train_stacked(model, Xs, Ys, lr0, lrdecay, bs, epochs, anneal):
+    """
+    step i trains model s on minibatch i (mod its number of minibatches)
+    of split s, without shuffling (as regression.train_model)
+    """
+    Ns = np.array([len(X) for X in Xs])
+    # the minibatches of all the splits are stacked, so they must be full
+    assert Ns.min() >= bs, \
+        'every split needs at least bs={} examples (got {})'.format(bs, Ns.min())
+    n_batches = Ns // bs
+    ds = np.cast[floatX](Ns)
+    for e in range(epochs):
+        # epoch 0 is skipped, as in regression.train_model (e0=0)
+        if e == 0:
+            continue
+        if lrdecay:
+            lr = lr0 * 10**(-e/float(epochs-1))
+        else:
+            lr = lr0
+        if anneal:
+            w = min(1.0,0.001+e/(epochs/2.))
+        else:
+            w = 1.0
+
+        for i in range(n_batches.max()):
+            x = np.asarray([X[(i%n)*bs:(i%n+1)*bs]
+                            for X,n in zip(Xs,n_batches)])
+            y = np.asarray([Y[(i%n)*bs:(i%n+1)*bs]
+                            for Y,n in zip(Ys,n_batches)])
+            loss = model.train_func(x,y,ds,lr,w)
+
+        if e % 5 == 0:
+            print 'epoch {}: loss {}'.format(e, loss)
+
+
+if __name__ == '__main__':
+
+    taus = 10.**np.arange(-3,6)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset',default='airfoil',type=str)
+    parser.add_argument('--splits',default=range(20),type=int,nargs='+')
+    parser.add_argument('--lrdecay',default=0,type=int)
+    parser.add_argument('--lr0',default=0.001,type=float)
+    parser.add_argument('--coupling',default=4,type=int)
+    parser.add_argument('--lbda',default=1,type=float)
+    parser.add_argument('--bs',default=32,type=int)
+    parser.add_argument('--epochs',default=1000,type=int)
+    parser.add_argument('--anneal',default=0,type=int)
+    parser.add_argument('--n_hiddens',default=1,type=int)
+    parser.add_argument('--n_units',default=50,type=int)
+    parser.add_argument('--reinit',default=1,type=int)
+    parser.add_argument('--flow',default='IAF',type=str,
+                        choices=['RealNVP','IAF'])
+    parser.add_argument('--seed',default=None,type=int)
+    parser.add_argument('--data_path',default=None,type=str)
+    parser.add_argument('--store_path',default=None,type=str)
+    parser.add_argument('--save_dir',default=None,type=str)
+    parser.add_argument('--fname',default='regression.py',type=str)
+    args = parser.parse_args()
+    print args
+
+    seed = args.seed
+    if seed is None:
+        seed = np.random.randint(2**31 - 1)
+    set_rng(np.random.RandomState(seed))
+    np.random.seed(seed+1000)
+
+    data_path = args.data_path
+    if data_path is None:
+        data_path = os.path.join(os.environ['HOME'], 'BayesianHypernetCW/')
+
+    data = [get_regression_dataset(args.dataset, split, data_path=data_path,
+                                   store_path=args.store_path)
+            for split in args.splits]
+    input_dim = data[0][0]
+    assert all([d[0] == input_dim for d in data])
+    tr_xs, tr_ys, va_xs, va_ys, te_xs, te_ys, y_means, y_stds = \
+        [[d[k] for d in data] for k in range(1,9)]
+
+    if args.reinit:
+        init_batch = np.asarray([tr_x[-64:] for tr_x in tr_xs])
+    else:
+        init_batch = None
+    t0 = time.time()
+    network = StackedMLPWeightNorm_BHN(len(args.splits),
+                                       lbda=args.lbda,
+                                       srng=RandomStreams(seed=seed+2000),
+                                       prior=log_normal,
+                                       coupling=args.coupling,
+                                       n_hiddens=args.n_hiddens,
+                                       n_units=args.n_units,
+                                       input_dim=input_dim,
+                                       flow=args.flow,
+                                       init_batch=init_batch)
+    t1 = time.time()
+    print 'compile time = {:.1f}s'.format(t1 - t0)
+
+    train_stacked(network, tr_xs, tr_ys, args.lr0, args.lrdecay, args.bs,
+                  args.epochs, args.anneal)
+    t2 = time.time()
+    print 'train time = {:.1f}s ({} splits)'.format(t2 - t1, len(args.splits))
+
+    va_RMSEs, va_LLs = evaluate_stacked(network.predict, va_xs, va_ys,
+                                        y_means, y_stds, n_mc=1000, taus=taus)
+    te_RMSEs, te_LLs = evaluate_stacked(network.predict, te_xs, te_ys,
+                                        y_means, y_stds, n_mc=1000, taus=taus)
+    for s, split in enumerate(args.splits):
+        print 'split {}: va RMSE {:.3f}, te RMSE {:.3f}'.format(
+            split, va_RMSEs[s], te_RMSEs[s])
+
+    if args.save_dir is not None:
+        # flags given as --arg=value, as in regression.py
+        flags = [flag.lstrip('--') for flag in sys.argv[1:]
+                 if flag.startswith('--') and
+                 not flag.startswith('--save_dir') and
+                 not flag.startswith('--store_path') and
+                 not flag.startswith('--splits')]
+        save_dir = os.path.join(args.save_dir, args.fname)
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        network.save(save_dir + '___stacked_' + '_'.join(flags) + '_final')
+        for s, split in enumerate(args.splits):
+            save_path = save_dir + '___' + \
+                        '_'.join(flags + ['split=' + str(split)])
+            save_final_results(save_path, taus, va_RMSEs[s], te_RMSEs[s],
+                               va_LLs[s], te_LLs[s])
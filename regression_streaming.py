@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Trains a MLPWeightNorm_BHN on a large regression dataset (year: 515k x 90)
+with bounded memory: the training set is never loaded, minibatches are read
+from the memory-mapped binary store of dk_get_regression_data by a
+background thread (prefetch.memmap_minibatches), which shuffles within
+windows of `window` rows and normalizes them, while the main thread trains.
+
+Results are written as in regression.py:
+    {save_dir}/{fname}___{flags}_FINAL_...
+
+    python regression_streaming.py --dataset=year --store_path=./regression_store
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+import theano
+from lasagne.random import set_rng
+from theano.tensor.shared_randomstreams import RandomStreams
+floatX = theano.config.floatX
+
+from BHNs_MLP_Regression import MLPWeightNorm_BHN
+from dk_get_regression_data import build_regression_store
+from prefetch import Prefetcher, memmap_minibatches
+from utils import log_normal
+from regression import evaluate_model, save_final_results
+
+
+def load_stream_data(dataset, split, store_path):
+    """
+    memory-mapped X and y, the training indices, and the (in memory)
+    normalized valid and test sets, split as in get_regression_dataset
+    """
+    src = os.path.join(store_path, dataset)
+    load = lambda name, mmap_mode='r': \
+        np.load(os.path.join(src, name + '.npy'), mmap_mode=mmap_mode)
+    X, y = load('X'), load('y')
+    index_train = np.asarray(load('index_train')[split])
+    index_test = np.asarray(load('index_test')[split])
+    ind = int(.8 * len(index_train))
+    tr_inds, va_inds = index_train[:ind], index_train[ind:]
+    stats = [np.asarray(load(name)[split])
+             for name in ['x_mean', 'x_std', 'y_mean', 'y_std']]
+    x_mean, x_std = stats[:2]
+
+    va_x = (X[va_inds] - x_mean) / x_std
+    te_x = (X[index_test] - x_mean) / x_std
+    return X, y, tr_inds, va_x, y[va_inds], te_x, y[index_test], stats
+
+
+def train_streaming(model, X, Y, tr_inds, va_x, va_y, stats,
+                    lr0, lrdecay, bs, epochs, anneal,
+                    window=2**16, max_queue=8, taus=None, n_mc=20):
+    """
+    as regression.train_model, with minibatches streamed from X, Y
+    """
+    x_mean, x_std, y_mean, y_std = stats
+    normalize = lambda x, y: ((x - x_mean) / x_std, (y - y_mean) / y_std)
+    N = len(tr_inds)
+    va_LLs = []
+    wait_time = 0
+    t0 = time.time()
+    for e in range(epochs):
+        if lrdecay:
+            lr = lr0 * 10**(-e/float(epochs-1))
+        else:
+            lr = lr0
+        if anneal:
+            w = min(1.0,0.001+e/(epochs/2.))
+        else:
+            w = 1.0
+
+        batches = Prefetcher(memmap_minibatches(X, Y, tr_inds, bs, window,
+                                                transform=normalize),
+                             max_queue=max_queue)
+        t1 = time.time()
+        try:
+            for x, y in batches:
+                wait_time += time.time() - t1
+                loss = model.train_func(x,y,N,lr,w)
+                t1 = time.time()
+        finally:
+            batches.close()
+
+        va_rmse, va_LL = evaluate_model(model.predict, va_x, va_y,
+                                        n_mc=n_mc, taus=taus,
+                                        y_mean=y_mean, y_std=y_std)
+        va_LLs.append(va_LL)
+        print 'epoch {}: loss {:.4f}, va rmse {:.4f}, ' \
+              'waiting for data {:.1f}s of {:.1f}s'.format(
+                  e, float(loss), va_rmse, wait_time, time.time() - t0)
+    return va_LLs
+
+
+if __name__ == '__main__':
+
+    taus = 10.**np.arange(-3,6)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset',default='year',type=str)
+    parser.add_argument('--split',default=0,type=int)
+    parser.add_argument('--store_path',default='./regression_store',type=str)
+    parser.add_argument('--data_path',default=None,type=str)
+    parser.add_argument('--lrdecay',default=0,type=int)
+    parser.add_argument('--lr0',default=0.001,type=float)
+    parser.add_argument('--coupling',default=4,type=int)
+    parser.add_argument('--lbda',default=1,type=float)
+    parser.add_argument('--bs',default=32,type=int)
+    parser.add_argument('--epochs',default=100,type=int)
+    parser.add_argument('--anneal',default=0,type=int)
+    parser.add_argument('--n_hiddens',default=1,type=int)
+    parser.add_argument('--n_units',default=100,type=int)
+    parser.add_argument('--reinit',default=1,type=int)
+    parser.add_argument('--flow',default='IAF',type=str,
+                        choices=['RealNVP','IAF','ConvNVP'])
+    parser.add_argument('--window',default=2**16,type=int,
+                        help="rows read (and shuffled) at a time")
+    parser.add_argument('--max_queue',default=8,type=int,
+                        help="minibatches prefetched")
+    parser.add_argument('--seed',default=None,type=int)
+    parser.add_argument('--save_dir',default=None,type=str)
+    parser.add_argument('--fname',default='regression.py',type=str)
+    args = parser.parse_args()
+    print args
+
+    seed = args.seed
+    if seed is None:
+        seed = np.random.randint(2**31 - 1)
+    set_rng(np.random.RandomState(seed))
+    np.random.seed(seed+1000)
+
+    if not os.path.isfile(os.path.join(args.store_path, args.dataset,
+                                       'index_train.npy')):
+        data_path = args.data_path
+        if data_path is None:
+            data_path = os.path.join(os.environ['HOME'], 'BayesianHypernetCW/')
+        build_regression_store(args.dataset, data_path, args.store_path)
+
+    X, y, tr_inds, va_x, va_y, te_x, te_y, stats = \
+        load_stream_data(args.dataset, args.split, args.store_path)
+    x_mean, x_std, y_mean, y_std = stats
+    input_dim = X.shape[1]
+
+    if args.reinit:
+        init_batch = np.cast[floatX]((X[tr_inds[-64:]] - x_mean) / x_std)
+    else:
+        init_batch = None
+    network = MLPWeightNorm_BHN(lbda=args.lbda,
+                                srng=RandomStreams(seed=seed+2000),
+                                prior=log_normal,
+                                coupling=args.coupling,
+                                n_hiddens=args.n_hiddens,
+                                n_units=args.n_units,
+                                input_dim=input_dim,
+                                flow=args.flow,
+                                init_batch=init_batch)
+
+    train_streaming(network, X, y, tr_inds, va_x, va_y, stats,
+                    args.lr0, args.lrdecay, args.bs, args.epochs, args.anneal,
+                    window=args.window, max_queue=args.max_queue, taus=taus)
+
+    va_RMSE, va_LL = evaluate_model(network.predict, va_x, va_y, n_mc=1000,
+                                    taus=taus, y_mean=y_mean, y_std=y_std)
+    te_RMSE, te_LL = evaluate_model(network.predict, te_x, te_y, n_mc=1000,
+                                    taus=taus, y_mean=y_mean, y_std=y_std)
+    print 'va RMSE {:.3f}, te RMSE {:.3f}'.format(va_RMSE, te_RMSE)
+
+    if args.save_dir is not None:
+        # flags given as --arg=value, as in regression.py
+        flags = [flag.lstrip('--') for flag in sys.argv[1:]
+                 if not flag.startswith('--save_dir') and
+                 not flag.startswith('--store_path') and
+                 not flag.startswith('--data_path') and
+                 not flag.startswith('--max_queue')]
+        save_dir = os.path.join(args.save_dir, args.fname)
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        save_path = save_dir + '___' + '_'.join(flags)
+        network.save(save_path + '_final')
+        save_final_results(save_path, taus, va_RMSE, te_RMSE, va_LL, te_LL)
@@ -63,7 +63,8 @@ def KL(prior_mean, prior_log_var, posterior_mean, posterior_log_var, delta=.001)
 
 class Full_BHN(Base_BHN):
     """
-    hypernet (really just BbB/mean field for now) that outputs ALL the primary net parameters (including biases!!)
+    hypernet (BbB/mean field if coupling=0) that outputs ALL the primary net parameters (including biases!!)
+    with coupling > 0, use conditioner='block_lowrank' (or 'lowrank') to keep the coupling layers in memory
     """
     def __init__(self,
                  lbda=1,
@@ -73,6 +74,7 @@ class Full_BHN(Base_BHN):
                  prior_mean = 0,
                  prior_log_var = 0,
                  coupling=0,
+                 n_units_h=200,
                  n_hiddens=2,
                  n_units=800,
                  n_inputs=784,
@@ -83,7 +85,6 @@ class Full_BHN(Base_BHN):
                  **kargs):
         
         self.__dict__.update(locals())
-        assert coupling == 0# TODO
 
 
 
@@ -98,9 +99,10 @@ class Full_BHN(Base_BHN):
             self.weight_shapes = [(n_inputs, n_classes)]
 
         if self.random_biases:
-            self.num_params = sum((ws[0]+1)*ws[1] for ws in self.weight_shapes)
+            self.block_sizes = [(ws[0]+1)*ws[1] for ws in self.weight_shapes]
         else:
-            self.num_params = sum((ws[0])*ws[1] for ws in self.weight_shapes)
+            self.block_sizes = [(ws[0])*ws[1] for ws in self.weight_shapes]
+        self.num_params = sum(self.block_sizes)
         
         super(Full_BHN, self).__init__(lbda=lbda,
                                                 perdatapoint=perdatapoint,
@@ -123,9 +125,17 @@ class Full_BHN(Base_BHN):
         self.mean = layer_temp.b
         self.log_var = layer_temp.W
         self.delta = .001 # default value from modules.py
-        self.h_net = IndexLayer(layer_temp,0)
+        h_net = IndexLayer(layer_temp,0)
         logdets_layers.append(IndexLayer(layer_temp,1))
 
+        for c in range(self.coupling):
+            if c > 0:
+                h_net = self._get_permute_layer(h_net)
+            layer_temp = self._get_coupling_layer(h_net,self.n_units_h)
+            h_net = IndexLayer(layer_temp,0)
+            logdets_layers.append(IndexLayer(layer_temp,1))
+
+        self.h_net = h_net
         self.weights = lasagne.layers.get_output(h_net,self.ep)
         self.logdets = sum([get_output(ld,self.ep) for ld in logdets_layers])
     
@@ -174,9 +184,16 @@ class Full_BHN(Base_BHN):
             assert False
 
     def _get_elbo(self):
-        # NTS: is KL waaay too big??
-        self.kl = KL(self.prior_mean, self.prior_log_var,
-                     self.mean, self.log_var).sum(-1).mean()
+        if self.coupling:
+            # q(w) is no longer gaussian: single sample estimate (as in Base_BHN)
+            self.logqw = - self.logdets
+            self.logpw = log_normal(self.weights, self.prior_mean,
+                                    self.prior_log_var).sum(1)
+            self.kl = (self.logqw - self.logpw).mean()
+        else:
+            # NTS: is KL waaay too big??
+            self.kl = KL(self.prior_mean, self.prior_log_var,
+                         self.mean, self.log_var).sum(-1).mean()
 
         if self.output_type == 'categorical':
             self.logpyx = - cc(self.y,self.target_var).mean()
@@ -226,6 +243,9 @@ parser.add_argument('--n_train', type=int, default=2000)
 parser.add_argument('--n_valid', type=int, default=100) # using less examples so it's faster
 #
 parser.add_argument('--random_biases', type=int, default=1)
+parser.add_argument('--coupling', type=int, default=0)
+parser.add_argument('--conditioner', type=str, default='block_lowrank', choices=['dense', 'lowrank', 'block', 'block_lowrank'])
+parser.add_argument('--conditioner_rank', type=int, default=16)
 
 #parser.add_argument('--optimizer', type=str, default='sgd', choices=['adam', 'momentum', 'sgd'])
 parser.add_argument('--save_dir', type=str, default="./")
@@ -306,6 +326,10 @@ va_accs = np.zeros((n_splits, n_epochs-1))
 prior_mean = 0
 prior_log_var = 0
 
+# the next prior is the gaussian base of the posterior only (mean, log_var)
+assert coupling == 0 or n_splits == 1, \
+    "sequential updating drops the coupling layers of the posterior"
+
 for split in range(n_splits):
 
     # get data
@@ -320,7 +344,10 @@ for split in range(n_splits):
                  n_hiddens=n_hiddens,
                  n_units=n_units,
                  weight=kl_weight,
-                 random_biases=random_biases)
+                 random_biases=random_biases,
+                 coupling=coupling,
+                 conditioner=conditioner,
+                 conditioner_rank=conditioner_rank)
 
     model.input_var.tag.test_value = train_x[:32]
     model.target_var.tag.test_value = train_x[:32]
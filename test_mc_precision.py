@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Error of storing the MC samples of utils.MCpred / utils.evaluate_model in
+reduced precision (dtype=np.float16 or np.float32), against float64, on
+fixed random predictive distributions: accuracy, test LL (log of the MC
+average of the probability of the label) and BALD, each checked against
+the bound implied by the rounding of the stored samples.
+
+    python -m pytest -q test_mc_precision.py
+    python test_mc_precision.py
+"""
+
+import numpy as np
+
+from utils import MCpred, evaluate_model
+from anomaly_detection import entropy
+
+
+n_mc, N, C = 50, 1000, 10
+max_n = 100
+
+
+def fixed_samples(seed=427):
+    """ (n_mc, N, C) float32 MC samples, each example with its own spread """
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(N, C) * 3
+    noise = rng.randn(n_mc, N, C) * rng.rand(1, N, 1) * 2
+    P = np.exp(logits + noise)
+    P /= P.sum(-1, keepdims=True)
+    Y = rng.randint(0, C, N)
+    return P.astype('float32'), Y
+
+
+def fixed_predictor(P, n_batches=1):
+    """
+    predict_proba returning the samples of P in turn; the inputs X are the
+    indices of the examples, each sample being asked in n_batches calls
+    """
+    calls = [0]
+    def predict_proba(x):
+        i = calls[0] // n_batches
+        calls[0] += 1
+        return P[i % len(P)][np.asarray(x).reshape(-1)]
+    return predict_proba
+
+
+def mc_results(dtype):
+    """ accuracy, per-example LL and BALD, and the MC mean (float64) """
+    P, Y = fixed_samples()
+    X = np.arange(N)[:,None]
+    samples = MCpred(X, fixed_predictor(P), num_samples=n_mc,
+                     returns='samples', num_classes=C, dtype=dtype)
+    probs = MCpred(X, fixed_predictor(P), num_samples=n_mc,
+                   returns='probs', num_classes=C, dtype=dtype)
+    acc = evaluate_model(fixed_predictor(P, N // max_n), X, Y, n_mc=n_mc,
+                         max_n=max_n, n_classes=C, dtype=dtype)
+    probs = probs.astype(np.float64)
+    LL = np.log(probs[np.arange(N), Y])
+    samples = samples.astype(np.float64)
+    bald = entropy(samples.mean(0)) - entropy(samples).mean(0)
+    return acc, LL, bald, probs
+
+
+def error_bounds(dtype, probs, Y):
+    """
+    bounds on the errors of accuracy, LL (per example) and BALD (per
+    example), given the float64 MC means probs. Each stored probability p
+    is off by at most u*p (u = 2**-(mantissa bits + 1)), or by tiny*u below
+    the smallest normal number tiny; the mean over the samples is then
+    accumulated in float32 (mc_mean).
+    """
+    info = np.finfo(dtype)
+    u = info.eps / 2.
+    tiny = info.tiny
+    u_mean = u + n_mc * np.finfo(np.float32).eps / 2.
+    err = u_mean * probs + tiny * u
+
+    # the argmax can only change where the top two are within the error
+    top2 = np.sort(probs, -1)[:,-2:]
+    ambiguous = top2[:,1] - top2[:,0] <= err.max(-1) * 2
+    acc_tol = ambiguous.mean()
+
+    p = probs[np.arange(N), Y]
+    r = err[np.arange(N), Y] / p
+    LL_tol = np.where(r < 1, -np.log1p(-np.minimum(r, 1 - 1e-12)), np.inf)
+
+    # |d(p log p)| <= u (1/e + 1) for normal p, and below tiny,
+    # |p log p| <= tiny log(1/tiny); both entropies have C such terms
+    bald_tol = 2 * C * (u * (1 / np.e + 1) + tiny * np.log(1 / tiny))
+    return acc_tol, LL_tol, bald_tol
+
+
+def check_bounds(dtype):
+    acc64, LL64, bald64, probs64 = mc_results(np.float64)
+    acc, LL, bald, _ = mc_results(dtype)
+    _, Y = fixed_samples()
+    acc_tol, LL_tol, bald_tol = error_bounds(dtype, probs64, Y)
+    assert abs(acc - acc64) <= acc_tol, (acc, acc64, acc_tol)
+    assert np.all(np.abs(LL - LL64) <= LL_tol * 1.01 + 1e-12)
+    assert np.abs(bald - bald64).max() <= bald_tol, \
+        (np.abs(bald - bald64).max(), bald_tol)
+    return abs(acc - acc64), np.abs(LL - LL64).mean(), \
+           np.abs(bald - bald64).max()
+
+
+def test_float16_bounds():
+    check_bounds(np.float16)
+
+
+def test_float32_bounds():
+    check_bounds(np.float32)
+
+
+if __name__ == '__main__':
+    for dtype in [np.float32, np.float16]:
+        acc_err, LL_err, bald_err = check_bounds(dtype)
+        print '{}: |acc error| {:.4f}, mean |LL error| {:.2e}, ' \
+              'max |BALD error| {:.2e}'.format(np.dtype(dtype).name, acc_err,
+                                               LL_err, bald_err)
+    print 'ok'
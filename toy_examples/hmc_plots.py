@@ -48,9 +48,14 @@ def plot_dump(D):
     ax2.set_title('hypernet', fontsize=10)
     ax2.tick_params(labelsize=8)
 
-    mu, std, _, _, _ = D['hmc']
-    plot_case(ax3, X, y, D['x'], mu[-1, :], std[-1, :])
-    ax3.set_title('NUTS', fontsize=10)
+    if 'hmc_pooled' in D:
+        # All samples after tuning (mlp_hmc.hmc_pred_pooled)
+        mu, std, _, _ = D['hmc_pooled']
+    else:
+        mu, std, _, _, _ = D['hmc']
+        mu, std = mu[-1, :], std[-1, :]
+    plot_case(ax3, X, y, D['x'], mu, std)
+    ax3.set_title('HMC', fontsize=10)
     ax3.tick_params(labelsize=8)
 
     return fig, (ax1, ax2, ax3)
@@ -4,7 +4,6 @@ from collections import OrderedDict
 import cPickle as pkl
 import numpy as np
 import pandas as pd
-import pymc3 as pm
 from scipy.stats import gaussian_kde
 import mlp_hmc
 
@@ -54,20 +53,20 @@ def run_id_experiment():
     init_samples = df.values
 
     df = pd.read_csv('data_train.csv', header=0, index_col=None)
-    X = df['x'].values
-    y = df['y'].values
+    X = df['x'].values[:, None]
+    y = df['y'].values[:, None]
 
     df = pd.read_csv('data_valid.csv', header=0, index_col=None)
-    X_valid = df['x'].values
-    y_valid = df['y'].values
+    X_valid = df['x'].values[:, None]
+    y_valid = df['y'].values[:, None]
 
     # Get HMC result
     tr_list, hmc_dbg = \
         mlp_hmc.prod_net_hmc(X, y, X_valid, y_valid, init_samples,
                              weight_shapes, restarts=n_samples,
                              n_iter=n_iter_hmc, n_tune=n_tune_hmc)
-    a_hmc = np.concatenate([pm.get_values('a') for tr in tr_list], axis=0)
-    b_hmc = np.concatenate([pm.get_values('b') for tr in tr_list], axis=0)
+    a_hmc = np.concatenate([tr.get_values('a') for tr in tr_list], axis=0)
+    b_hmc = np.concatenate([tr.get_values('b') for tr in tr_list], axis=0)
     assert(a_hmc.ndim == 1)
     assert(a_hmc.shape == b_hmc.shape)
 
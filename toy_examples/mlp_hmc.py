@@ -3,7 +3,10 @@
 from collections import OrderedDict
 from time import time
 import numpy as np
-import pymc3 as pm
+try:
+    import pymc3 as pm
+except ImportError:
+    pm = None  # Only needed by the *_pm reference models
 from scipy.misc import logsumexp
 from scipy.stats import norm
 import theano
@@ -28,6 +31,20 @@ def unpack(v, weight_shapes, skip_chk=True):
     return D
 
 
+def unpack_batch(V, weight_shapes):
+    '''Like unpack for a batch V of shape (n, num_params): every var gets a
+    leading axis of size n. Works with np arrays and theano vars.'''
+    assert(V.ndim == 2)
+
+    D = OrderedDict()
+    tt = 0
+    for varname, ws in weight_shapes.iteritems():
+        num_param = np.prod(ws, dtype=int)
+        D[varname] = V[:, tt:tt + num_param].reshape((V.shape[0],) + tuple(ws))
+        tt += num_param
+    return D
+
+
 def get_num_params(weight_shapes):
     cnt = sum(np.prod(ws, dtype=int) for ws in weight_shapes.itervalues())
     return cnt
@@ -86,6 +103,75 @@ def logprior_np(theta):
                    for th in theta.itervalues())
     return logprior
 
+# Batched versions: theta has a leading axis over samples (e.g. chains)
+
+
+def _batch_dot(A, W, lib=T):
+    '''(n, N, D) or shared (N, D) inputs times (n, D, H) weights.'''
+    if lib is np:
+        return np.matmul(A, W)
+    if A.ndim == 2:
+        return T.tensordot(A, W, axes=[[1], [1]]).dimshuffle(1, 0, 2)
+    return T.batched_dot(A, W)
+
+
+def mlp_pred_batch(X, theta, lib=T):
+    '''mlp_pred for a batch of n parameters: yp is (n, N, out) and y_prec
+    is (n,). Can use lib=T or lib=np.'''
+    n_layers = get_n_layers(theta)
+
+    yp = X
+    for nn in xrange(n_layers):
+        W, b = theta['W_' + str(nn)], theta['b_' + str(nn)]
+        act = _batch_dot(yp, W, lib=lib) + b[:, None, :]
+        # Linear at final layer
+        yp = act if nn == n_layers - 1 else lib.maximum(0.0, act)
+    log_prec = theta['log_prec']
+    assert(log_prec.ndim == 1)
+    y_prec = lib.exp(log_prec)
+    return yp, y_prec
+
+
+def prod_net_pred_batch(X, theta, lib=T):
+    '''prod_net_pred for a batch of n parameters, all outputs (n, N, D).'''
+    a, b, c = [theta[k][:, None, None] for k in ('a', 'b', 'c')]
+
+    yp = a * b * X[None, :, :]
+    log_var = a * c * X[None, :, :]
+    y_prec = lib.exp(-log_var)
+    return yp, y_prec
+
+
+def loglik_batch(X, y, theta, pred_f=mlp_pred_batch, lib=T):
+    '''Gaussian loglik of the data for each of the n parameters: (n,).'''
+    yp, y_prec = pred_f(X, theta, lib=lib)
+    if y_prec.ndim == 1:
+        y_prec = y_prec[:, None, None]
+    err = yp - y[None, :, :]
+
+    loglik = -0.5 * np.log(2.0 * np.pi) + 0.5 * lib.log(y_prec) \
+        - 0.5 * y_prec * err ** 2
+    return loglik.sum(axis=2).sum(axis=1)
+
+
+def logprior_batch(V):
+    '''Same as logprior_np for each row of V (n, num_params): (n,).'''
+    return (-0.5 * V ** 2 - 0.5 * np.log(2.0 * np.pi)).sum(axis=1)
+
+
+def build_logp_grad(X, y, weight_shapes, pred_f=mlp_pred_batch):
+    '''Compiled f(V) -> logp (n,), grad (n, num_params) of the posterior
+    for a batch V (n, num_params), e.g. the states of n chains.'''
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    V = T.dmatrix('theta')
+    theta = unpack_batch(V, weight_shapes)
+    logp = logprior_batch(V) + loglik_batch(X, y, theta, pred_f, lib=T)
+    # Chains are independent, so grad of the sum gives the per-chain grads
+    f = theano.function([V], [logp, T.grad(T.sum(logp), V)])
+    return f
+
 # Define theano only flat versions of MLP functions
 
 
@@ -187,50 +273,193 @@ def prod_net_pm(X_train, Y_train, weight_shapes,
 
 def prod_net_hmc(X_train, Y_train, X_test, Y_test, init_samples, weight_shapes,
                  restarts=100, n_iter=500, n_tune=500, init_scale_iter=1000,
-                 build_model=prod_net_pm,
-                 logprior_np=logprior_np, loglik_np=prod_net_loglik_np):
+                 build_model=None, logprior_np=None, loglik_np=None,
+                 pred_f=prod_net_pred_batch, **hmc_args):
     '''Y_test only used to monitor loglik'''
+    _check_pm_args(build_model, logprior_np, loglik_np)
     num_params = get_num_params(weight_shapes)
     assert(init_samples.ndim == 2 and init_samples.shape[1] == num_params)
     assert(init_samples.shape[0] >= restarts)
 
-    model_input = theano.shared(X_train)
-    model_output = theano.shared(Y_train)
-    model = build_model(model_input, model_output, weight_shapes)
-
     var_estimate = np.var(init_samples, axis=0)
     assert(var_estimate.shape == (num_params,))
 
-    tr = [None] * restarts
+    return run_hmc(X_train, Y_train, X_test, Y_test,
+                   init_samples[:restarts, :], var_estimate, weight_shapes,
+                   n_iter=n_iter, n_tune=n_tune, pred_f=pred_f, **hmc_args)
+
+def _check_pm_args(build_model, logprior_np, loglik_np):
+    '''The pymc3 model and numpy logprior/loglik of the old restarts loop
+    are replaced by pred_f (a batched prediction, e.g. mlp_pred_batch).'''
+    if not (build_model is None and logprior_np is None and loglik_np is None):
+        raise ValueError('build_model, logprior_np and loglik_np are no '
+                         'longer supported, pass pred_f instead')
+
+# Vectorized HMC: all the chains advance together as the rows of a
+# (chains, num_params) state matrix, with one batched logp/grad evaluation
+# per leapfrog step.
+
+
+class Trace(object):
+    '''Samples (n, num_params) of one chain, with the parts of the pymc3
+    trace API used here: len, iteration over points (dicts of the vars), and
+    get_values.'''
+
+    def __init__(self, samples, weight_shapes):
+        assert(samples.ndim == 2)
+        self.samples = samples
+        self.weight_shapes = weight_shapes
+
+    def __len__(self):
+        return self.samples.shape[0]
+
+    def __getitem__(self, ii):
+        return unpack(self.samples[ii], self.weight_shapes)
+
+    def __iter__(self):
+        return (self[ii] for ii in xrange(len(self)))
+
+    def get_values(self, varname):
+        return unpack_batch(self.samples, self.weight_shapes)[varname]
+
+
+def hmc_sample(logp_grad_f, theta0, n_iter=500, n_tune=500, var_estimate=None,
+               n_leapfrog=20, step_size=0.1, target_accept=0.8,
+               rng=np.random):
+    '''HMC on all the chains (rows of theta0) at once, with a diagonal mass
+    matrix 1 / var_estimate (as pm.NUTS(scaling=var_estimate, is_cov=True)).
+    During the n_tune first iterations the step size of each chain is
+    adapted by dual averaging (Hoffman & Gelman, 2014) to target_accept.
+    Returns trace (n_tune + n_iter, chains, num_params), logp and accept
+    probabilities (n_tune + n_iter, chains).'''
+    n_chains, num_params = theta0.shape
+    if var_estimate is None:
+        var_estimate = np.ones(num_params)
+    assert(var_estimate.shape == (num_params,))
+    inv_mass = var_estimate[None, :]
+
+    q = np.array(theta0, dtype=np.float64)
+    logp, grad = logp_grad_f(q)
+
+    trace = np.zeros((n_tune + n_iter, n_chains, num_params))
+    logp_trace = np.zeros((n_tune + n_iter, n_chains))
+    accept_trace = np.zeros((n_tune + n_iter, n_chains))
+
+    # Dual averaging state, per chain
+    eps = step_size + np.zeros(n_chains)
+    mu = np.log(10.0 * eps)
+    H_bar = np.zeros(n_chains)
+    log_eps_bar = np.zeros(n_chains)
+    gamma, t0, kappa = 0.05, 10.0, 0.75
+
+    for ii in xrange(n_tune + n_iter):
+        p = rng.randn(n_chains, num_params) / np.sqrt(inv_mass)
+        # Jitter to avoid periodic trajectories
+        e = (eps * rng.uniform(0.9, 1.1, n_chains))[:, None]
+
+        q_new, g_new = q, grad
+        p_new = p + 0.5 * e * g_new
+        for ll in xrange(n_leapfrog):
+            q_new = q_new + e * inv_mass * p_new
+            logp_new, g_new = logp_grad_f(q_new)
+            if ll < n_leapfrog - 1:
+                p_new = p_new + e * g_new
+        p_new = p_new + 0.5 * e * g_new
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            nrg0 = -logp + 0.5 * np.sum(inv_mass * p ** 2, axis=1)
+            nrg1 = -logp_new + 0.5 * np.sum(inv_mass * p_new ** 2, axis=1)
+            log_accept = np.minimum(0.0, nrg0 - nrg1)
+        log_accept[~np.isfinite(log_accept)] = -np.inf  # Divergent
+        accept_prob = np.exp(log_accept)
+
+        accept = np.log(rng.rand(n_chains)) < log_accept
+        q = np.where(accept[:, None], q_new, q)
+        grad = np.where(accept[:, None], g_new, grad)
+        logp = np.where(accept, logp_new, logp)
+
+        if ii < n_tune:
+            m = ii + 1.0
+            H_bar = (1.0 - 1.0 / (m + t0)) * H_bar + \
+                (target_accept - accept_prob) / (m + t0)
+            log_eps = mu - (np.sqrt(m) / gamma) * H_bar
+            eta = m ** -kappa
+            log_eps_bar = eta * log_eps + (1.0 - eta) * log_eps_bar
+            eps = np.exp(log_eps_bar if ii == n_tune - 1 else log_eps)
+
+        trace[ii] = q
+        logp_trace[ii] = logp
+        accept_trace[ii] = accept_prob
+    return trace, logp_trace, accept_trace
+
+
+def trace_diagnostics(trace):
+    '''Split R-hat and effective sample size of each param, from a trace
+    (n, chains, num_params), vectorized over chains and params.'''
+    n, n_chains, num_params = trace.shape
+    assert(n >= 4)
+
+    # Split R-hat
+    half = n // 2
+    split = np.concatenate((trace[:half], trace[half:2 * half]), axis=1)
+    W = np.mean(np.var(split, axis=0, ddof=1), axis=0)
+    B = half * np.var(np.mean(split, axis=0), axis=0, ddof=1)
+    var_plus = ((half - 1.0) / half) * W + B / half
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rhat = np.sqrt(var_plus / W)
+
+    # ESS from the autocorrelation (FFT), summed until its first negative
+    x = trace - np.mean(trace, axis=0)
+    f = np.fft.rfft(x, n=2 * n, axis=0)
+    acov = np.fft.irfft(f * np.conj(f), axis=0)[:n]
+    acov = np.mean(acov, axis=1)  # Average over chains
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = acov / acov[0]
+    positive = np.cumprod(rho[1:] > 0.0, axis=0)
+    tau = 1.0 + 2.0 * np.sum(rho[1:] * positive, axis=0)
+    ess = (n * n_chains) / tau
+    return rhat, ess
+
+
+def run_hmc(X_train, Y_train, X_test, Y_test, starts, var_estimate,
+            weight_shapes, n_iter=500, n_tune=500, pred_f=mlp_pred_batch,
+            **hmc_args):
+    '''Run one chain per row of starts with hmc_sample, then get the
+    logprior and logliks of every sample, batched over the chains.'''
+    restarts, num_params = starts.shape
+
+    logp_grad_f = build_logp_grad(X_train, Y_train, weight_shapes, pred_f)
+
+    print 'starting to sample %d chains' % restarts
+    t = time()
+    trace, logp_chk, accept = hmc_sample(logp_grad_f, starts, n_iter=n_iter,
+                                         n_tune=n_tune,
+                                         var_estimate=var_estimate,
+                                         **hmc_args)
+    print (time() - t), 's'
+
     logprior = np.nan + np.zeros((n_tune + n_iter, restarts))
     loglik_train = np.nan + np.zeros((n_tune + n_iter, restarts))
     loglik_test = np.nan + np.zeros((n_tune + n_iter, restarts))
-    logp_chk = np.nan + np.zeros((n_tune + n_iter, restarts))
-    for rr in xrange(restarts):
-        print 'HMC run', str(rr)
-
-        # Cast to ordinary dict to be safe, for now
-        start = dict(unpack(init_samples[rr, :], weight_shapes))
-
-        print 'starting to sample'
-        t = time()
-        with model:
-            step = pm.NUTS(scaling=var_estimate, is_cov=True)
-            tr[rr] = pm.sampling.sample(draws=n_iter, step=step, start=start,
-                                        progressbar=False, tune=n_tune,
-                                        discard_tuned_samples=False)
-        print (time() - t), 's'
-
-        assert(len(tr[rr]) == n_tune + n_iter)
-        for ii, theta in enumerate(tr[rr]):
-            logp_chk[ii, rr] = model.logp(theta)
-            # We could also allow these to be None to skip checks
-            logprior[ii, rr] = logprior_np(theta)
-            loglik_train[ii, rr] = loglik_np(X_train, Y_train, theta)
-            loglik_test[ii, rr] = loglik_np(X_test, Y_test, theta)
+    for ii in xrange(n_tune + n_iter):
+        theta = unpack_batch(trace[ii], weight_shapes)
+        logprior[ii, :] = logprior_batch(trace[ii])
+        loglik_train[ii, :] = loglik_batch(X_train, Y_train, theta, pred_f,
+                                           lib=np)
+        loglik_test[ii, :] = loglik_batch(X_test, Y_test, theta, pred_f,
+                                          lib=np)
     err = np.max(np.abs(logp_chk - (logprior + loglik_train)))
     print 'nrg log10 err %f' % np.log10(err)
-    # Could use merge traces but prob not worth trouble
+
+    if trace.shape[0] - n_tune >= 4:
+        rhat, ess = trace_diagnostics(trace[n_tune:])
+        print 'accept rate %f, max R-hat %f, min ESS %f' % \
+            (np.mean(accept[n_tune:]), np.nanmax(rhat), np.nanmin(ess))
+    else:
+        # Too few samples for R-hat/ESS (e.g. test runs)
+        print 'accept rate %f' % np.mean(accept[n_tune:])
+
+    tr = [Trace(trace[:, rr, :], weight_shapes) for rr in xrange(restarts)]
     return tr, (logprior, loglik_train, loglik_test)
 
 # General pymc3 stuff
@@ -238,16 +467,13 @@ def prod_net_hmc(X_train, Y_train, X_test, Y_test, init_samples, weight_shapes,
 
 def hmc_net(X_train, Y_train, X_test, Y_test, initializer_f, weight_shapes,
             restarts=100, n_iter=500, n_tune=500, init_scale_iter=1000,
-            build_model=primary_net_pm,
-            logprior_np=logprior_np, loglik_np=mlp_loglik_np):
+            build_model=None, logprior_np=None, loglik_np=None,
+            pred_f=mlp_pred_batch, **hmc_args):
     '''hypernet_f can serve as initializer_f. Y_test only used to monitor
     loglik'''
+    _check_pm_args(build_model, logprior_np, loglik_np)
     num_params = get_num_params(weight_shapes)
 
-    ann_input = theano.shared(X_train)
-    ann_output = theano.shared(Y_train)
-    ann_model = build_model(ann_input, ann_output, weight_shapes)
-
     # TODO deal with False
     theta0 = [initializer_f(np.random.randn(num_params), False)
               for _ in xrange(init_scale_iter)]
@@ -255,76 +481,94 @@ def hmc_net(X_train, Y_train, X_test, Y_test, initializer_f, weight_shapes,
     var_estimate = np.var(theta0, axis=0)
     assert(var_estimate.shape == (num_params,))
 
-    tr = [None] * restarts
-    logprior = np.nan + np.zeros((n_tune + n_iter, restarts))
-    loglik_train = np.nan + np.zeros((n_tune + n_iter, restarts))
-    loglik_test = np.nan + np.zeros((n_tune + n_iter, restarts))
-    logp_chk = np.nan + np.zeros((n_tune + n_iter, restarts))
-    for rr in xrange(restarts):
-        print 'HMC run', str(rr)
-
-        z_noise = np.random.randn(num_params)
-        theta_vec = initializer_f(z_noise, False)
-        assert(theta_vec.shape == (num_params,))
-        # Cast to ordinary dict to be safe, for now
-        start = dict(unpack(theta_vec, weight_shapes))
-
-        print 'starting to sample'
-        t = time()
-        with ann_model:
-            step = pm.NUTS(scaling=var_estimate, is_cov=True)
-            tr[rr] = pm.sampling.sample(draws=n_iter, step=step, start=start,
-                                        progressbar=False, tune=n_tune,
-                                        discard_tuned_samples=False)
-        print (time() - t), 's'
-
-        assert(len(tr[rr]) == n_tune + n_iter)
-        for ii, theta in enumerate(tr[rr]):
-            logp_chk[ii, rr] = ann_model.logp(theta)
-            # We could also allow these to be None to skip checks
-            logprior[ii, rr] = logprior_np(theta)
-            loglik_train[ii, rr] = loglik_np(X_train, Y_train, theta)
-            loglik_test[ii, rr] = loglik_np(X_test, Y_test, theta)
-    err = np.max(np.abs(logp_chk - (logprior + loglik_train)))
-    print 'nrg log10 err %f' % np.log10(err)
-    # Could use merge traces but prob not worth trouble
-    return tr, (logprior, loglik_train, loglik_test)
+    starts = np.array([initializer_f(np.random.randn(num_params), False)
+                       for _ in xrange(restarts)])
+    assert(starts.shape == (restarts, num_params))
+
+    return run_hmc(X_train, Y_train, X_test, Y_test, starts, var_estimate,
+                   weight_shapes, n_iter=n_iter, n_tune=n_tune, pred_f=pred_f,
+                   **hmc_args)
 
 
-def hmc_pred(tr_list, X_test, y_test=None, p=(0.025, 0.5, 0.975)):
+def _stack_traces(tr_list):
+    '''Samples (n_samples, n_iter, num_params) of a list of Trace.'''
     n_samples = len(tr_list)
     assert(n_samples >= 1)
-    n_iter = len(tr_list[0])
+    weight_shapes = tr_list[0].weight_shapes
+    S = np.array([tr.samples for tr in tr_list])
+    assert(S.ndim == 3)
+    return S, weight_shapes
+
+
+def _chunk_iters(S, weight_shapes, n_grid, max_elems):
+    '''Number of iterations predicted at once for all the chains, so that
+    the largest activations of mlp_pred_batch have at most max_elems.'''
+    n_samples = S.shape[0]
+    width = max(ws[-1] for k, ws in weight_shapes.iteritems()
+                if k.startswith('W_'))
+    return max(1, max_elems // (n_samples * n_grid * width))
+
+
+def _pred_chunks(S, weight_shapes, X_test, noise, chunk):
+    '''Yield i0, mu_test, std_dev, y_samples for the iterations i0:i0+chunk
+    of all the chains: mu_test and y_samples are (n_samples, chunk, n_grid)
+    and std_dev (n_samples, chunk, 1).'''
+    n_samples, n_iter, num_params = S.shape
+    n_grid, _ = X_test.shape
+    for i0 in xrange(0, n_iter, chunk):
+        V = S[:, i0:i0 + chunk, :]
+        n_chunk = V.shape[1]
+        theta = unpack_batch(V.reshape((-1, num_params)), weight_shapes)
+        mu_test, y_prec = mlp_pred_batch(X_test, theta, lib=np)
+        assert(mu_test.shape == (n_samples * n_chunk, n_grid, 1))
+        mu_test = mu_test[:, :, 0].reshape((n_samples, n_chunk, n_grid))
+        std_dev = np.sqrt(1.0 / y_prec).reshape((n_samples, n_chunk, 1))
+        y_samples = mu_test + std_dev * noise[:, None, None]
+        yield i0, mu_test, std_dev, y_samples
+
+
+def hmc_pred(tr_list, X_test, y_test=None, p=(0.025, 0.5, 0.975),
+             max_elems=2 ** 25):
+    '''Predictions of every chain at every iteration. All the chains and
+    chunks of iterations are predicted at once (mlp_pred_batch), the
+    quantiles over the chains are exact per chunk. loglik and loglik_raw
+    are only computed (else None) when y_test is given.'''
+    S, weight_shapes = _stack_traces(tr_list)
+    n_samples, n_iter, _ = S.shape
     n_grid, _ = X_test.shape
     assert(y_test is None or y_test.shape == (n_grid,))
 
-    mu_test = np.zeros((n_samples, n_iter, n_grid))
-    y_samples = np.zeros((n_samples, n_iter, n_grid))
-    loglik_raw = np.nan + np.zeros((n_samples, n_iter, n_grid))
-    for ss, tr in enumerate(tr_list):
-        assert(len(tr) == n_iter)
-
-        noise = np.random.randn()
-        for ii, theta in enumerate(tr):
-            mu_test_, y_prec = mlp_pred(X_test, theta, lib=np)
-            mu_test[ss, ii, :] = mu_test_[:, 0]
-            std_dev = np.sqrt(1.0 / y_prec)
-            y_samples[ss, ii, :] = mu_test[ss, ii, :] + std_dev * noise
-            if y_test is not None:
-                # Could assert same as MLP loglik here for extra check
-                loglik_raw[ss, ii, :] = \
-                    norm.logpdf(y_test, loc=mu_test[ss, ii, :], scale=std_dev)
-
-    # Get predictive loglik over iteration
-    loglik = logsumexp(loglik_raw, axis=0) - np.log(n_samples)
-    assert(loglik.shape == (n_iter, n_grid))
-    loglik = np.mean(loglik, axis=1)  # Get average loss per example
-    assert(loglik.shape == (n_iter,))
-
-    # Summarize the predictions
-    mu = np.mean(mu_test, axis=0)  # Average the means w/o extra noise
-    std = np.std(mu_test, axis=0, ddof=0)  # MLE std
-    LB, UB = summarize(y_samples, p)  # MC estimate quantiles using noise
+    mu = np.zeros((n_iter, n_grid))
+    std = np.zeros((n_iter, n_grid))
+    LB = np.zeros((len(p), n_iter, n_grid))
+    UB = np.zeros((len(p), n_iter, n_grid))
+    loglik_raw = None
+    if y_test is not None:
+        loglik_raw = np.zeros((n_samples, n_iter, n_grid))
+    # Same noise for the whole grid and all iterations of a chain
+    noise = np.random.randn(n_samples)
+    chunk = _chunk_iters(S, weight_shapes, n_grid, max_elems)
+    for i0, mu_test, std_dev, y_samples in \
+            _pred_chunks(S, weight_shapes, X_test, noise, chunk):
+        i1 = i0 + mu_test.shape[1]
+        if y_test is not None:
+            # Could assert same as MLP loglik here for extra check
+            loglik_raw[:, i0:i1, :] = \
+                norm.logpdf(y_test[None, None, :], loc=mu_test, scale=std_dev)
+
+        mu[i0:i1, :] = np.mean(mu_test, axis=0)  # Average the means w/o noise
+        std[i0:i1, :] = np.std(mu_test, axis=0, ddof=0)  # MLE std
+        # MC estimate quantiles using noise
+        LB[:, i0:i1, :], UB[:, i0:i1, :] = summarize(y_samples, p)
+
+    loglik = None
+    if y_test is not None:
+        # Get predictive loglik over iteration
+        loglik = logsumexp(loglik_raw, axis=0) - np.log(n_samples)
+        assert(loglik.shape == (n_iter, n_grid))
+        loglik = np.mean(loglik, axis=1)  # Get average loss per example
+        assert(loglik.shape == (n_iter,))
+
     assert(mu.shape == (n_iter, n_grid))
     assert(std.shape == (n_iter, n_grid))
     assert(LB.shape == (len(p), n_iter, n_grid))
@@ -333,3 +577,60 @@ def hmc_pred(tr_list, X_test, y_test=None, p=(0.025, 0.5, 0.975)):
 
     # Only returning loglik_raw for now for debugging purposes
     return mu, std, LB, UB, loglik, loglik_raw
+
+
+def hmc_pred_pooled(tr_list, X_test, p=(0.025, 0.5, 0.975), burn_in=0,
+                    n_bins=1000, max_elems=2 ** 25):
+    '''Predictive of all the samples after burn_in, pooled over chains and
+    iterations, streamed in chunks so the samples are never all in memory:
+    mean and std of the means are accumulated, and the quantiles (as in
+    summarize) come from per grid point histograms of y, in a first pass
+    for the range and a second for the counts. The quantiles are accurate
+    to about (max - min) / n_bins.'''
+    S, weight_shapes = _stack_traces(tr_list)
+    S = S[:, burn_in:, :]
+    n_samples, n_iter, _ = S.shape
+    n_grid, _ = X_test.shape
+    assert(n_iter >= 1)
+
+    p = np.asarray(p)
+    levels = np.concatenate((0.5 * (1.0 - p), 0.5 * (1.0 + p)))
+    noise = np.random.randn(n_samples)
+    chunk = _chunk_iters(S, weight_shapes, n_grid, max_elems)
+    chunks = lambda: _pred_chunks(S, weight_shapes, X_test, noise, chunk)
+
+    mu_sum = np.zeros(n_grid)
+    mu_sq_sum = np.zeros(n_grid)
+    lo = np.inf + np.zeros(n_grid)
+    hi = -np.inf + np.zeros(n_grid)
+    for _, mu_test, _, y_samples in chunks():
+        mu_sum += np.sum(mu_test, axis=(0, 1))
+        mu_sq_sum += np.sum(mu_test ** 2, axis=(0, 1))
+        lo = np.minimum(lo, np.min(y_samples, axis=(0, 1)))
+        hi = np.maximum(hi, np.max(y_samples, axis=(0, 1)))
+    count = float(n_samples * n_iter)
+    mu = mu_sum / count
+    std = np.sqrt(np.maximum(mu_sq_sum / count - mu ** 2, 0.0))
+
+    width = np.maximum(hi - lo, 1e-12) / n_bins
+    counts = np.zeros((n_bins, n_grid))
+    grid_idx = np.arange(n_grid)
+    for _, _, _, y_samples in chunks():
+        y = y_samples.reshape((-1, n_grid))
+        bins = np.clip(((y - lo) / width).astype(int), 0, n_bins - 1)
+        flat = (bins * n_grid + grid_idx[None, :]).ravel()
+        counts += np.bincount(flat, minlength=n_bins * n_grid).reshape(
+            (n_bins, n_grid))
+    cdf = np.cumsum(counts, axis=0) / count
+
+    Q = np.zeros((len(levels), n_grid))
+    for qq, level in enumerate(levels):
+        idx = np.argmax(cdf >= level, axis=0)
+        cdf_prev = np.where(idx > 0, cdf[np.maximum(idx - 1, 0), grid_idx],
+                            0.0)
+        frac = (level - cdf_prev) / np.maximum(counts[idx, grid_idx] / count,
+                                               1e-12)
+        Q[qq, :] = lo + (idx + np.clip(frac, 0.0, 1.0)) * width
+    LB, UB = Q[:len(p)], Q[len(p):]
+    assert(np.all(LB <= UB))
+    return mu, std, LB, UB
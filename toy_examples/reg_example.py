@@ -193,6 +193,9 @@ if __name__ == '__main__':
         mlp_hmc.hmc_pred(tr, x_grid[:, None])
     _, _, _, _, loglik_hmc, loglik_raw = \
         mlp_hmc.hmc_pred(tr, X_valid, y_test=y_valid[:, 0])
+    # All samples after tuning, pooled over the chains
+    hmc_pooled = mlp_hmc.hmc_pred_pooled(tr, x_grid[:, None],
+                                         burn_in=n_tune_hmc)
 
     # Debug check to make sure get same answer for loglik
     _, _, loglik_test_dbg = hmc_dbg
@@ -225,6 +228,7 @@ if __name__ == '__main__':
     dump_dict['x'] = x_grid
     dump_dict['hmc'] = mu_hmc, std_hmc, LB_hmc, UB_hmc, loglik_hmc
     dump_dict['hmc_dbg'] = hmc_dbg
+    dump_dict['hmc_pooled'] = hmc_pooled
     dump_dict['hyper'] = mu_hyper, std_hyper, LB_hyper, UB_hyper, loglik_valid
     dump_dict['trad'] = mu_trad, std_dev_trad * np.ones(mu_trad.shape)
     with open('reg_example_dump.pkl', 'wb') as f:
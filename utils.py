@@ -5,9 +5,14 @@ Created on Fri Mar 31 21:39:54 2017
 @author: Chin-Wei
 """
 
+import os
 import theano.tensor as T
 import numpy as np
 
+from prefetch import iterate_minibatches
+from encoding import to_labels
+from helpers import checkpoint_exists
+
 from lasagne.updates import total_norm_constraint as tnc
 from lasagne.init import Normal
 from lasagne.init import Initializer, Orthogonal
@@ -66,20 +71,28 @@ def softmax(x,axis=1):
 
 
 
+def mc_mean(MCt):
+    """ mean over MC samples, accumulated in at least float32 """
+    return MCt.mean(0, dtype=np.promote_types(MCt.dtype, np.float32))
+
+
 # inds : the indices of the examples you wish to evaluate
 #   these should probably be ALL of the inds, OR be randomly sampled
-def MCpred(X, predict_probs_fn=None, num_samples=100, inds=None, returns='preds', num_classes=10):
+# dtype : storage of the samples, e.g. np.float16 to halve the memory of
+#   float32 predictions (averages are still computed in float32)
+def MCpred(X, predict_probs_fn=None, num_samples=100, inds=None, returns='preds', num_classes=10,
+           dtype=np.float64):
     if inds is None:
         inds = range(len(X))
-    rval = np.empty((num_samples, len(inds), num_classes))
+    rval = np.empty((num_samples, len(inds), num_classes), dtype=dtype)
     for ind in range(num_samples):
         rval[ind] = predict_probs_fn(X[inds])
     if returns == 'samples':
         return rval
     elif returns == 'probs':
-        return rval.mean(0)
+        return mc_mean(rval)
     elif returns == 'preds':
-        return rval.mean(0).argmax(-1)
+        return mc_mean(rval).argmax(-1)
 
 
     
@@ -138,12 +151,23 @@ def train_model(model,X,Y,Xv,Yv,
                 e0=0,rec=0,print_every=100,v_mc=20,n_classes=10,toshuffle=False,
                 verbose=False,
                 kl_weight=1.0,
-                save=1):
+                save=1,
+                resume=False,
+                checkpoint_every=1,
+                prefetch=0):
+    """
+    resume: every `checkpoint_every` epochs, params, optimizer and rng 
+    states and counters are checkpointed to name+'.resume'; if that 
+    checkpoint exists, training restarts from there.
+    prefetch: if > 0, minibatches are prepared by a worker thread, up to 
+    `prefetch` minibatches ahead (see prefetch.py)
+    """
     
     print 'trainset X.shape:{}, Y.shape:{}'.format(X.shape,Y.shape)
     N = X.shape[0]    
     va_rec_name = name+'_recs'
     save_path = name + '.params'
+    resume_path = name + '.resume'
     va_recs = list()
     tr_recs = list()
     
@@ -152,6 +176,12 @@ def train_model(model,X,Y,Xv,Yv,
     va_accs = []
 
     t = 0
+    if resume and checkpoint_exists(resume_path):
+        state = model.load(resume_path, opt_state=True, rng_state=True)
+        e0, t, rec, va_accs = state['e'], state['t'], state['rec'], \
+                              state['va_accs']
+        print 'resuming after epoch {}'.format(e0)
+    
     for e in range(epochs):
         
         if e <= e0:
@@ -168,9 +198,7 @@ def train_model(model,X,Y,Xv,Yv,
             #w = 1.0         
             w = kl_weight#model.weight.eval()
             
-        for i in range(N/bs):
-            x = X[i*bs:(i+1)*bs]
-            y = Y[i*bs:(i+1)*bs]
+        for x, y in iterate_minibatches(X,Y,bs,prefetch):
             
             loss = model.train_func(x,y,N,lr,w)
             
@@ -216,12 +244,17 @@ def train_model(model,X,Y,Xv,Yv,
         
         if toshuffle:
             X, Y = shuffle(X,Y)
+        
+        if resume and (e % checkpoint_every == 0 or e == epochs-1):
+            model.save(resume_path, [{'e': e, 't': t, 'rec': rec,
+                                      'va_accs': va_accs}], opt_state=True)
 
     return rval
 
 
-def evaluate_model(predict_proba,X,Y,n_mc=100,max_n=100,n_classes=10):
-    MCt = np.zeros((n_mc,X.shape[0],n_classes))
+def evaluate_model(predict_proba,X,Y,n_mc=100,max_n=100,n_classes=10,
+                   dtype=np.float64):
+    MCt = np.zeros((n_mc,X.shape[0],n_classes),dtype=dtype)
     
     N = X.shape[0]
     num_batches = np.ceil(N / float(max_n)).astype(int)
@@ -230,8 +263,9 @@ def evaluate_model(predict_proba,X,Y,n_mc=100,max_n=100,n_classes=10):
             x = X[j*max_n:(j+1)*max_n]
             MCt[i,j*max_n:(j+1)*max_n] = predict_proba(x)
     
-    Y_pred = MCt.mean(0).argmax(-1)
-    Y_true = Y.argmax(-1)
+    Y_pred = mc_mean(MCt).argmax(-1)
+    # Y: one-hot rows or int labels
+    Y_true = to_labels(Y)
     return np.equal(Y_pred,Y_true).mean()
 
 